@@ -0,0 +1,136 @@
+from typing import List, Union, Callable, Optional, Dict, Tuple
+from dataclasses import dataclass
+import asyncio
+import itertools
+import random
+import time
+from ..Core.UMRType import UnifiedMessage, ChatType, ChatAttribute, MessageEntity, EntityType
+from ..Core.UMRDriver import BaseDriverMixin, register_driver
+from ..Core.UMRMessageRelation import set_ingress_message_id, set_egress_message_id
+from ..Core import UMRConfig
+from ..Core import UMRLogging
+
+"""
+Driver that runs entirely in memory
+
+Sent messages are recorded instead of going to a platform, inbound messages are generated by inject()
+Used by benchmarks and for trying out topologies without real bots.
+"""
+
+logger = UMRLogging.get_logger('LoopbackDriver')
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+
+@dataclass
+class SentRecord:
+    """
+    One message received by the loopback platform
+    """
+    to_chat: Union[int, str]
+    chat_type: ChatType
+    message_id: int
+    message: UnifiedMessage
+    sent_at: float  # time.perf_counter()
+
+
+class LoopbackDriver(BaseDriverMixin):
+    def __init__(self, name, send_latency: float = 0.0, keep_records: bool = True):
+        """
+        Create driver instance
+
+        :param name: the name in ForwardList
+        :param send_latency: artificial latency of every send, in seconds
+        :param keep_records: keep every sent message in self.sent
+        """
+        super().__init__(name)
+        self.name = name
+        self.send_latency = send_latency
+        self.keep_records = keep_records
+        self.bot_account = UMRConfig.config.ForwardList.Accounts.get(name, 0)
+        self.sent: List[SentRecord] = list()
+        self.sent_count = 0
+        self.on_send: Optional[Callable[[SentRecord], None]] = None  # called after every send
+        self.message_id = itertools.count(1)
+
+    async def send(self, to_chat: Union[int, str], chat_type: ChatType, message: UnifiedMessage):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        message_id = next(self.message_id)
+        set_egress_message_id(src_platform=message.chat_attrs.platform,
+                              src_chat_id=message.chat_attrs.chat_id,
+                              src_chat_type=message.chat_attrs.chat_type,
+                              src_message_id=message.chat_attrs.message_id,
+                              dst_platform=self.name,
+                              dst_chat_id=to_chat,
+                              dst_chat_type=chat_type,
+                              dst_message_id=message_id,
+                              user_id=self.bot_account)
+        record = SentRecord(to_chat=to_chat, chat_type=chat_type, message_id=message_id, message=message,
+                            sent_at=time.perf_counter())
+        self.sent_count += 1
+        if self.keep_records:
+            self.sent.append(record)
+        if self.on_send:
+            self.on_send(record)
+        return message_id
+
+    async def is_group_admin(self, chat_id: int, chat_type: ChatType, user_id: int) -> bool:
+        return False
+
+    async def is_group_owner(self, chat_id: int, chat_type: ChatType, user_id: int) -> bool:
+        return False
+
+    async def inject(self, message: UnifiedMessage):
+        """
+        simulate an inbound message on this platform
+        :param message: message with chat_attrs.platform set to this driver
+        """
+        set_ingress_message_id(src_platform=self.name,
+                               src_chat_id=message.chat_attrs.chat_id,
+                               src_chat_type=message.chat_attrs.chat_type,
+                               src_message_id=message.chat_attrs.message_id,
+                               user_id=message.chat_attrs.user_id)
+        await self.receive(message)
+
+    def generate_message(self, chat_id: Union[int, str], chat_type: ChatType = ChatType.GROUP,
+                         rng: random.Random = random, entity_ratio: float = 0.3, media_url: str = '',
+                         reply_to: Optional[SentRecord] = None) -> UnifiedMessage:
+        """
+        generate synthetic message from this platform
+
+        :param chat_id: source chat
+        :param chat_type: source chat type
+        :param rng: random generator, for reproducible traffic
+        :param entity_ratio: probability of a word being formatted
+        :param media_url: attach this image url
+        :param reply_to: message sent by the bot in the same chat, to reply to
+        :return: message, not injected yet
+        """
+        words = [rng.choice(WORDS) for _ in range(rng.randint(1, 20))]
+        text = ''
+        entities = list()
+        for word in words:
+            if text:
+                text += ' '
+            if rng.random() < entity_ratio:
+                entity_type = rng.choice((EntityType.BOLD, EntityType.ITALIC, EntityType.CODE))
+                entities.append(MessageEntity(start=len(text), end=len(text) + len(word), entity_type=entity_type))
+            text += word
+
+        user_id = rng.randint(1, 1000)
+        message = UnifiedMessage(text=text, message_entities=entities, platform=self.name, chat_id=chat_id,
+                                 chat_type=chat_type, name=f'user{user_id}', user_id=user_id,
+                                 message_id=next(self.message_id))
+        if media_url:
+            message.image = media_url
+            message.file_id = media_url.rsplit('/', 1)[-1]
+        if reply_to:
+            message.chat_attrs.reply_to = ChatAttribute(platform=self.name, chat_id=reply_to.to_chat,
+                                                        chat_type=reply_to.chat_type, user_id=self.bot_account,
+                                                        message_id=reply_to.message_id)
+        return message
+
+
+register_driver('Loopback', LoopbackDriver)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory per entry of the message relation store
+
+Fills the store with synthetic relayed messages and measures allocated memory with tracemalloc,
+the layout used before the compact store (OrderedDict of dataclass keys and dicts) is measured for comparison.
+
+Run with: python -m unified_message_relay.Benchmark.RelationMemory --help
+Config is generated in a temporary home directory, the real ~/.umr/config.yaml is not touched.
+"""
+from collections import OrderedDict
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+import yaml
+
+PLATFORMS = ('Telegram', 'QQ', 'Discord', 'Line')
+
+
+def legacy_fill(messages: int, copies: int):
+    """
+    relation layout before the compact store, kept here only for comparison
+    """
+    from ..Core.UMRType import GroupID, MessageID, DestinationMessageID, ChatType
+
+    mapping = OrderedDict()
+    for i in range(messages):
+        src_platform = PLATFORMS[i % len(PLATFORMS)]
+        src = DestinationMessageID(platform=src_platform, chat_id=-(1000000 + i % 500), chat_type=ChatType.GROUP,
+                                   message_id=i, user_id=10000 + i % 1000)
+        saved = {GroupID(platform=src.platform, chat_id=src.chat_id, chat_type=src.chat_type): src}
+        mapping[MessageID(platform=src.platform, chat_id=src.chat_id, chat_type=src.chat_type, message_id=i)] = saved
+        for j in range(copies):
+            dst_platform = PLATFORMS[(i + j + 1) % len(PLATFORMS)]
+            dst = DestinationMessageID(platform=dst_platform, chat_id=-(2000000 + i % 500), chat_type=ChatType.GROUP,
+                                       message_id=i * 10 + j, user_id=1, source=src)
+            saved[GroupID(platform=dst.platform, chat_id=dst.chat_id, chat_type=dst.chat_type)] = dst
+            mapping[MessageID(platform=dst.platform, chat_id=dst.chat_id, chat_type=dst.chat_type,
+                              message_id=dst.message_id)] = saved
+    return mapping
+
+
+def compact_fill(messages: int, copies: int):
+    from ..Core.UMRMessageRelation import RelationStore
+    from ..Core.UMRType import ChatType
+
+    store = RelationStore(messages * (copies + 1))
+    for i in range(messages):
+        src_platform = PLATFORMS[i % len(PLATFORMS)]
+        src_chat = -(1000000 + i % 500)
+        store.set_ingress(src_platform, ChatType.GROUP, src_chat, i, 10000 + i % 1000)
+        for j in range(copies):
+            dst_platform = PLATFORMS[(i + j + 1) % len(PLATFORMS)]
+            store.set_egress((src_platform, ChatType.GROUP, src_chat, i), dst_platform, ChatType.GROUP,
+                             -(2000000 + i % 500), i * 10 + j, 1)
+    return store
+
+
+def measure(fill, messages: int, copies: int) -> int:
+    """
+    :return: bytes allocated by the filled store
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = fill(messages, copies)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+    return after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UMR message relation memory benchmark')
+    parser.add_argument('--messages', type=int, default=100000, help='number of received messages')
+    parser.add_argument('--copies', type=int, default=1, help='copies sent for every received message')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='umr-benchmark-')
+    os.makedirs(os.path.join(root, '.umr'))
+    with open(os.path.join(root, '.umr', 'config.yaml'), 'w') as f:
+        yaml.safe_dump({'DataRoot': root, 'LogRoot': root, 'ForwardList': {}}, f)
+    os.environ['HOME'] = root  # UMRConfig loads ~/.umr/config.yaml on import
+
+    keys = args.messages * (args.copies + 1)
+    print(f'relayed:         {args.messages} messages with {args.copies} copies each, {keys} keys')
+    for name, fill in (('legacy', legacy_fill), ('compact', compact_fill)):
+        size = measure(fill, args.messages, args.copies)
+        print(f'{name + ":":<16} {size / 1024 / 1024:.1f} MiB, {size / args.messages:.0f} bytes per message, '
+              f'{size / keys:.0f} bytes per key')
+
+
+if __name__ == '__main__':
+    main()
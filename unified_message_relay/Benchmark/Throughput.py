@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput benchmark through UMRDispatcher
+
+Generates a ForwardList topology of loopback drivers, injects synthetic traffic and reports
+messages per second and p50/p99 latency from inject to driver send.
+
+Run with: python -m unified_message_relay.Benchmark.Throughput --help
+Config is generated in a temporary home directory, the real ~/.umr/config.yaml is not touched.
+"""
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+import yaml
+
+PLATFORMS = ('LoopA', 'LoopB', 'LoopC')
+
+
+def generate_config(root: str, chats: int, defaults: int, rng: random.Random) -> dict:
+    """
+    :param root: temporary directory for data and logs
+    :param chats: number of bridged chats on each side of the topology
+    :param defaults: number of Default rules
+    :param rng: random generator
+    :return: config dict
+    """
+    topology = list()
+    for i in range(chats):
+        src, dst = rng.sample(PLATFORMS, 2)
+        forward_type = rng.choices(('BiDirection', 'OneWay+', 'OneWay'), weights=(5, 4, 1))[0]
+        topology.append({
+            'From': src,
+            'FromChat': -(1000000 + i),
+            'FromChatType': 'group',
+            'To': dst,
+            'ToChat': -(2000000 + i),
+            'ToChatType': 'group',
+            'ForwardType': forward_type,
+        })
+
+    default = list()
+    for i in range(defaults):
+        src, dst = rng.sample(PLATFORMS, 2)
+        default.append({
+            'From': src,
+            'To': dst,
+            'ToChat': -(3000000 + i),
+            'ToChatType': 'group',
+            'ForwardType': rng.choice(('OneWay', 'OneWay+')),
+        })
+
+    return {
+        'DataRoot': os.path.join(root, 'data'),
+        'LogRoot': os.path.join(root, 'log'),
+        'ForwardList': {
+            'Accounts': {platform: 10000 + index for index, platform in enumerate(PLATFORMS)},
+            'Topology': topology,
+            'Default': default,
+        },
+        'Driver': {platform: {'Base': 'Loopback'} for platform in PLATFORMS},
+    }
+
+
+async def serve_media():
+    """
+    local stand-in for platform file servers, every path returns the same png
+    :return: (runner, base url)
+    """
+    from aiohttp import web
+    from PIL import Image
+    from io import BytesIO
+
+    buffer = BytesIO()
+    Image.new('RGB', (64, 64), (255, 0, 0)).save(buffer, 'PNG')
+    png = buffer.getvalue()
+
+    async def handler(request):
+        return web.Response(body=png, content_type='image/png')
+
+    app = web.Application()
+    app.router.add_get('/{name}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]  # port 0 is resolved by the listening socket
+    return runner, f'http://{host}:{port}'
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+async def run(args, config: dict):
+    from ..Core import UMRDispatcher
+    from ..Core import UMRDriver
+    from .LoopbackDriver import LoopbackDriver, SentRecord
+
+    rng = random.Random(args.seed)
+    media_runner, media_root = await serve_media()
+
+    UMRDispatcher.init_dispatcher()
+    if args.hook_block:
+        from ..Core.UMRMessageHook import register_hook
+
+        @register_hook()
+        async def blocking_hook(message) -> bool:
+            time.sleep(args.hook_block)  # stands in for blocking IO or GIL releasing conversion in a hook
+            return False
+
+    inject_time: Dict[Tuple[str, int], float] = dict()
+    latencies: List[float] = list()
+    drivers: Dict[str, LoopbackDriver] = dict()
+
+    def on_send(record: SentRecord):
+        started = inject_time.get((record.message.chat_attrs.platform, record.message.chat_attrs.message_id))
+        if started:
+            latencies.append(record.sent_at - started)
+
+    for platform in PLATFORMS:
+        driver = LoopbackDriver(platform, send_latency=args.latency)
+        driver.on_send = on_send
+        UMRDriver.add_driver(platform, driver)
+        drivers[platform] = driver
+
+    # source chats: both sides of every topology entry, plus unbridged chats that hit Default rules
+    sources: List[Tuple[str, int]] = list()
+    for i in config['ForwardList']['Topology']:
+        sources.append((i['From'], i['FromChat']))
+        sources.append((i['To'], i['ToChat']))
+    for i in range(args.unbridged):
+        sources.append((rng.choice(PLATFORMS), -(4000000 + i)))
+
+    async def chat_worker(queue: asyncio.Queue):
+        while True:
+            platform, chat_id = await queue.get()
+            driver = drivers[platform]
+            reply_to = None
+            if rng.random() < args.reply_ratio:
+                candidates = [i for i in driver.sent[-200:] if i.to_chat == chat_id]
+                if candidates:
+                    reply_to = rng.choice(candidates)
+            media_url = ''
+            if rng.random() < args.media_ratio:
+                media_url = f'{media_root}/{rng.randint(1, args.media_files)}.png'
+            message = driver.generate_message(chat_id, rng=rng, media_url=media_url, reply_to=reply_to)
+            inject_time[(platform, message.chat_attrs.message_id)] = time.perf_counter()
+            await driver.inject(message)
+            queue.task_done()
+
+    queue = asyncio.Queue()
+    for _ in range(args.messages):
+        queue.put_nowait(rng.choice(sources))
+
+    started = time.perf_counter()
+    workers = [asyncio.ensure_future(chat_worker(queue)) for _ in range(args.concurrency)]
+    await queue.join()
+    dispatched = time.perf_counter()
+
+    # wait for queued and coalesced messages
+    last_count = -1
+    while True:
+        count = sum(i.sent_count for i in drivers.values())
+        if count == last_count:
+            break
+        last_count = count
+        await asyncio.sleep(max(args.latency * 3, 0.2))
+    finished = max([i.sent[-1].sent_at for i in drivers.values() if i.sent] or [dispatched])
+
+    for worker in workers:
+        worker.cancel()
+    await media_runner.cleanup()
+
+    latencies.sort()
+    elapsed = finished - started
+    delivered = sum(i.sent_count for i in drivers.values())
+    print(f'topology:        {args.chats} bridges, {args.defaults} default rules, {len(sources)} source chats')
+    print(f'injected:        {args.messages} messages in {dispatched - started:.3f}s')
+    print(f'delivered:       {delivered} copies in {elapsed:.3f}s')
+    print(f'throughput:      {args.messages / elapsed:.1f} messages/s, {delivered / elapsed:.1f} copies/s')
+    print(f'latency p50:     {percentile(latencies, 0.5) * 1000:.3f} ms')
+    print(f'latency p99:     {percentile(latencies, 0.99) * 1000:.3f} ms')
+    print(f'latency max:     {(latencies[-1] if latencies else 0) * 1000:.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UMR dispatch throughput benchmark')
+    parser.add_argument('--chats', type=int, default=300, help='number of Topology entries')
+    parser.add_argument('--defaults', type=int, default=6, help='number of Default rules')
+    parser.add_argument('--unbridged', type=int, default=50, help='source chats only covered by Default rules')
+    parser.add_argument('--messages', type=int, default=5000, help='number of injected messages')
+    parser.add_argument('--concurrency', type=int, default=32, help='messages injected at the same time')
+    parser.add_argument('--latency', type=float, default=0.0, help='artificial send latency in seconds')
+    parser.add_argument('--reply-ratio', type=float, default=0.1, help='share of messages that reply to the bot')
+    parser.add_argument('--media-ratio', type=float, default=0.02, help='share of messages with an image')
+    parser.add_argument('--media-files', type=int, default=20, help='number of distinct images')
+    parser.add_argument('--concurrent-fan-out', action='store_true', help='enable Dispatch.ConcurrentFanOut')
+    parser.add_argument('--send-queue', action='store_true', help='enable Dispatch.SendQueue')
+    parser.add_argument('--media-workers', type=int, default=0, help='set Dispatch.MediaWorkers')
+    parser.add_argument('--ingress', action='store_true', help='enable Dispatch.Ingress')
+    parser.add_argument('--shards', type=int, default=1, help='set Dispatch.Ingress.Shards')
+    parser.add_argument('--hook-block', type=float, default=0.0, help='seconds a message hook blocks its thread')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='umr-benchmark-')
+    config = generate_config(root, args.chats, args.defaults, random.Random(args.seed))
+    config['Dispatch'] = {
+        'ConcurrentFanOut': args.concurrent_fan_out,
+        'SendQueue': {'Enabled': args.send_queue, 'MaxSize': 0},
+        'MediaWorkers': args.media_workers,
+        'Ingress': {'Enabled': args.ingress, 'MaxSize': 0, 'Shards': args.shards},
+    }
+    os.makedirs(os.path.join(root, '.umr'))
+    os.makedirs(config['DataRoot'])
+    with open(os.path.join(root, '.umr', 'config.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+    os.environ['HOME'] = root  # UMRConfig loads ~/.umr/config.yaml on import
+
+    from ..Core import UMRLogging
+    UMRLogging.root_logger.setLevel(logging.WARNING)
+
+    asyncio.run(run(args, config))
+
+
+if __name__ == '__main__':
+    main()
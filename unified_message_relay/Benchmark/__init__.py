@@ -0,0 +1 @@
+# leave blank, modules here read config on import
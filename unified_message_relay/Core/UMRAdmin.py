@@ -1,13 +1,153 @@
-from typing import Dict, List
+from typing import Dict, Tuple, Set, Union
+from concurrent.futures import Future
+from threading import Lock
+import asyncio
+import time
 from . import UMRConfig
 from . import UMRLogging
 from .UMRDriver import api_call
+from .UMRMetrics import metrics
 from .UMRType import ChatType
 
-# Stateless
+"""
+Privilege checks
+
+Group admin and owner checks go to the platform API, some drivers fetch the whole member list to answer.
+Results are cached per platform for Driver.<name>.PrivilegeCacheTTL seconds, concurrent checks of the same member
+share one request, drivers call invalidate_privilege when they see role changes.
+"""
 
 logger = UMRLogging.get_logger('Admin')
 
+CACHE_SIZE = 10000  # cached checks, expired ones are removed when full
+
+PrivilegeKey = Tuple[str, str, str, str]  # (platform, role, chat id, user id)
+
+
+class PrivilegeCache:
+    def __init__(self):
+        """
+        Thread safe, commands received by drivers on different threads may check the same member at the same time
+        """
+        self.entries: Dict[PrivilegeKey, Tuple[float, bool]] = dict()  # key -> (expire time, result)
+        self.pending: Dict[PrivilegeKey, Future] = dict()
+        self.generation = 0  # increased by invalidate, results fetched before that are not cached
+        self.lock = Lock()
+
+    async def check(self, platform: str, role: str, chat_id: Union[int, str], chat_type: ChatType,
+                    user_id: Union[int, str], ttl: float) -> bool:
+        """
+        :param platform: platform name
+        :param role: is_group_admin or is_group_owner
+        :param chat_id: group id
+        :param chat_type: chat type
+        :param user_id: member id
+        :param ttl: seconds to cache the result
+        :return: cached or fetched result
+        """
+        key = (platform, role, str(chat_id), str(user_id))
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[0] > time.monotonic():
+                    metrics.increase('privilege_cache_hit', platform)
+                    return entry[1]
+                future = self.pending.get(key)
+                owner = future is None
+                if owner:
+                    future = Future()
+                    self.pending[key] = future
+                    generation = self.generation
+
+            if owner:
+                break
+            try:
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                if not future.cancelled():  # this check is cancelled
+                    raise
+                # the check fetching the result is cancelled, try again
+
+        metrics.increase('privilege_cache_miss', platform)
+        try:
+            result = await query(platform, role, chat_id, chat_type, user_id)
+        except asyncio.CancelledError:
+            with self.lock:
+                self.pending.pop(key, None)
+            future.cancel()
+            raise
+        except Exception as e:
+            with self.lock:
+                self.pending.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.pending.pop(key, None)
+            if generation == self.generation:
+                if len(self.entries) >= CACHE_SIZE:
+                    self.prune()
+                self.entries[key] = (time.monotonic() + ttl, result)
+        future.set_result(result)
+        return result
+
+    def prune(self):
+        # caller holds the lock
+        now = time.monotonic()
+        self.entries = {key: entry for key, entry in self.entries.items() if entry[0] > now}
+        if len(self.entries) >= CACHE_SIZE:
+            self.entries = dict()
+
+    def invalidate(self, platform: str, chat_id: Union[int, str, None] = None, user_id: Union[int, str, None] = None):
+        """
+        :param platform: platform name
+        :param chat_id: only this chat, None for every chat
+        :param user_id: only this member, None for every member
+        """
+        chat_id = None if chat_id is None else str(chat_id)
+        user_id = None if user_id is None else str(user_id)
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries
+                        if key[0] == platform
+                        and (chat_id is None or key[2] == chat_id)
+                        and (user_id is None or key[3] == user_id)]:
+                del self.entries[key]
+
+
+privilege_cache = PrivilegeCache()
+
+bot_admin_config = None
+bot_admins: Dict[str, Set[str]] = dict()  # platform -> bot admin ids as str
+
+
+def get_bot_admins(platform: str) -> Set[str]:
+    global bot_admin_config, bot_admins
+    if bot_admin_config is not UMRConfig.config.BotAdmin:  # rebuilt after config reload
+        bot_admins = {_platform: {str(i) for i in user_ids}
+                      for _platform, user_ids in (UMRConfig.config.BotAdmin or dict()).items()}
+        bot_admin_config = UMRConfig.config.BotAdmin
+    return bot_admins.get(platform, set())
+
+
+def privilege_ttl(platform: str) -> float:
+    driver_config = (UMRConfig.config.Driver or dict()).get(platform)
+    if not driver_config:
+        return 0
+    return driver_config.PrivilegeCacheTTL
+
+
+async def query(platform: str, role: str, chat_id: Union[int, str], chat_type: ChatType,
+                user_id: Union[int, str]) -> bool:
+    result = await api_call(platform, role, chat_id, chat_type, user_id)
+    if result:  # result can be None if driver does not have is_group_admin or is_group_owner
+        if isinstance(result, bool):
+            return result
+        else:
+            return result.result()
+    else:
+        return False
+
 
 async def is_bot_admin(platform: str, user_id: int) -> bool:
     """
@@ -16,32 +156,34 @@ async def is_bot_admin(platform: str, user_id: int) -> bool:
     :param user_id:
     :return:
     """
-    if platform not in UMRConfig.config.BotAdmin:
-        return False
-    return user_id in UMRConfig.config.BotAdmin[platform]
+    return str(user_id) in get_bot_admins(platform)
 
 
 async def is_group_owner(platform: str, chat_id: int, chat_type: ChatType, user_id: int):
     if chat_id > 0:  # private chat
         return False
-    result = await api_call(platform, 'is_group_owner', chat_id, chat_type, user_id)
-    if result:  # result can be None if driver does not have is_group_owner
-        if isinstance(result, bool):
-            return result
-        else:
-            return result.result()
-    else:
-        return False
+    ttl = privilege_ttl(platform)
+    if not ttl:
+        return await query(platform, 'is_group_owner', chat_id, chat_type, user_id)
+    return await privilege_cache.check(platform, 'is_group_owner', chat_id, chat_type, user_id, ttl)
 
 
 async def is_group_admin(platform: str, chat_id: int, chat_type: ChatType, user_id: int):
     if chat_id > 0:  # private chat
         return False
-    result = await api_call(platform, 'is_group_admin', chat_id, chat_type, user_id)
-    if result:  # result can be None if driver does not have is_group_admin
-        if isinstance(result, bool):
-            return result
-        else:
-            return result.result()
-    else:
-        return False
+    ttl = privilege_ttl(platform)
+    if not ttl:
+        return await query(platform, 'is_group_admin', chat_id, chat_type, user_id)
+    return await privilege_cache.check(platform, 'is_group_admin', chat_id, chat_type, user_id, ttl)
+
+
+def invalidate_privilege(platform: str, chat_id: Union[int, str, None] = None,
+                         user_id: Union[int, str, None] = None):
+    """
+    drop cached admin and owner checks, call when the platform reports role or membership changes
+    can be called from any thread
+    :param platform: platform name
+    :param chat_id: only this chat, None for every chat
+    :param user_id: only this member, None for every member
+    """
+    privilege_cache.invalidate(platform, chat_id, user_id)
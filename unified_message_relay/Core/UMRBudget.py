@@ -0,0 +1,44 @@
+from typing import Callable, Awaitable, Any
+import asyncio
+import time
+from .UMRMetrics import metrics
+from . import UMRLogging
+
+"""
+Time budget of extension code
+
+Hooks and commands run inline in dispatch, one slow function holds up every message behind it.
+Every call is timed per function, calls over budget are cancelled.
+"""
+
+logger = UMRLogging.get_logger('Budget')
+
+
+def function_name(function: Callable) -> str:
+    return f'{function.__module__}.{function.__qualname__}'
+
+
+async def call_with_budget(kind: str, function: Callable[..., Awaitable], budget: float, *args, default: Any = None):
+    """
+    call coroutine function with time budget and record its time
+    :param kind: e.g. hook, command
+    :param function: coroutine function
+    :param budget: seconds before the call is cancelled, 0 for no limit
+    :param args: positional args to pass
+    :param default: returned when the call is cancelled
+    :return: result of function, default if cancelled
+    """
+    stats = metrics.function(kind, function_name(function))
+    start = time.perf_counter()
+    timed_out = False
+    try:
+        if budget:
+            return await asyncio.wait_for(function(*args), budget)
+        return await function(*args)
+    except asyncio.TimeoutError:
+        timed_out = True
+        logger.warning(f'{kind.capitalize()} {function_name(function)} exceeded its budget of {budget}s '
+                       f'and was cancelled')
+        return default
+    finally:
+        stats.record(time.perf_counter() - start, timed_out)
@@ -0,0 +1,227 @@
+from typing import Dict, Union, Callable, Awaitable, Any
+from threading import Lock
+import asyncio
+import concurrent.futures
+import time
+from .UMRType import CircuitState
+from .UMRMetrics import metrics
+from . import UMRConfig
+from . import UMRLogging
+
+"""
+Send timeouts and circuit breaker per destination driver
+
+After FailureThreshold consecutive failures or timeouts the circuit opens, sends to that driver fail fast
+instead of waiting for a hanging API. After Cooldown one probe send is allowed, success closes the circuit,
+failure opens it again.
+"""
+
+logger = UMRLogging.get_logger('CircuitBreaker')
+
+STATE_VALUE = {CircuitState.CLOSED: 0, CircuitState.HALF_OPEN: 1, CircuitState.OPEN: 2}  # exported gauge value
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, platform: str, retry_after: float):
+        super().__init__(f'Circuit of driver "{platform}" is open, retry after {retry_after:.1f}s')
+        self.platform = platform
+        self.retry_after = retry_after
+
+
+def wait_result(result: Any) -> Awaitable:
+    """
+    sync driver methods may return a future of the actual send, on any event loop or thread
+    :param result: value returned by the driver
+    :return: awaitable of the final result
+    """
+    if isinstance(result, concurrent.futures.Future):
+        return asyncio.wrap_future(result)
+    if not isinstance(result, asyncio.Future):
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(result)
+        return future
+    if result.get_loop() is asyncio.get_event_loop():
+        return result
+
+    bridge = concurrent.futures.Future()  # future of another event loop
+
+    def copy(source: asyncio.Future):
+        if source.cancelled():
+            bridge.cancel()
+        elif source.exception():
+            bridge.set_exception(source.exception())
+        else:
+            bridge.set_result(source.result())
+
+    result.get_loop().call_soon_threadsafe(result.add_done_callback, copy)
+    return asyncio.wrap_future(bridge)
+
+
+class CircuitBreaker:
+    def __init__(self, platform: str, failure_threshold: int, cooldown: float, timeout: float):
+        """
+        Thread safe circuit breaker of one destination driver
+
+        :param platform: driver name
+        :param failure_threshold: consecutive failures that open the circuit, 0 for disabled
+        :param cooldown: seconds before a probe send is allowed
+        :param timeout: send timeout in seconds, 0 for no timeout
+        """
+        self.platform = platform
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self.lock = Lock()
+
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+        # statistics
+        self.opened = 0     # number of times the circuit opened
+        self.rejected = 0   # sends failed fast while open
+        self.timeouts = 0   # sends that timed out
+
+        metrics.set_gauge('circuit_state', platform, STATE_VALUE[self.state])
+
+    def _set_state(self, state: CircuitState):
+        if state == self.state:
+            return
+        logger.warning(f'Circuit of driver "{self.platform}" changed from {self.state.value} to {state.value}')
+        self.state = state
+        metrics.set_gauge('circuit_state', self.platform, STATE_VALUE[state])
+
+    def retry_after(self) -> float:
+        """
+        :return: seconds until a probe send is allowed, 0 if sending is allowed now
+        """
+        if self.state != CircuitState.OPEN:
+            return 0.0
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """
+        check if a send may go through, moves an open circuit to half-open after cooldown
+        :return: True if the send may go through
+        """
+        if not self.failure_threshold:
+            return True
+        with self.lock:
+            if self.state == CircuitState.CLOSED:
+                return True
+            if self.state == CircuitState.OPEN:
+                if self.retry_after() > 0:
+                    self.rejected += 1
+                    return False
+                self._set_state(CircuitState.HALF_OPEN)
+            if self.probing:  # only one probe at a time
+                self.rejected += 1
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        if not self.failure_threshold:
+            return
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self._set_state(CircuitState.CLOSED)
+
+    def release_probe(self):
+        """
+        probe send is cancelled before it has a result
+        """
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitState.OPEN:
+                    self.opened += 1
+                self.opened_at = time.monotonic()
+                self._set_state(CircuitState.OPEN)
+
+
+class CircuitBreakers:
+    def __init__(self):
+        """
+        Lazily created breakers for every destination driver, configured by SendTimeout and CircuitBreaker
+        """
+        self.breakers: Dict[str, CircuitBreaker] = dict()
+        self.lock = Lock()
+
+    def get(self, platform: str) -> CircuitBreaker:
+        breaker = self.breakers.get(platform)
+        if not breaker:
+            driver_config = UMRConfig.config.Driver.get(platform)
+            if driver_config:
+                breaker_config = driver_config.CircuitBreaker
+                timeout = driver_config.SendTimeout
+            else:
+                breaker_config = UMRConfig.CircuitBreakerConfig()
+                timeout = 0
+            with self.lock:
+                breaker = self.breakers.get(platform)
+                if not breaker:  # created once, a new breaker resets the circuit_state gauge
+                    breaker = CircuitBreaker(platform, breaker_config.FailureThreshold, breaker_config.Cooldown,
+                                             timeout)
+                    self.breakers[platform] = breaker
+        return breaker
+
+    def ready(self, platform: str) -> bool:
+        """
+        :return: False while the circuit of platform is open and cooling down
+        """
+        return not self.get(platform).retry_after()
+
+    async def call(self, platform: str, function: Callable[..., Awaitable], *args, **kwargs):
+        """
+        call function through the breaker of platform, with send timeout
+        futures returned by function are waited for within the timeout, so sync drivers are measured by delivery
+        :param platform: dst platform
+        :param function: coroutine function to call
+        :return: result of function
+        :raise CircuitOpenError: circuit is open, function is not called
+        :raise asyncio.TimeoutError: function did not finish in time
+        """
+        breaker = self.get(platform)
+        if not breaker.allow():
+            raise CircuitOpenError(platform, breaker.retry_after())
+
+        async def send():
+            return await wait_result(await function(*args, **kwargs))
+
+        try:
+            if breaker.timeout:
+                result = await asyncio.wait_for(send(), breaker.timeout)
+            else:
+                result = await send()
+        except asyncio.TimeoutError:
+            breaker.timeouts += 1
+            metrics.increase('send_timeouts', platform)
+            breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result
+
+    def stats(self) -> Dict[str, Dict[str, Union[str, int, float]]]:
+        """
+        :return: state, consecutive failures, open count, fast failed and timed out sends of every driver
+        """
+        return {platform: {'state': breaker.state.value, 'failures': breaker.failures, 'opened': breaker.opened,
+                           'rejected': breaker.rejected, 'timeouts': breaker.timeouts,
+                           'retry_after': breaker.retry_after()}
+                for platform, breaker in list(self.breakers.items())}
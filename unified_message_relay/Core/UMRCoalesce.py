@@ -0,0 +1,193 @@
+from typing import Dict, List, Union, Optional, Callable, Awaitable
+from threading import Lock
+import asyncio
+from .UMRType import UnifiedMessage, UnifiedMessageView, MessageEntity, ChatType, GroupID
+from . import UMRConfig
+from . import UMRLogging
+
+"""
+Burst coalescing for destination chats
+
+Consecutive text messages from the same sender in the same source chat are merged into one message
+if they arrive within a short window. Replies, forwards and media flush the buffer and are sent as is.
+The merged message keeps the attributes of the first message, so only the first one can be replied to
+from the destination chat.
+"""
+
+logger = UMRLogging.get_logger('Coalesce')
+
+Sender = Callable[[UnifiedMessage, str, Union[int, str], ChatType], Awaitable]
+
+
+def is_coalescible(message: UnifiedMessage) -> bool:
+    """
+    :return: True for plain text messages that are not replies or forwards
+    """
+    return bool(message.text) and not message.image and not message.send_action.message_id and \
+        not message.chat_attrs.reply_to and not message.chat_attrs.forward_from
+
+
+def is_same_sender(message: UnifiedMessage, other: UnifiedMessage) -> bool:
+    return message.chat_attrs.platform == other.chat_attrs.platform and \
+        message.chat_attrs.chat_id == other.chat_attrs.chat_id and \
+        message.chat_attrs.user_id == other.chat_attrs.user_id
+
+
+def merge_messages(messages: List[UnifiedMessage], separator: str = '\n') -> UnifiedMessage:
+    """
+    merge text messages into one, entity offsets are shifted to the merged text
+    :param messages: messages to merge, the first one provides every other attribute
+    :param separator: text between messages
+    :return: merged message
+    """
+    if len(messages) == 1:
+        return messages[0]
+
+    text = ''
+    text_entities: List[MessageEntity] = list()
+    for message in messages:
+        if text:
+            text += separator
+        offset = len(text)
+        for entity in message.text_entities or ():
+            text_entities.append(MessageEntity(start=entity.start + offset,
+                                               end=entity.end + offset,
+                                               entity_type=entity.entity_type,
+                                               link=entity.link))
+        text += message.text
+
+    return UnifiedMessageView(messages[0], text=text, text_entities=text_entities)
+
+
+class MessageCoalescer:
+    def __init__(self, destination: GroupID, sender: Sender, window: float, max_messages: int):
+        """
+        Buffers consecutive text messages from one sender to one destination chat, the buffer is merged and sent
+        when the sender changes, a reply or media message arrives, max_messages is reached, or nothing new
+        arrives within window. The buffer, its lock and the window timer belong to the current event loop,
+        submits from other loops are handed over to it.
+
+        :param destination: destination chat
+        :param sender: coroutine function that sends the (merged) message
+        :param window: seconds to wait for the next message before flushing
+        :param max_messages: flush when this many messages are buffered
+        """
+        self.destination = destination
+        self.sender = sender
+        self.window = window
+        self.max_messages = max_messages
+        self.loop = asyncio.get_event_loop()
+        self.lock = asyncio.Lock()  # keeps flushes and direct sends in order
+        self.messages: List[UnifiedMessage] = list()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+        # statistics
+        self.received = 0
+        self.sent = 0
+
+    async def submit(self, message: UnifiedMessage):
+        """
+        buffer or send message, can be called from any event loop
+        :param message: message to send
+        """
+        if asyncio.get_event_loop() is self.loop:
+            await self._submit(message)
+        else:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._submit(message), self.loop))
+
+    async def _submit(self, message: UnifiedMessage):
+        async with self.lock:
+            self.received += 1
+            if not is_coalescible(message):
+                await self._flush()
+                await self._send(message)
+                return
+
+            if self.messages and not is_same_sender(self.messages[0], message):
+                await self._flush()
+
+            self.messages.append(message)
+            if len(self.messages) >= self.max_messages:
+                await self._flush()
+                return
+
+            if self.timer:
+                self.timer.cancel()
+            self.timer = self.loop.call_later(self.window, self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        self.loop.create_task(self.flush())
+
+    async def flush(self):
+        async with self.lock:
+            await self._flush()
+
+    async def _flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        messages, self.messages = self.messages, list()
+        if not messages:
+            return
+        if len(messages) > 1:
+            logger.debug(f'Merged {len(messages)} messages to {self.destination}')
+        await self._send(merge_messages(messages))
+
+    async def _send(self, message: UnifiedMessage):
+        self.sent += 1
+        try:
+            await self.sender(message, self.destination.platform, self.destination.chat_id,
+                              self.destination.chat_type)
+        except Exception:
+            logger.exception(f'Failed to send message to {self.destination}')
+
+
+class Coalescers:
+    def __init__(self, sender: Sender, rules: List[UMRConfig.CoalesceRule]):
+        """
+        Lazily created coalescers for destinations that opted in
+
+        :param sender: coroutine function that sends the (merged) message
+        :param rules: Coalesce section of Dispatch config
+        """
+        self.sender = sender
+        self.rules: Dict[str, Dict[Union[None, int, str], UMRConfig.CoalesceRule]] = dict()
+        for rule in rules:
+            self.rules.setdefault(rule.To, dict()).setdefault(rule.ToChat, rule)
+        self.coalescers: Dict[GroupID, MessageCoalescer] = dict()
+        self.lock = Lock()  # drivers may dispatch from different threads
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def get_coalescer(self, platform: str, chat_id: Union[int, str], chat_type: ChatType) \
+            -> Optional[MessageCoalescer]:
+        """
+        :return: coalescer of the destination, None if the destination did not opt in
+        """
+        destination = GroupID(platform=platform, chat_id=chat_id, chat_type=chat_type)
+        coalescer = self.coalescers.get(destination)
+        if coalescer:
+            return coalescer
+
+        platform_rules = self.rules.get(platform)
+        if not platform_rules:
+            return None
+        rule = platform_rules.get(chat_id) or platform_rules.get(None)
+        if not rule:
+            return None
+
+        with self.lock:
+            coalescer = self.coalescers.get(destination)
+            if not coalescer:
+                coalescer = MessageCoalescer(destination, self.sender, rule.Window, rule.MaxMessages)
+                self.coalescers[destination] = coalescer
+        return coalescer
+
+    def stats(self) -> Dict[GroupID, Dict[str, int]]:
+        """
+        :return: received and sent message count of every destination, the difference is saved API calls
+        """
+        return {destination: {'received': coalescer.received, 'sent': coalescer.sent}
+                for destination, coalescer in list(self.coalescers.items())}
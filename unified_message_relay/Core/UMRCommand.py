@@ -1,9 +1,17 @@
-from typing import Dict, List, Union, Set
+from typing import Dict, List, Union, Set, Optional, Tuple, Callable
 from asyncio import iscoroutinefunction
+from bisect import bisect_left, insort
+from threading import Lock
+import math
+import time
 from . import UMRConfig
 from . import UMRLogging
 from .UMRType import UnifiedMessage, Command, ChatAttribute, MessageEntity, ChatType, Privilege, SendAction, EntityType
 from .UMRMessageHook import register_hook
+from .UMRBudget import call_with_budget
+from .UMRRateLimit import TokenBucket
+from .UMRWorkerPool import WorkerPool
+from .UMRMetrics import metrics
 from .UMRDriver import api_call
 from .UMRAdmin import is_bot_admin, is_group_admin, is_group_owner
 from ..Util.Helper import unparse_entities_to_markdown
@@ -11,7 +19,92 @@ from ..Util.Helper import unparse_entities_to_markdown
 logger = UMRLogging.get_logger('Command')
 
 command_map: Dict[str, Command] = dict()
+command_names: List[str] = list()  # sorted keys of command_map, for abbreviation lookup
 command_prefix: str = UMRConfig.config.CommandPrefix
+command_abbreviation: bool = UMRConfig.config.CommandAbbreviation
+
+BUCKETS_SIZE = 10000  # token buckets kept per command, all are dropped when full
+REJECTION_INTERVAL = 10  # seconds, a user gets at most one rejection reply in this time
+
+
+class CommandLimiter:
+    def __init__(self, user_rate: float, user_burst: int, chat_rate: float, chat_burst: int, max_concurrency: int):
+        """
+        Thread safe, limits of one command
+
+        :param user_rate: runs per second for each user, 0 for unlimited
+        :param user_burst: runs a user can save for burst
+        :param chat_rate: runs per second for each chat, 0 for unlimited
+        :param chat_burst: runs a chat can save for burst
+        :param max_concurrency: runs at the same time, 0 for unlimited
+        """
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_concurrency = max_concurrency
+        self.user_buckets: Dict[Tuple[str, str], TokenBucket] = dict()
+        self.chat_buckets: Dict[Tuple[str, str], TokenBucket] = dict()
+        self.running = 0
+        self.lock = Lock()
+
+    def _bucket(self, buckets: Dict[Tuple[str, str], TokenBucket], key: Tuple[str, str], rate: float,
+                burst: int) -> TokenBucket:
+        bucket = buckets.get(key)
+        if not bucket:
+            with self.lock:
+                if len(buckets) >= BUCKETS_SIZE:
+                    buckets.clear()
+                bucket = buckets.setdefault(key, TokenBucket(rate, burst))
+        return bucket
+
+    def acquire(self, chat_attrs: ChatAttribute) -> Tuple[str, float]:
+        """
+        take a run, release must be called when the run ends
+        tokens are only taken when both the user and the chat have one
+        :return: (rejection reason, seconds to retry), empty reason if the command may run
+        """
+        buckets = [self._bucket(buckets, key, rate, burst) for buckets, key, rate, burst in (
+            (self.user_buckets, (chat_attrs.platform, str(chat_attrs.user_id)), self.user_rate, self.user_burst),
+            (self.chat_buckets, (chat_attrs.platform, str(chat_attrs.chat_id)), self.chat_rate, self.chat_burst))
+            if rate]
+        with self.lock:  # buckets are only used under this lock, peek and take can not be interleaved
+            if self.max_concurrency and self.running >= self.max_concurrency:
+                return 'Command is busy, try again later', 0
+            delay = max([bucket.peek() for bucket in buckets], default=0)
+            if delay:
+                return f'Too many requests, try again in {math.ceil(delay)}s', delay
+            for bucket in buckets:
+                bucket.try_acquire()
+            self.running += 1
+        return '', 0
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+
+
+command_limiters: Dict[Callable, CommandLimiter] = dict()  # command function -> limits
+command_pool: Optional[WorkerPool] = None  # started by the first background command
+rejection_replies: Dict[Tuple[str, str], float] = dict()  # (platform, user id) -> time of next allowed reply
+rejection_lock = Lock()
+
+
+async def reject(chat_attrs: ChatAttribute, reason: str, retry_after: float = 0):
+    """
+    count a rejected command, reply at most once per REJECTION_INTERVAL or retry time to each user
+    so users over the limit do not cause an API call for every message
+    """
+    metrics.increase('command_rejected', chat_attrs.platform)
+    key = (chat_attrs.platform, str(chat_attrs.user_id))
+    now = time.monotonic()
+    with rejection_lock:
+        if rejection_replies.get(key, 0) > now:
+            return
+        if len(rejection_replies) >= BUCKETS_SIZE:
+            rejection_replies.clear()
+        rejection_replies[key] = now + max(REJECTION_INTERVAL, retry_after)
+    await quick_reply(chat_attrs, reason)
 
 
 async def unauthorized(chat_attrs: ChatAttribute, required_privilege: Privilege):
@@ -25,10 +118,10 @@ async def unauthorized(chat_attrs: ChatAttribute, required_privilege: Privilege)
     await quick_reply(chat_attrs, error_message)
 
 
-@register_hook()
+@register_hook(timeout=0)  # commands have their own budget
 async def command_dispatcher(message: UnifiedMessage):
-    # filter command
-    if len(message.text) == 0:  # command must have some texts
+    # filter command on raw text, most messages are not commands and never get rendered
+    if not message.text.startswith(command_prefix):
         return False
 
     msg = unparse_entities_to_markdown(message, EntityType.PLAIN)
@@ -38,71 +131,130 @@ async def command_dispatcher(message: UnifiedMessage):
 
     cmd, *args = msg.split(' ')
     cmd = cmd[len(command_prefix):]
-    logger.debug(f'dispatching command: "{cmd}" with args: "{" ".join(args)}"')
-    if cmd in command_map:
-        # check if platform matches
-        if command_map[cmd].platform:
-            base_platform = UMRConfig.config.Driver[message.chat_attrs.platform].Base
-            if base_platform not in command_map[cmd].platform:
-                return False
-
-        # filter chat_type
-        if command_map[cmd].chat_type:
-            if message.chat_attrs.chat_id > 0 and command_map[cmd].chat_type == ChatType.GROUP:
-                return False
-            if message.chat_attrs.chat_id < 0 and command_map[cmd].chat_type == ChatType.PRIVATE:
-                return False
-
-        # filter privilege
-        if command_map[cmd].privilege:
-            if command_map[cmd].privilege == Privilege.BOT_ADMIN:
-                if not await is_bot_admin(message.chat_attrs.platform, message.chat_attrs.user_id):
-                    await unauthorized(message.chat_attrs, command_map[cmd].privilege)
-                    return True
-            elif command_map[cmd].privilege == Privilege.GROUP_OWNER:
-                if not await is_bot_admin(message.chat_attrs.platform, message.chat_attrs.user_id) or \
-                        not await is_group_owner(platform=message.chat_attrs.platform,
-                                                 chat_id=message.chat_attrs.chat_id,
-                                                 chat_type=message.chat_attrs.chat_type,
-                                                 user_id=message.chat_attrs.user_id):
-                    await unauthorized(message.chat_attrs, command_map[cmd].privilege)
-                    return True
-            elif command_map[cmd].privilege == Privilege.GROUP_ADMIN:
-                if not await is_bot_admin(message.chat_attrs.platform, message.chat_attrs.user_id) or \
-                        not await is_group_admin(platform=message.chat_attrs.platform,
-                                                 chat_id=message.chat_attrs.chat_id,
-                                                 chat_type=message.chat_attrs.chat_type,
-                                                 user_id=message.chat_attrs.user_id):
-                    await unauthorized(message.chat_attrs, command_map[cmd].privilege)
-                    return True
-
-        await command_map[cmd].command_function(message.chat_attrs, args)
-        return True
-    else:
+    command = resolve_command(cmd)
+    if not command:
         return False
+    logger.debug(f'dispatching command: "{cmd}" with args: "{" ".join(args)}"')
+
+    # check if platform matches
+    if command.platform:
+        base_platform = UMRConfig.config.Driver[message.chat_attrs.platform].Base
+        if base_platform not in command.platform:
+            return False
+
+    # filter chat_type
+    if command.chat_type:
+        if message.chat_attrs.chat_id > 0 and command.chat_type == ChatType.GROUP:
+            return False
+        if message.chat_attrs.chat_id < 0 and command.chat_type == ChatType.PRIVATE:
+            return False
+
+    # filter privilege
+    if command.privilege:
+        if command.privilege == Privilege.BOT_ADMIN:
+            if not await is_bot_admin(message.chat_attrs.platform, message.chat_attrs.user_id):
+                await unauthorized(message.chat_attrs, command.privilege)
+                return True
+        elif command.privilege == Privilege.GROUP_OWNER:
+            if not await is_bot_admin(message.chat_attrs.platform, message.chat_attrs.user_id) or \
+                    not await is_group_owner(platform=message.chat_attrs.platform,
+                                             chat_id=message.chat_attrs.chat_id,
+                                             chat_type=message.chat_attrs.chat_type,
+                                             user_id=message.chat_attrs.user_id):
+                await unauthorized(message.chat_attrs, command.privilege)
+                return True
+        elif command.privilege == Privilege.GROUP_ADMIN:
+            if not await is_bot_admin(message.chat_attrs.platform, message.chat_attrs.user_id) or \
+                    not await is_group_admin(platform=message.chat_attrs.platform,
+                                             chat_id=message.chat_attrs.chat_id,
+                                             chat_type=message.chat_attrs.chat_type,
+                                             user_id=message.chat_attrs.user_id):
+                await unauthorized(message.chat_attrs, command.privilege)
+                return True
+
+    limiter = command_limiters.get(command.command_function)
+    if limiter:
+        rejection, retry_after = limiter.acquire(message.chat_attrs)
+        if rejection:
+            await reject(message.chat_attrs, rejection, retry_after)
+            return True
+
+    if not command.background:
+        await run_command(command, message.chat_attrs, args)
+    elif not command_pool.submit(run_command, command, message.chat_attrs, args):
+        if limiter:
+            limiter.release()
+        await reject(message.chat_attrs, 'Bot is busy, try again later')
+    return True
+
+
+async def run_command(command: Command, chat_attrs: ChatAttribute, args: List[str]):
+    timeout = command.timeout
+    if timeout is None:
+        timeout = UMRConfig.config.Dispatch.CommandTimeout
+    try:
+        await call_with_budget('command', command.command_function, timeout, chat_attrs, args)
+    finally:
+        limiter = command_limiters.get(command.command_function)
+        if limiter:
+            limiter.release()
+
+
+def resolve_command(cmd: str) -> Optional[Command]:
+    """
+    :param cmd: command keyword without prefix
+    :return: registered command, with CommandAbbreviation also the only command starting with cmd, None if not found
+    """
+    command = command_map.get(cmd)
+    if command or not cmd or not command_abbreviation:
+        return command
+    position = bisect_left(command_names, cmd)
+    while position < len(command_names) and command_names[position].startswith(cmd):
+        candidate = command_map[command_names[position]]
+        if command and candidate is not command:  # ambiguous, aliases of one command count once
+            return None
+        command = candidate
+        position += 1
+    return command
 
 
 def register_command(cmd: Union[str, List[str]] = '', description: str = '', platform: Union[str, List[str]] = '',
-                     chat_type=ChatType.UNSPECIFIED, privilege=''):
+                     chat_type=ChatType.UNSPECIFIED, privilege='', timeout: Optional[float] = None,
+                     background: bool = False, user_rate: float = 0, user_burst: int = 1, chat_rate: float = 0,
+                     chat_burst: int = 1, max_concurrency: int = 0):
     """
     register command
     :param cmd: command keyword, must not be null
     :param description: command description, will show in help command
     :param platform: platform name, if specified, only message from that platform will trigger this command
+    :param timeout: seconds before the command is cancelled, None for Dispatch.CommandTimeout, 0 for no limit
+    :param background: run on the command pool, dispatch does not wait for the command
+    :param user_rate: runs per second for each user, 0 for unlimited, runs over the limit get a rejection reply
+    :param user_burst: runs a user can save for burst
+    :param chat_rate: runs per second for each chat, 0 for unlimited
+    :param chat_burst: runs a chat can save for burst
+    :param max_concurrency: runs of this command at the same time, 0 for unlimited
     :return:
     """
 
     def deco(func):
+        global command_pool
+        _cmd = Command(platform=platform, description=description, chat_type=chat_type,
+                       privilege=privilege, command_function=func, timeout=timeout, background=background)
+        if user_rate or chat_rate or max_concurrency:
+            command_limiters[func] = CommandLimiter(user_rate, user_burst, chat_rate, chat_burst, max_concurrency)
+        if background and not command_pool:
+            pool_config = UMRConfig.config.Dispatch.CommandPool
+            command_pool = WorkerPool('Command', pool_config.Workers, pool_config.MaxPending)
         if isinstance(cmd, str):
             assert cmd not in command_map, f'Error, "{cmd}" has been registered'
-            command_map[cmd] = Command(platform=platform, description=description, chat_type=chat_type,
-                                       privilege=privilege, command_function=func)
+            command_map[cmd] = _cmd
+            insort(command_names, cmd)
         else:
-            _cmd = Command(platform=platform, description=description, chat_type=chat_type,
-                           privilege=privilege, command_function=func)
             for c in cmd:
                 assert c not in command_map, f'Error, "{c}" has been registered'
                 command_map[c] = _cmd
+                insort(command_names, c)
         return func
 
     return deco
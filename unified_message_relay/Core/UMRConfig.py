@@ -1,6 +1,6 @@
 import pathlib
 from . import UMRLogging
-from .UMRType import ChatType, ForwardTypeEnum, DefaultForwardTypeEnum, LogLevel
+from .UMRType import ChatType, ForwardTypeEnum, DefaultForwardTypeEnum, LogLevel, QueueOverflowPolicy
 from pydantic import BaseModel, validator
 from typing import Dict, List, Union, Type, Optional, Generic, AnyStr, DefaultDict
 from typing_extensions import Literal
@@ -33,8 +33,26 @@ def load_extensions():
             globals()[e] = importlib.import_module(e)
 
 
+class RateLimitConfig(BaseModel):
+    Rate: float = 0       # messages per second for the whole bot account, 0 for unlimited
+    Burst: int = 1
+    ChatRate: float = 0   # messages per second for each destination chat, 0 for unlimited
+    ChatBurst: int = 1
+
+
+class CircuitBreakerConfig(BaseModel):
+    FailureThreshold: int = 0  # consecutive failures or timeouts that open the circuit, 0 for disabled
+    Cooldown: float = 30       # seconds before a probe send is allowed
+
+
 class BaseDriverConfig(BaseModel):
     Base: str
+    RateLimit: RateLimitConfig = RateLimitConfig()
+    SendTimeout: float = 0     # seconds, 0 for no timeout
+    CircuitBreaker: CircuitBreakerConfig = CircuitBreakerConfig()
+    PrivilegeCacheTTL: float = 60  # seconds to cache group admin and owner checks, 0 for no cache
+    SyncWorkers: int = 4       # threads for blocking sync driver API methods
+    BlockingAPIs: List[str] = []  # sync API methods that block, run on SyncWorkers instead of the caller's thread
 
 
 class BaseExtensionConfig(BaseModel):
@@ -79,6 +97,79 @@ class ForwardList(BaseModel):
             return v
 
 
+class SendQueueConfig(BaseModel):
+    Enabled: bool = False
+    MaxSize: int = 100  # per destination chat
+    OverflowPolicy: QueueOverflowPolicy = QueueOverflowPolicy.BLOCK
+    Shards: int = 1        # dispatch threads with their own event loop, source chats are pinned to one shard
+
+
+class CoalesceRule(BaseModel):
+    To: str
+    ToChat: Optional[Union[int, str]]  # leave empty for every chat of the driver
+    Window: float = 0.5    # seconds to wait for the next message
+    MaxMessages: int = 10  # flush when this many messages are merged
+
+
+class JournalConfig(BaseModel):
+    Enabled: bool = False
+    Path: str = ''             # default: outbound.db under DataRoot
+    MaxAttempts: int = 5       # failed messages go to dead letter queue after this many attempts
+    RetryDelay: float = 2      # seconds before the first retry, doubled after each attempt
+    MaxRetryDelay: float = 300
+    FlushInterval: float = 0.5  # seconds between batched writes
+    BatchSize: int = 500
+
+
+class DedupConfig(BaseModel):
+    Enabled: bool = False
+    Capacity: int = 10000  # message keys in one generation, two generations are kept
+
+
+class MessageRelationConfig(BaseModel):
+    Capacity: int = 65536  # remembered message ids (received messages and sent copies), oldest are evicted first
+    Shards: int = 16           # independently locked parts, keys are spread by message key
+    Persistent: bool = False   # keep relations in SQLite, Capacity becomes the size of the in memory cache
+    Path: str = ''             # default: relation.db under DataRoot
+    TTL: float = 604800        # seconds before a relation is pruned from disk, 0 for never
+    FlushInterval: float = 1   # seconds between batched writes
+    BatchSize: int = 1000
+
+
+class ObserverConfig(BaseModel):
+    Workers: int = 4         # observers running at the same time
+    MaxPending: int = 1000   # queued observer calls, more are dropped, 0 for unbounded
+
+
+class IngressConfig(BaseModel):
+    Enabled: bool = False
+    MaxSize: int = 1000    # received messages waiting for dispatch, 0 for unbounded
+    BatchSize: int = 64    # messages taken from the queue at once
+    OverflowPolicy: QueueOverflowPolicy = QueueOverflowPolicy.BLOCK
+    Shards: int = 1        # dispatch threads with their own event loop, source chats are pinned to one shard
+
+
+class CommandPoolConfig(BaseModel):
+    Workers: int = 4         # background commands running at the same time
+    MaxPending: int = 100    # queued background commands, more are rejected, 0 for unbounded
+
+
+class DispatchConfig(BaseModel):
+    ConcurrentFanOut: bool = False  # send one message to all of its destinations in parallel
+    SendQueue: SendQueueConfig = SendQueueConfig()
+    Coalesce: List[CoalesceRule] = []  # merge bursts of text messages for these destinations
+    MediaWorkers: int = 0  # processes for media conversion, 0 for converting on the event loop
+    Journal: JournalConfig = JournalConfig()  # persist outbound messages, retry failed sends
+    Dedup: DedupConfig = DedupConfig()  # drop redelivered inbound messages
+    MaxHops: int = 3  # drop messages relayed more times than this, 0 for no limit
+    DropOwnMessages: bool = False  # drop messages whose sender is the bot account of the platform
+    Observers: ObserverConfig = ObserverConfig()  # background pool of observer hooks
+    HookTimeout: float = 0  # seconds before a message hook is cancelled, 0 for no limit
+    CommandTimeout: float = 0  # seconds before a command is cancelled, 0 for no limit
+    CommandPool: CommandPoolConfig = CommandPoolConfig()  # pool of commands registered with background=True
+    Ingress: IngressConfig = IngressConfig()  # one queue from all drivers to a single dispatch loop
+
+
 def construct_union(modules: List, names):
     eval_string = ', '.join([i.__module__ + '.' + i.__name__ for i in modules])
     if names:
@@ -93,11 +184,14 @@ class BasicConfig(BaseModel):
     DataRoot: str = '/root/coolq/data/image'
     LogRoot: str = '/var/log/umr'
     CommandPrefix: str = '!!'
+    CommandAbbreviation: bool = False  # unambiguous prefixes of commands also match
     Extensions: Optional[List[str]]
     BotAdmin: Optional[Dict[str, List[Union[int, str]]]]
     LogLevel: Optional[Dict[str, LogLevel]]
 
     ForwardList: ForwardList
+    Dispatch: DispatchConfig = DispatchConfig()
+    MessageRelation: MessageRelationConfig = MessageRelationConfig()
     Driver: Optional[Dict[str, BaseDriverConfig]]
 
     ExtensionConfig: Optional[Dict[str, BaseExtensionConfig]]
@@ -145,11 +239,14 @@ def reload_config():
         DataRoot: str = '/root/coolq/data/image'
         LogRoot: str = '/var/log/umr'
         CommandPrefix: str = '!!'
+        CommandAbbreviation: bool = False  # unambiguous prefixes of commands also match
         Extensions: Optional[List[str]]
         BotAdmin: Optional[Dict[str, List[Union[int, str]]]]
         LogLevel: Optional[Dict[str, LogLevel]]
 
         ForwardList: ForwardList
+        Dispatch: DispatchConfig = DispatchConfig()
+        MessageRelation: MessageRelationConfig = MessageRelationConfig()
         Driver: Optional[Dict[str, construct_union(driver_config, BaseDriverConfig)]]
 
         ExtensionConfig: Optional[Dict[str, construct_union(extension_config, BaseExtensionConfig)]]
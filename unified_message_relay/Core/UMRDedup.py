@@ -0,0 +1,77 @@
+from typing import Set, Dict
+from threading import Lock
+from .UMRType import UnifiedMessage
+from .UMRMetrics import metrics
+from . import UMRLogging
+
+"""
+Inbound deduplication
+
+Webhook based drivers may redeliver the same event after reconnect. Every received message is keyed by its source
+MessageID and a hash of its content (drivers split one platform message into several UnifiedMessages sharing the same
+message id), repeats are dropped before dispatch.
+
+Keys are kept as hashes in two generations of sets, when the current generation is full it replaces the previous one,
+so memory is bounded to two generations and every key is remembered for at least one generation.
+"""
+
+logger = UMRLogging.get_logger('Dedup')
+
+
+def message_key(message: UnifiedMessage) -> int:
+    """
+    :return: hash of source message id and content
+    """
+    chat_attrs = message.chat_attrs
+    reply_to = chat_attrs.reply_to.message_id if chat_attrs.reply_to else 0
+    return hash((chat_attrs.platform, chat_attrs.chat_type, chat_attrs.chat_id, chat_attrs.message_id,
+                 message.text, message.image, message.file_id, reply_to))
+
+
+class MessageDeduplicator:
+    def __init__(self, capacity: int):
+        """
+        :param capacity: keys in one generation, 0 for disabled
+        """
+        self.capacity = capacity
+        self.current: Set[int] = set()
+        self.previous: Set[int] = set()
+        self.lock = Lock()
+
+        # statistics
+        self.hits: Dict[str, int] = dict()  # platform -> dropped duplicates
+
+    def is_duplicate(self, message: UnifiedMessage) -> bool:
+        """
+        remember message and check if it was seen before, messages without message id are never duplicates
+        :param message: received message
+        :return: True if message should be dropped
+        """
+        if not self.capacity or not message.chat_attrs.message_id:
+            return False
+        key = message_key(message)
+        with self.lock:
+            if key in self.current:
+                duplicate = True
+            elif key in self.previous:
+                duplicate = True
+                self.current.add(key)  # keep recent repeats alive across rotation
+            else:
+                duplicate = False
+                self.current.add(key)
+            if len(self.current) >= self.capacity:
+                self.previous = self.current
+                self.current = set()
+            if duplicate:
+                platform = message.chat_attrs.platform
+                self.hits[platform] = self.hits.get(platform, 0) + 1
+        if duplicate:
+            metrics.increase('duplicates_dropped', message.chat_attrs.platform)
+        return duplicate
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: dropped duplicates of every source platform
+        """
+        return dict(self.hits)
+
@@ -1,15 +1,26 @@
-from typing import Union, List, DefaultDict, Tuple, Any, Union, Dict
+from typing import Union, List, Tuple, Sequence
+from copy import copy
 import asyncio
-from collections import defaultdict
-from .UMRType import UnifiedMessage, ForwardAction, ForwardActionType, DefaultForwardAction,\
-    DefaultForwardActionType, SendAction, ChatType, GroupID,\
-    DestinationMessageID, ForwardTypeEnum, DefaultForwardTypeEnum
+from .UMRType import UnifiedMessage, UnifiedMessageView, ForwardAction, ForwardActionType, DefaultForwardAction,\
+    DefaultForwardActionType, SendAction, ChatType, GroupID, DestinationMessageID
 from . import UMRLogging
 from . import UMRDriver
+from . import UMRConfig
 from .UMRConfig import config
-from .UMRMessageRelation import get_message_id
+from .UMRMessageRelation import fetch_message_id
 from .UMRMessageHook import dispatch_hook
 from .UMRFile import get_image
+from .UMRSendQueue import SendQueues
+from .UMRRouting import RoutingTable
+from .UMRRateLimit import RateLimiter
+from .UMRCoalesce import Coalescers
+from .UMRMetrics import metrics
+from .UMRIngress import IngressQueue
+from .UMRJournal import OutboundJournal
+from .UMRCircuitBreaker import CircuitBreakers, CircuitOpenError
+from .UMRDedup import MessageDeduplicator
+from .UMRLoop import LoopGuard, analyze_forward_list
+import os
 
 """
 
@@ -38,78 +49,49 @@ class UMRDispatcher:
         # bot accounts for each platform
         self.bot_accounts = config.ForwardList.Accounts
 
-        # forward graph
-
-        self.action_graph: DefaultDict[GroupID, List[ForwardAction]] = defaultdict(lambda: list())  # action graph
-
-        self.default_action_graph: DefaultDict[str, Dict[GroupID, DefaultForwardAction]] = defaultdict(
-            lambda: dict())  # default action graph
-
-        # initialize action_graph
-        for i in config.ForwardList.Topology:
-
-            # Add action
-            # BiDirection = two ALL
-            # OneWay      = one All
-            # OneWay+     = one All + one Reply
-
-            # ForwardType.All: From one platform to another, forward all message
-            # ForwardType.Reply: From one platform to another, forward only replied message
-
-            # init forward graph and workers
-            if i.ForwardType == ForwardTypeEnum.BiDirection:
-                forward_action_type = ForwardActionType.ForwardAll
-                backward_action_type = ForwardActionType.ForwardAll
-            elif i.ForwardType == ForwardTypeEnum.OneWayPlus:
-                forward_action_type = ForwardActionType.ForwardAll
-                backward_action_type = ForwardActionType.ReplyOnly
-            elif i.ForwardType == ForwardTypeEnum.OneWay:
-                forward_action_type = ForwardActionType.ForwardAll
-                backward_action_type = ForwardActionType.Block
-            else:
-                self.logger.warning(f'Unrecognized ForwardType in config: "{i.ForwardType}", ignoring')
-                continue
-            self.action_graph[GroupID(platform=i.From,
-                                      chat_id=i.FromChat,
-                                      chat_type=i.FromChatType)].append(
-                ForwardAction(to_platform=i.To,
-                              to_chat=i.ToChat,
-                              chat_type=i.ToChatType,
-                              action_type=forward_action_type))
-            self.action_graph[
-                GroupID(platform=i.To,
-                        chat_id=i.ToChat,
-                        chat_type=i.ToChatType)].append(
-                ForwardAction(to_platform=i.From,
-                              to_chat=i.FromChat,
-                              chat_type=i.FromChatType,
-                              action_type=backward_action_type))
-
-        # initialize default_action_graph
-        for i in config.ForwardList.Default:
-
-            # Add action
-            # OneWay      = one All
-            # OneWay+     = one All + one Reply
-
-            # ForwardType.All: From one platform to another, forward all message, accept reply backward
-            # ForwardType.Reply: From one platform to another, forward all message, reject reply backward
-
-            if i.ForwardType == DefaultForwardTypeEnum.OneWayPlus:
-                action_type = DefaultForwardActionType.OneWayWithReply
-            elif i.ForwardType == DefaultForwardTypeEnum.OneWay:
-                action_type = DefaultForwardActionType.OneWay
-            else:
-                self.logger.warning(f'Unrecognized ForwardType in config: "{i.ForwardType}", ignoring')
-                continue
-            self.default_action_graph[i.From][
-                GroupID(platform=i.To,
-                        chat_id=i.ToChat,
-                        chat_type=i.ToChatType)] = \
-                DefaultForwardAction(to_platform=i.To,
-                                     to_chat=i.ToChat,
-                                     chat_type=i.ToChatType,
-                                     action_type=action_type)
+        # send to all destinations of one message in parallel
+        self.concurrent_fan_out = config.Dispatch.ConcurrentFanOut
+
+        # per destination outbound queues
+        self.send_queues: Union[None, SendQueues] = None
+        if config.Dispatch.SendQueue.Enabled:
+            self.send_queues = SendQueues(self.deliver,
+                                          max_size=config.Dispatch.SendQueue.MaxSize,
+                                          overflow_policy=config.Dispatch.SendQueue.OverflowPolicy,
+                                          discard=self.discard)
+
+        # send timeouts and fail fast for broken drivers
+        self.circuit_breakers = CircuitBreakers()
+
+        # persist outbound messages and retry failed sends
+        self.journal: Union[None, OutboundJournal] = None
+        if config.Dispatch.Journal.Enabled:
+            journal_config = config.Dispatch.Journal
+            self.journal = OutboundJournal(journal_config.Path or os.path.join(config.DataRoot, 'outbound.db'),
+                                           self.resend, self.driver_ready,
+                                           max_attempts=journal_config.MaxAttempts,
+                                           retry_delay=journal_config.RetryDelay,
+                                           max_retry_delay=journal_config.MaxRetryDelay,
+                                           flush_interval=journal_config.FlushInterval,
+                                           batch_size=journal_config.BatchSize,
+                                           loop_of=UMRDriver.driver_loop)
+
+        # merge bursts of text messages for opted in destinations
+        self.coalescers = Coalescers(self.enqueue, config.Dispatch.Coalesce)
+
+        # drop redelivered inbound messages
+        self.deduplicator = MessageDeduplicator(config.Dispatch.Dedup.Capacity if config.Dispatch.Dedup.Enabled else 0)
+
+        # drop messages relayed back by the bot itself or by another relay
+        self.loop_guard = LoopGuard(config.ForwardList.Accounts, config.Dispatch.MaxHops,
+                                    config.Dispatch.DropOwnMessages)
+
+        # token buckets per destination driver and chat
+        self.rate_limiter = RateLimiter()
+
+        # compiled forward graph
+        self.routing_table = RoutingTable(config.ForwardList)
+        analyze_forward_list(config.ForwardList)
 
     async def send(self, message: UnifiedMessage, platform: str, chat_id: Union[int, str], chat_type: ChatType):
         """
@@ -120,36 +102,196 @@ class UMRDispatcher:
         :param chat_id: dst chat id
         :param chat_type: dst type
         """
-        if await dispatch_hook(message,
-                               dst_driver=platform,
-                               dst_chat=chat_id,
-                               dst_chat_type=chat_type):
+        destination = GroupID(platform=platform, chat_id=chat_id, chat_type=chat_type)
+        if destination in message.path:
+            metrics.increase('loop_destination_skipped', platform)
+            self.logger.debug(f'Message already passed ({platform}, {chat_id}, {chat_type}), skipping')
+            return
+        if not isinstance(message, UnifiedMessageView):
+            message = UnifiedMessageView(message)
+        message.path = message.path + (destination,)
+        message.hops = message.hops + 1
+
+        with metrics.timer('destination_hook', platform):
+            handled = await dispatch_hook(message,
+                                          dst_driver=platform,
+                                          dst_chat=chat_id,
+                                          dst_chat_type=chat_type)
+        if handled:
             self.logger.debug(f'Message to ({platform}, {chat_id}, {chat_type}) is handled by hook')
             return
-        if message.image.startswith('http'):
-            message.image = await get_image(message.image, message.file_id)
-        await UMRDriver.api_call(platform, 'send', chat_id, chat_type, message)
+        if message.image.startswith('http'):  # image replaced by hook
+            with metrics.timer('media', platform):
+                image = await get_image(message.image, message.file_id)
+            message = UnifiedMessageView(message, image=image)
+        coalescer = self.coalescers and self.coalescers.get_coalescer(platform, chat_id, chat_type)
+        if coalescer:
+            await coalescer.submit(message)
+        else:
+            await self.enqueue(message, platform, chat_id, chat_type)
+
+    async def enqueue(self, message: UnifiedMessage, platform: str, chat_id: Union[int, str], chat_type: ChatType):
+        """
+        Internal function: put message into the queue of destination, or deliver directly if queue is disabled
+
+        :param message: UnifiedMessage
+        :param platform: dst platform
+        :param chat_id: dst chat id
+        :param chat_type: dst type
+        """
+        journal_id = 0
+        if self.journal:
+            journal_id = self.journal.record(message, platform, chat_id, chat_type)
+        if self.send_queues:
+            await self.send_queues.put(message, platform, chat_id, chat_type, journal_id=journal_id)
+            self.logger.debug(f'Message to ({platform}, {chat_id}, {chat_type}) is queued')
+        else:
+            await self.deliver(message, platform, chat_id, chat_type, journal_id=journal_id)
+
+    async def resend(self, message: UnifiedMessage, platform: str, chat_id: Union[int, str], chat_type: ChatType,
+                     journal_id: int = 0):
+        """
+        Internal function: retry of a journaled message, goes through the destination queue to keep the order
+
+        :param message: UnifiedMessage
+        :param platform: dst platform
+        :param chat_id: dst chat id
+        :param chat_type: dst type
+        :param journal_id: id in outbound journal
+        """
+        if self.send_queues:
+            await self.send_queues.put(message, platform, chat_id, chat_type, journal_id=journal_id)
+        else:
+            await self.deliver(message, platform, chat_id, chat_type, journal_id=journal_id)
+
+    def discard(self, journal_id: int):
+        """
+        Internal function: journaled message is dropped by queue overflow policy
+        """
+        if self.journal:
+            self.journal.discard(journal_id)
+
+    async def deliver(self, message: UnifiedMessage, platform: str, chat_id: Union[int, str], chat_type: ChatType,
+                      journal_id: int = 0):
+        """
+        Internal function: hand message to destination driver
+
+        :param message: UnifiedMessage
+        :param platform: dst platform
+        :param chat_id: dst chat id
+        :param chat_type: dst type
+        :param journal_id: id in outbound journal, failures are retried by journal instead of raised
+        """
+        with metrics.timer('rate_limit', platform):
+            await self.rate_limiter.acquire(platform, chat_id, chat_type)
+        try:
+            with metrics.timer('send', platform):
+                await self.circuit_breakers.call(platform, UMRDriver.api_call, platform, 'send', chat_id, chat_type,
+                                                 message)
+        except CircuitOpenError as e:
+            metrics.increase('send_rejected', platform)
+            if journal_id:  # park until the circuit may close
+                self.journal.postpone(journal_id, e.retry_after)
+                return
+            raise
+        except Exception as e:
+            metrics.increase('send_errors', platform)
+            if journal_id:
+                self.journal.fail(journal_id, e)
+                return
+            raise
+        if journal_id:
+            self.journal.complete(journal_id)
+        metrics.increase('messages_sent', platform)
         self.logger.debug(f'Message to ({platform}, {chat_id}, {chat_type}) is assigned to driver')
 
+    def driver_ready(self, platform: str) -> bool:
+        """
+        :return: True if the driver of platform is registered, started and its circuit is not open
+        """
+        driver = UMRDriver.driver_lookup_table.get(platform)
+        return bool(driver and driver.started and self.circuit_breakers.ready(platform))
+
+    async def resolve_media(self, message: UnifiedMessage):
+        """
+        Internal function: download remote media once per inbound message, before it is sent to any destination
+
+        :param message: UnifiedMessage
+        """
+        if message.image.startswith('http'):
+            with metrics.timer('media', message.chat_attrs.platform):
+                message.image = await get_image(message.image, message.file_id)
+
+    @staticmethod
+    def reply_view(message: UnifiedMessage, reply_message_id: DestinationMessageID) -> UnifiedMessageView:
+        """
+        Internal function: view of a reply message that replies to the original message in the destination chat
+
+        :param message: UnifiedMessage
+        :param reply_message_id: relation of the replied message
+        :return: UnifiedMessageView
+        """
+        chat_attrs = copy(message.chat_attrs)
+        chat_attrs.reply_to = None
+        return UnifiedMessageView(message,
+                                  chat_attrs=chat_attrs,
+                                  send_action=SendAction(message_id=reply_message_id.source.message_id,
+                                                         user_id=reply_message_id.source.user_id))
+
+    async def fan_out(self, message: UnifiedMessage, actions: Sequence[Union[ForwardAction, DefaultForwardAction]]) \
+            -> List[Tuple[GroupID, BaseException]]:
+        """
+        Internal function: send one message to every destination
+
+        In concurrent mode all destinations are sent in parallel, the call returns after every send is finished,
+        so the next message from the same source will not overtake this one in any destination chat.
+        A failed destination does not cancel the others.
+        Every destination gets its own view of the message, changes made by destination hooks do not leak.
+
+        :param message: UnifiedMessage
+        :param actions: forward actions of all destinations
+        :return: list of (destination, exception) for failed sends
+        """
+        failures: List[Tuple[GroupID, BaseException]] = list()
+
+        if self.concurrent_fan_out and len(actions) > 1:
+            results = await asyncio.gather(*[self.send(UnifiedMessageView(message),
+                                                       action.to_platform, action.to_chat, action.chat_type)
+                                             for action in actions],
+                                           return_exceptions=True)
+        else:
+            results = list()
+            for action in actions:
+                try:
+                    results.append(await self.send(UnifiedMessageView(message),
+                                                   action.to_platform, action.to_chat, action.chat_type))
+                except Exception as e:
+                    results.append(e)
+
+        for action, result in zip(actions, results):
+            if isinstance(result, BaseException):
+                failures.append((GroupID(platform=action.to_platform, chat_id=action.to_chat,
+                                         chat_type=action.chat_type), result))
+                self.logger.error(f'Failed to send message to ({action.to_platform}, {action.to_chat}, '
+                                  f'{action.chat_type})', exc_info=(type(result), result, result.__traceback__))
+
+        return failures
+
     async def dispatch_normal_reply(self, message: UnifiedMessage, reply_message_id: DestinationMessageID):
         # normal one way forward, ignore
-        normal_action = self.action_graph[GroupID(platform=message.chat_attrs.platform,
-                                                  chat_id=message.chat_attrs.chat_id,
-                                                  chat_type=message.chat_attrs.chat_type)]
-        for action in normal_action:  # ignore if defined, else treat as OneWay+
-            if action.to_platform == reply_message_id.source.platform and action.to_chat == reply_message_id.source.chat_id:
-                if action.action_type == ForwardActionType.Block:
-                    return True
-                break
-        else:
+        action_type = self.routing_table.route(message.chat_attrs.platform,
+                                               message.chat_attrs.chat_id,
+                                               message.chat_attrs.chat_type).reply_action(
+            reply_message_id.source.platform, reply_message_id.source.chat_id)
+        if not action_type:
             return False
+        if action_type == ForwardActionType.Block:
+            return True
 
         # if it has any action, then forward
 
-        message.chat_attrs.reply_to = None
-        message.send_action = SendAction(message_id=reply_message_id.source.message_id,
-                                         user_id=reply_message_id.source.user_id)
-        await self.send(message,
+        await self.resolve_media(message)
+        await self.send(self.reply_view(message, reply_message_id),
                         reply_message_id.source.platform,
                         reply_message_id.source.chat_id,
                         reply_message_id.source.chat_type)
@@ -158,9 +300,10 @@ class UMRDispatcher:
 
     async def dispatch_default_reply(self, message: UnifiedMessage, reply_message_id: DestinationMessageID):
         # default one way forward, block
-        default_action = self.default_action_graph[reply_message_id.source.platform].get(
-            GroupID(platform=message.chat_attrs.platform, chat_id=message.chat_attrs.chat_id,
-                    chat_type=message.chat_attrs.chat_type))
+        default_action = self.routing_table.default_action(reply_message_id.source.platform,
+                                                           message.chat_attrs.platform,
+                                                           message.chat_attrs.chat_id,
+                                                           message.chat_attrs.chat_type)
         if not default_action:
             return False
 
@@ -169,10 +312,8 @@ class UMRDispatcher:
 
         # OneWayWithReply
 
-        message.chat_attrs.reply_to = None
-        message.send_action = SendAction(message_id=reply_message_id.source.message_id,
-                                         user_id=reply_message_id.source.user_id)
-        await self.send(message,
+        await self.resolve_media(message)
+        await self.send(self.reply_view(message, reply_message_id),
                         reply_message_id.source.platform,
                         reply_message_id.source.chat_id,
                         reply_message_id.source.chat_type)
@@ -194,13 +335,14 @@ class UMRDispatcher:
         if message.chat_attrs.reply_to.user_id != self.bot_accounts.get(message.chat_attrs.platform):
             return False
 
-        reply_message_id = get_message_id(src_platform=message.chat_attrs.platform,
-                                          src_chat_id=message.chat_attrs.chat_id,
-                                          src_chat_type=message.chat_attrs.chat_type,
-                                          src_message_id=message.chat_attrs.reply_to.message_id,
-                                          dst_platform=message.chat_attrs.platform,
-                                          dst_chat_id=message.chat_attrs.chat_id,
-                                          dst_chat_type=message.chat_attrs.chat_type)
+        with metrics.timer('reply_lookup', message.chat_attrs.platform):
+            reply_message_id = await fetch_message_id(src_platform=message.chat_attrs.platform,
+                                                      src_chat_id=message.chat_attrs.chat_id,
+                                                      src_chat_type=message.chat_attrs.chat_type,
+                                                      src_message_id=message.chat_attrs.reply_to.message_id,
+                                                      dst_platform=message.chat_attrs.platform,
+                                                      dst_chat_id=message.chat_attrs.chat_id,
+                                                      dst_chat_type=message.chat_attrs.chat_type)
 
         # filter no source message (e.g. bot command)
         if not reply_message_id or not reply_message_id.source:
@@ -220,31 +362,42 @@ class UMRDispatcher:
         return False
 
     async def dispatch_default(self, message: UnifiedMessage):
-        if not self.default_action_graph[message.chat_attrs.platform]:
+        actions = self.routing_table.default_actions(message.chat_attrs.platform)
+        if not actions:
             return False
 
-        for _, action in self.default_action_graph[message.chat_attrs.platform].items():
-            await self.send(message, action.to_platform, action.to_chat, action.chat_type)
+        await self.resolve_media(message)
+        await self.fan_out(message, actions)
 
         return True
 
     async def dispatch_normal(self, message: UnifiedMessage):
-        actions = self.action_graph[GroupID(platform=message.chat_attrs.platform,
-                                            chat_id=message.chat_attrs.chat_id,
-                                            chat_type=message.chat_attrs.chat_type)]
-        if not actions:
+        route = self.routing_table.route(message.chat_attrs.platform,
+                                         message.chat_attrs.chat_id,
+                                         message.chat_attrs.chat_type)
+        if not route:
             return False
 
-        for action in actions:
-            if action.action_type != ForwardActionType.ForwardAll:  # reply is handled in another logic
-                continue
-
-            await self.send(message, action.to_platform, action.to_chat, action.chat_type)
+        # reply is handled in another logic
+        if route.forward_all:
+            await self.resolve_media(message)
+            await self.fan_out(message, route.forward_all)
 
         return True
 
     async def dispatch(self, message: UnifiedMessage):
-        if await dispatch_hook(message):
+        metrics.increase('messages_received', message.chat_attrs.platform)
+        source = GroupID(platform=message.chat_attrs.platform, chat_id=message.chat_attrs.chat_id,
+                         chat_type=message.chat_attrs.chat_type)
+        if not message.path or message.path[-1] != source:  # path set by driver ends before the receiving chat
+            message.path = message.path + (source,)
+        with metrics.timer('dispatch', message.chat_attrs.platform):
+            await self._dispatch(message)
+
+    async def _dispatch(self, message: UnifiedMessage):
+        with metrics.timer('hook', message.chat_attrs.platform):
+            handled = await dispatch_hook(message)
+        if handled:
             return
 
         # check reply
@@ -260,10 +413,14 @@ class UMRDispatcher:
             return
 
     def reload(self):
-        pass
+        self.routing_table = RoutingTable(UMRConfig.config.ForwardList)
+        analyze_forward_list(UMRConfig.config.ForwardList)
+        self.loop_guard = LoopGuard(UMRConfig.config.ForwardList.Accounts, UMRConfig.config.Dispatch.MaxHops,
+                                    UMRConfig.config.Dispatch.DropOwnMessages)
 
 
 dispatcher: UMRDispatcher
+ingress: Union[None, IngressQueue] = None
 
 
 async def dispatch(message: UnifiedMessage):
@@ -272,12 +429,45 @@ async def dispatch(message: UnifiedMessage):
     :param message:
     :return:
     """
+    if ingress:
+        await ingress.put(message)
+    else:
+        await dispatch_message(message)
+
+
+async def dispatch_message(message: UnifiedMessage):
+    """
+    dispatch on the dispatcher, messages in ingress queue end up here
+    :param message:
+    """
     if not dispatcher:
         pass
 
     await dispatcher.dispatch(message)
 
 
+def is_duplicate(message: UnifiedMessage) -> bool:
+    """
+    check if message is a redelivery of a received message
+    :param message: received message
+    :return: True if message should be dropped
+    """
+    return dispatcher.deduplicator.is_duplicate(message)
+
+
+def is_loop(message: UnifiedMessage) -> bool:
+    """
+    check if message is relayed in a loop, see LoopGuard
+    :param message: received message
+    :return: True if message should be dropped
+    """
+    return dispatcher.loop_guard.is_loop(message)
+
+
 def init_dispatcher():
-    global dispatcher
+    global dispatcher, ingress
     dispatcher = UMRDispatcher()
+    ingress_config = config.Dispatch.Ingress
+    if ingress_config.Enabled:
+        ingress = IngressQueue(dispatch_message, ingress_config.MaxSize, ingress_config.BatchSize,
+                               ingress_config.OverflowPolicy, ingress_config.Shards)
@@ -1,12 +1,16 @@
-from typing import Dict, List, Union, Any
-from threading import Thread
+from typing import Dict, List, Union, Any, Callable, Tuple, Optional, Iterable
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from .UMRType import UnifiedMessage, ChatType
+from .UMRMetrics import metrics
 from . import UMRLogging
 from . import UMRConfig
 from asyncio import iscoroutinefunction
 from . import UMRDispatcher
 import asyncio
+import functools
 import importlib
+import inspect
 
 logger = UMRLogging.get_logger('Driver')
 
@@ -53,11 +57,81 @@ class BaseDriverMixin:
         this function should not be override
         :param message: unified message to dispatch
         """
+        if UMRDispatcher.is_duplicate(message):
+            logger.debug(f'Dropped duplicate message {message.chat_attrs.message_id} '
+                         f'from ({message.chat_attrs.platform}, {message.chat_attrs.chat_id})')
+            return
+        if UMRDispatcher.is_loop(message):
+            return
         await UMRDispatcher.dispatch(message)
 
 
+def blocking(function: Callable) -> Callable:
+    """
+    decorator for sync driver API methods that block, they run on a thread pool of the driver
+    """
+    function.blocking = True
+    return function
+
+
+class DriverAPI:
+    def __init__(self, name: str, driver: BaseDriverMixin, sync_workers: int, blocking_apis: Iterable[str] = ()):
+        """
+        API table of one driver, public methods are resolved to bound methods once.
+        Coroutine and sync methods run on the caller's thread, so they may use the caller's event loop.
+        Sync methods marked with @blocking or listed in blocking_apis run on a thread pool of the driver instead.
+
+        :param name: the name in ForwardList
+        :param driver: driver instance
+        :param sync_workers: threads for blocking methods, the pool is created by the first blocking call
+        :param blocking_apis: names of sync methods that block
+        """
+        self.name = name
+        self.driver = driver
+        self.sync_workers = max(sync_workers, 1)
+        self.blocking_apis = frozenset(blocking_apis)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.lock = Lock()
+        # api name -> (bound method, is coroutine, is blocking)
+        self.functions: Dict[str, Tuple[Callable, bool, bool]] = dict()
+        for api_name, _ in inspect.getmembers(type(driver), inspect.isfunction):
+            if not api_name.startswith('_'):
+                self._add(api_name)
+
+    def _add(self, api_name: str) -> Optional[Tuple[Callable, bool, bool]]:
+        function = getattr(self.driver, api_name, None)
+        if not callable(function):
+            return None
+        is_coroutine = iscoroutinefunction(function)
+        is_blocking = not is_coroutine and (api_name in self.blocking_apis or getattr(function, 'blocking', False))
+        entry = (function, is_coroutine, is_blocking)
+        self.functions[api_name] = entry
+        return entry
+
+    async def call(self, api_name: str, *args, **kwargs):
+        entry = self.functions.get(api_name)
+        if not entry:
+            entry = self._add(api_name)  # set on instance after registration
+            if not entry:
+                logger.error(f'Driver "{self.name}" has no API "{api_name}"')
+                return None
+        function, is_coroutine, is_blocking = entry
+        with metrics.timer(f'api_{api_name}', self.name):
+            if is_coroutine:
+                return await function(*args, **kwargs)
+            if not is_blocking:
+                return function(*args, **kwargs)
+            if not self.executor:
+                with self.lock:
+                    if not self.executor:
+                        self.executor = ThreadPoolExecutor(self.sync_workers, thread_name_prefix=f'Driver-{self.name}')
+            return await asyncio.get_event_loop().run_in_executor(self.executor,
+                                                                  functools.partial(function, *args, **kwargs))
+
+
 driver_class_lookup_table: Dict[str, Any] = dict()  # driver prototypes
 driver_lookup_table: Dict[str, BaseDriverMixin] = dict()  # driver instances
+driver_api_table: Dict[str, DriverAPI] = dict()  # API tables of driver instances
 threads: List[Thread] = list()  # all threads that drivers created
 
 
@@ -69,6 +143,20 @@ def register_driver(name: str, driver_prototype):
     """
     driver_class_lookup_table[name] = driver_prototype
 
+
+def add_driver(name: str, driver: BaseDriverMixin):
+    """
+    register a driver instance and build its API table
+    :param name: the name in ForwardList
+    :param driver: driver instance
+    """
+    driver_config = UMRConfig.config.Driver.get(name)
+    driver_lookup_table[name] = driver
+    if driver_config:
+        driver_api_table[name] = DriverAPI(name, driver, driver_config.SyncWorkers, driver_config.BlockingAPIs)
+    else:
+        driver_api_table[name] = DriverAPI(name, driver, 1)
+
 # endregion
 
 
@@ -86,6 +174,15 @@ def driver_lookup(platform: str) -> Union[None, BaseDriverMixin]:
         return driver_lookup_table[platform]
 
 
+def driver_loop(platform: str) -> Optional[asyncio.AbstractEventLoop]:
+    """
+    :param platform: platform name (from config)
+    :return: event loop the driver runs on (its loop attribute), None if the driver has none
+    """
+    loop = getattr(driver_lookup_table.get(platform), 'loop', None)
+    return loop if isinstance(loop, asyncio.AbstractEventLoop) else None
+
+
 async def api_call(platform: str, api_name: str, *args, **kwargs):
     """
     fast api call
@@ -96,19 +193,16 @@ async def api_call(platform: str, api_name: str, *args, **kwargs):
     :return: None for API not found, api result for successful calling
     api result can be any or asyncio.Future, for Future type use result.result() to get the actual result
     """
-    driver = driver_lookup(platform)
-    if not driver:
-        logger.error(f'Due to driver "{platform}" not found, "{api_name}" is ignored')
-        return
+    driver_api = driver_api_table.get(platform)
+    if not driver_api:
+        driver = driver_lookup_table.get(platform)
+        if not driver:
+            logger.error(f'Due to driver "{platform}" not found, "{api_name}" is ignored')
+            return
+        add_driver(platform, driver)  # put in driver_lookup_table directly
+        driver_api = driver_api_table[platform]
 
-    func = getattr(driver, api_name)
-    if not func:
-        return
-
-    if iscoroutinefunction(func):
-        return await func(*args, **kwargs)
-    else:
-        return func(*args, **kwargs)
+    return await driver_api.call(api_name, *args, **kwargs)
 
 # endregion
 
@@ -138,7 +232,7 @@ async def init_drivers():
             exit(-1)
         driver: BaseDriverMixin = driver_class_lookup_table[driver_config.Base](driver_name)
         driver.start()
-        driver_lookup_table[driver_name] = driver
+        add_driver(driver_name, driver)
 
     loop = asyncio.get_event_loop()
 
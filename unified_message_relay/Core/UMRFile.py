@@ -1,4 +1,7 @@
-from typing import Dict
+from typing import Dict, Union
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock
+import asyncio
 import aiohttp
 from . import UMRConfig
 from PIL import Image
@@ -17,6 +20,14 @@ download_dir = UMRConfig.config.DataRoot
 
 cache: Dict[str, str] = dict()  # Dict[url, file_name]
 
+# downloads in progress, shared by every caller from any thread or event loop
+in_flight: Dict[str, Future] = dict()  # Dict[url, Future[file_name]]
+in_flight_lock = Lock()
+
+# process pool for media conversion, created on first use if Dispatch.MediaWorkers is set
+media_executor: Union[None, ProcessPoolExecutor] = None
+media_executor_lock = Lock()
+
 logger = UMRLogging.get_logger('FileDL')
 
 # By default, a image downgrading mapping is hardcoded here
@@ -54,18 +65,42 @@ async def get_image(url, file_id='', target_format=''):
     :param target_format: override the default target_format
     :return:
     """
+    key = file_id or url
+    if key in cache:
+        logger.debug(f'{key} found in cache')
+        return cache[key]
+
+    # concurrent requests for the same file wait for the first download
+    with in_flight_lock:
+        future = in_flight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            in_flight[key] = future
+
+    if not is_owner:
+        logger.debug(f'{key} is being downloaded, waiting...')
+        return await asyncio.wrap_future(future)
+
+    file_full_path = ''
+    try:
+        logger.debug(f'{key} not found in cache, downloading...')
+        file_full_path = await download_image(url, file_id)
+        return file_full_path
+    finally:
+        with in_flight_lock:
+            del in_flight[key]
+        future.set_result(file_full_path)
+
+
+async def download_image(url, file_id=''):
+    """
+    download and convert image, result will be cached
+    :param url: file url
+    :param file_id: unique file id, will replace cache index if specified
+    :return: full path of the converted file, empty string if failed
+    """
     try:
-        if file_id:
-            if file_id in cache:
-                logger.debug(f'{file_id} found in cache')
-                return cache[file_id]
-            else:
-                logger.debug(f'{file_id} not found in cache, downloading...')
-        elif url in cache:
-            logger.debug(f'{url} found in cache')
-            return cache[url]
-        else:
-            logger.debug(f'{url} not found in cache, downloading...')
         async with aiohttp.ClientSession() as session:
             async with session.get(url) as response:
                 logger.debug('download finished')
@@ -81,22 +116,10 @@ async def get_image(url, file_id='', target_format=''):
                 if file_mime not in default_target_format:
                     logger.error(f'{file_mime} is not supported at this time')
 
-                image.seek(0)  # restart from head
                 target_file_name = str(uuid4()) + mime_to_extension[default_target_format[file_mime]]
                 file_full_path = os.path.join(download_dir, target_file_name)
 
-                if file_mime == 'application/gzip':  # tgs file
-                    convert_tgs_to_gif(image, file_full_path)
-                elif file_mime == 'video/mp4' or file_mime == 'video/webm':  # tg animation
-                    convert_mp4_to_gif(image, file_full_path)
-                elif file_mime == 'image/webp':
-                    convert_webp_to_png(image, file_full_path)
-                elif default_target_format[file_mime] == file_mime:
-                    open(file_full_path, 'wb').write(image.read())
-                else:
-                    img = Image.open(image)
-                    img = img.convert('RGB')
-                    img.save(file_full_path)
+                await run_conversion(image.getvalue(), file_mime, file_full_path)
 
                 if file_id:
                     cache[file_id] = file_full_path
@@ -110,6 +133,47 @@ async def get_image(url, file_id='', target_format=''):
         return ''
 
 
+async def run_conversion(image: bytes, file_mime: str, file_full_path: str):
+    """
+    convert image in the media process pool if configured, otherwise on the current event loop
+    :param image: downloaded file
+    :param file_mime: mime of the downloaded file
+    :param file_full_path: full output path
+    """
+    global media_executor
+    workers = UMRConfig.config.Dispatch.MediaWorkers
+    if not workers:
+        convert_image(image, file_mime, file_full_path)
+        return
+    if not media_executor:
+        with media_executor_lock:
+            if not media_executor:
+                media_executor = ProcessPoolExecutor(max_workers=workers)
+    await asyncio.get_event_loop().run_in_executor(media_executor, convert_image, image, file_mime, file_full_path)
+
+
+def convert_image(image: bytes, file_mime: str, file_full_path: str):
+    """
+    convert downloaded file to the target format of its mime, CPU heavy
+    :param image: downloaded file
+    :param file_mime: mime of the downloaded file
+    :param file_full_path: full output path
+    """
+    image = BytesIO(image)
+    if file_mime == 'application/gzip':  # tgs file
+        convert_tgs_to_gif(image, file_full_path)
+    elif file_mime == 'video/mp4' or file_mime == 'video/webm':  # tg animation
+        convert_mp4_to_gif(image, file_full_path)
+    elif file_mime == 'image/webp':
+        convert_webp_to_png(image, file_full_path)
+    elif default_target_format[file_mime] == file_mime:
+        open(file_full_path, 'wb').write(image.read())
+    else:
+        img = Image.open(image)
+        img = img.convert('RGB')
+        img.save(file_full_path)
+
+
 def convert_mp4_to_gif(mp4_file: [str, BytesIO], gif_file: str):
     """
     Reference: http://imageio.readthedocs.io/en/latest/examples.html#convert-a-movie
@@ -0,0 +1,246 @@
+from typing import Callable, Awaitable, Deque, Dict, List, Tuple
+from threading import Thread, Lock
+from collections import OrderedDict, deque
+import asyncio
+import itertools
+import time
+from janus import Queue
+from .UMRType import UnifiedMessage, QueueOverflowPolicy, GroupID
+from .UMRMetrics import metrics
+from . import UMRLogging
+
+"""
+Central ingress queue
+
+Drivers receive messages on their own threads and event loops, the ingress queue hands them over to dispatch
+shards. Each shard is a thread with its own event loop, every source chat is pinned to one shard by the hash of its
+GroupID. Every source chat gets its own task on its shard, messages of the same chat are dispatched in order,
+different chats in parallel, so a slow chat does not hold up the others, and blocking work in one shard does not
+hold up the other shards. The bound covers messages waiting for dispatch and messages being dispatched, across all
+shards. When it is reached, drivers wait in order or messages are dropped.
+"""
+
+logger = UMRLogging.get_logger('Ingress')
+
+
+class IngressItem:
+    __slots__ = ('sequence', 'message', 'enqueued_at')
+
+    def __init__(self, sequence: int, message: UnifiedMessage):
+        self.sequence = sequence
+        self.message = message
+        self.enqueued_at = time.perf_counter()
+
+
+def source_of(message: UnifiedMessage) -> GroupID:
+    chat_attrs = message.chat_attrs
+    return GroupID(platform=chat_attrs.platform, chat_type=chat_attrs.chat_type, chat_id=chat_attrs.chat_id)
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class IngressShard:
+    def __init__(self, ingress: 'IngressQueue', index: int):
+        """
+        Start the dispatch thread of the shard
+
+        :param ingress: queue feeding this shard
+        :param index: shard number
+        """
+        self.ingress = ingress
+        self.index = index
+        # source chat -> messages handed to its task, only used on the shard loop
+        self.chats: Dict[GroupID, Deque[IngressItem]] = dict()
+
+        self.loop = asyncio.new_event_loop()
+        self.queue: Queue = None
+        started = Lock()
+        started.acquire()
+        self.thread = Thread(target=self.run, args=(started,), name=f'Ingress-{index}', daemon=True)
+        self.thread.start()
+        started.acquire()  # queue must exist before the first put
+
+    def run(self, started: Lock):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.work(started))
+
+    async def work(self, started: Lock):
+        self.queue = Queue()  # janus queue is bound to the running loop, the bound is kept by IngressQueue.put
+        started.release()
+        async_q = self.queue.async_q
+        while True:
+            batch = [await async_q.get()]
+            while len(batch) < self.ingress.batch_size:
+                try:
+                    batch.append(async_q.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            for item in batch:
+                key = source_of(item.message)
+                chat = self.chats.get(key)
+                if chat is None:
+                    chat = self.chats[key] = deque()
+                    self.loop.create_task(self.dispatch_chat(key, chat))
+                chat.append(item)
+
+    async def dispatch_chat(self, key: GroupID, chat: Deque[IngressItem]):
+        """
+        dispatch messages of one source chat in order, ends when the chat has nothing left
+        :param key: source chat
+        :param chat: messages handed over by work
+        """
+        try:
+            while chat:
+                await self.ingress.dispatch_item(chat.popleft())
+        finally:
+            del self.chats[key]
+
+
+class IngressQueue:
+    def __init__(self, dispatch_function: Callable[[UnifiedMessage], Awaitable], max_size: int, batch_size: int,
+                 overflow_policy: QueueOverflowPolicy, shards: int = 1):
+        """
+        Start the dispatch shards
+
+        :param dispatch_function: coroutine function that dispatches one message
+        :param max_size: queue bound, 0 for unbounded
+        :param batch_size: max messages taken from the queue at once by each shard
+        :param overflow_policy: what to do when the queue is full
+        :param shards: number of dispatch threads
+        """
+        self.dispatch_function = dispatch_function
+        self.max_size = max_size
+        self.batch_size = max(batch_size, 1)
+        self.overflow_policy = overflow_policy
+        self.lock = Lock()
+        self.sequence = itertools.count()
+
+        # accepted and not yet dispatched, oldest first, shared by all threads under lock
+        self.waiting: Dict[int, IngressItem] = OrderedDict()
+        self.running = 0
+        # puts waiting for room with block policy, admitted in order
+        self.blocked: Deque[Tuple[IngressItem, asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+
+        # statistics
+        self.enqueued = 0
+        self.dispatched = 0
+        self.failed = 0
+        self.dropped = 0
+
+        self.shards: List[IngressShard] = [IngressShard(self, index) for index in range(max(shards, 1))]
+        logger.info(f'Started ingress queue, max size {self.max_size}, batch size {self.batch_size}, '
+                    f'{len(self.shards)} shards')
+
+    async def dispatch_item(self, item: IngressItem):
+        """
+        dispatch one message on the shard loop, skipped if it was dropped meanwhile
+        :param item: message handed over by put
+        """
+        with self.lock:
+            if self.waiting.pop(item.sequence, None) is None:
+                return  # dropped for a newer message
+            self.running += 1
+            depth = len(self.waiting)
+        message = item.message
+        metrics.set_gauge('ingress_depth', '', depth)
+        metrics.observe('ingress_wait', message.chat_attrs.platform, time.perf_counter() - item.enqueued_at)
+        try:
+            await self.dispatch_function(message)
+            with self.lock:
+                self.dispatched += 1
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            logger.exception(f'Failed to dispatch message {message.chat_attrs.message_id} '
+                             f'from ({message.chat_attrs.platform}, {message.chat_attrs.chat_id})')
+        finally:
+            with self.lock:
+                self.running -= 1
+                self._admit_blocked()
+
+    async def put(self, message: UnifiedMessage):
+        """
+        enqueue message, can be called from any event loop
+        with block policy, waits without blocking the caller's event loop, waiting puts are admitted in order
+        :param message: received message
+        """
+        with self.lock:
+            item = IngressItem(next(self.sequence), message)
+            if not self.blocked and not self._full():
+                self._accept(item)
+                return
+            if self.overflow_policy == QueueOverflowPolicy.DROP_NEWEST:
+                self._drop(message, 'incoming')
+                return
+            if self.overflow_policy == QueueOverflowPolicy.DROP_OLDEST:
+                if not self.waiting:  # everything is being dispatched
+                    self._drop(message, 'incoming')
+                    return
+                _, oldest = self.waiting.popitem(last=False)
+                self._drop(oldest.message, 'oldest')
+                self._accept(item)
+                return
+            loop = asyncio.get_event_loop()
+            entry = (item, loop, loop.create_future())
+            self.blocked.append(entry)
+
+        try:
+            await entry[2]
+        except asyncio.CancelledError:
+            with self.lock:
+                try:
+                    self.blocked.remove(entry)
+                except ValueError:
+                    pass  # admitted meanwhile, message will still be dispatched
+            raise
+
+    def shard_of(self, message: UnifiedMessage) -> IngressShard:
+        """
+        :return: shard that dispatches the source chat of the message
+        """
+        return self.shards[hash(source_of(message)) % len(self.shards)]
+
+    def _full(self) -> bool:
+        return self.max_size > 0 and len(self.waiting) + self.running >= self.max_size
+
+    def _accept(self, item: IngressItem):
+        """
+        hand item over to the shard of its source chat, must be called with lock held to keep the order
+        """
+        self.waiting[item.sequence] = item
+        self.enqueued += 1
+        self.shard_of(item.message).queue.sync_q.put_nowait(item)
+        metrics.set_gauge('ingress_depth', '', len(self.waiting))
+
+    def _admit_blocked(self):
+        """
+        accept waiting puts while there is room, must be called with lock held
+        """
+        while self.blocked and not self._full():
+            item, loop, waiter = self.blocked.popleft()
+            self._accept(item)
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:  # caller's loop is closed
+                pass
+
+    def _drop(self, message: UnifiedMessage, which: str):
+        """
+        count dropped message, must be called with lock held
+        """
+        self.dropped += 1
+        metrics.increase('ingress_dropped', message.chat_attrs.platform)
+        logger.debug(f'Ingress queue is full, dropping {which} message')
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: waiting, running and blocked messages, enqueued, dispatched, failed and dropped messages
+        """
+        with self.lock:
+            return {'depth': len(self.waiting), 'running': self.running, 'blocked': len(self.blocked),
+                    'enqueued': self.enqueued, 'dispatched': self.dispatched, 'failed': self.failed,
+                    'dropped': self.dropped}
@@ -0,0 +1,420 @@
+from typing import Dict, List, Union, Callable, Awaitable, Tuple, Any, Optional
+from dataclasses import dataclass
+from threading import Thread, Lock
+from queue import SimpleQueue, Empty
+import asyncio
+import atexit
+import itertools
+import json
+import os
+import sqlite3
+import time
+from .UMRType import UnifiedMessage, ChatType, ChatAttribute, MessageEntity, EntityType, SendAction, GroupID
+from . import UMRLogging
+
+"""
+Durable outbound journal
+
+Every (message, destination) pair is recorded before it is queued or sent, and removed once the driver accepted it.
+Failed sends are retried with exponential backoff, and moved to the dead letter table after the last attempt.
+Pending entries are replayed after restart, retries run on the event loop of the destination driver if it has one.
+
+Payloads are versioned JSON documents with explicit fields, see dump_payload.
+All writes are batched by a writer thread, a message that is sent before the next flush never touches the disk.
+"""
+
+logger = UMRLogging.get_logger('Journal')
+
+Sender = Callable[..., Awaitable]
+LoopOf = Callable[[str], Optional[asyncio.AbstractEventLoop]]  # (platform) -> event loop of its driver
+
+PAYLOAD_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbound (
+    id INTEGER PRIMARY KEY,
+    platform TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    last_error TEXT NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letter (
+    id INTEGER PRIMARY KEY,
+    platform TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    last_error TEXT NOT NULL,
+    payload BLOB NOT NULL
+);
+'''
+
+
+def dump_chat_attrs(chat_attrs: Optional[ChatAttribute]) -> Optional[Dict[str, Any]]:
+    if not chat_attrs:
+        return None
+    return {'platform': chat_attrs.platform, 'chat_id': chat_attrs.chat_id, 'chat_type': chat_attrs.chat_type.value,
+            'name': chat_attrs.name, 'user_id': chat_attrs.user_id, 'message_id': chat_attrs.message_id,
+            'forward_from': dump_chat_attrs(chat_attrs.forward_from),
+            'reply_to': dump_chat_attrs(chat_attrs.reply_to)}
+
+
+def load_chat_attrs(data: Optional[Dict[str, Any]]) -> Optional[ChatAttribute]:
+    if not data:
+        return None
+    chat_attrs = ChatAttribute(platform=data['platform'], chat_id=data['chat_id'],
+                               chat_type=ChatType(data['chat_type']), name=data['name'], user_id=data['user_id'],
+                               message_id=data['message_id'])
+    chat_attrs.forward_from = load_chat_attrs(data['forward_from'])
+    chat_attrs.reply_to = load_chat_attrs(data['reply_to'])
+    return chat_attrs
+
+
+def dump_payload(platform: str, chat_id: Union[int, str], chat_type: ChatType, message: UnifiedMessage) -> bytes:
+    """
+    :return: JSON document of destination and message, fields are listed explicitly, bump PAYLOAD_VERSION on change
+    """
+    return json.dumps({
+        'version':     PAYLOAD_VERSION,
+        'platform':    platform,
+        'chat_id':     chat_id,
+        'chat_type':   chat_type.value,
+        'message': {
+            'chat_attrs':    dump_chat_attrs(message.chat_attrs),
+            'text':          message.text,
+            'text_entities': [{'start': i.start, 'end': i.end, 'entity_type': i.entity_type.value, 'link': i.link}
+                              for i in message.text_entities],
+            'image':         message.image,
+            'file_id':       message.file_id,
+            'send_action':   {'message_id': message.send_action.message_id,
+                              'user_id':    message.send_action.user_id},
+            'path':          [[i.platform, i.chat_type.value, i.chat_id] for i in message.path],
+            'hops':          message.hops,
+        },
+    }, ensure_ascii=False).encode()
+
+
+def load_payload(payload: bytes) -> Tuple[str, Union[int, str], ChatType, UnifiedMessage]:
+    """
+    :return: (platform, chat_id, chat_type, message) stored by dump_payload
+    :raise ValueError: payload is not a known version
+    """
+    data = json.loads(payload)
+    if data.get('version') != PAYLOAD_VERSION:
+        raise ValueError(f'Unsupported journal payload version {data.get("version")}')
+    message_data = data['message']
+    message = UnifiedMessage()
+    message.chat_attrs = load_chat_attrs(message_data['chat_attrs']) or message.chat_attrs
+    message.text = message_data['text']
+    message.text_entities = [MessageEntity(i['start'], i['end'], EntityType(i['entity_type']), i['link'])
+                             for i in message_data['text_entities']]
+    message.image = message_data['image']
+    message.file_id = message_data['file_id']
+    message.send_action = SendAction(**message_data['send_action'])
+    message.path = tuple(GroupID(platform=platform, chat_type=ChatType(chat_type), chat_id=chat_id)
+                         for platform, chat_type, chat_id in message_data['path'])
+    message.hops = message_data['hops']
+    return data['platform'], data['chat_id'], ChatType(data['chat_type']), message
+
+
+@dataclass
+class JournalEntry:
+    """
+    One pending (message, destination) pair
+    """
+    entry_id: int
+    platform: str
+    chat_id: Union[int, str]
+    chat_type: ChatType
+    message: UnifiedMessage
+    attempts: int = 0
+    created: float = 0.0
+    last_error: str = ''
+
+    def row(self, next_attempt: float) -> Tuple[Any, ...]:
+        payload = dump_payload(self.platform, self.chat_id, self.chat_type, self.message)
+        return (self.entry_id, self.platform, str(self.chat_id), self.attempts, next_attempt, self.created,
+                self.last_error, payload)
+
+
+class OutboundJournal:
+    def __init__(self, path: str, sender: Sender, is_ready: Callable[[str], bool], max_attempts: int,
+                 retry_delay: float, max_retry_delay: float, flush_interval: float, batch_size: int,
+                 loop_of: Optional[LoopOf] = None):
+        """
+        Open journal and replay pending entries
+
+        :param path: sqlite database file
+        :param sender: coroutine function (message, platform, chat_id, chat_type, journal_id=) that sends a message
+        :param is_ready: returns True when the driver of the platform is able to send
+        :param max_attempts: attempts before an entry goes to dead letter
+        :param retry_delay: seconds before the first retry
+        :param max_retry_delay: upper bound of retry delay
+        :param flush_interval: seconds between batched writes
+        :param batch_size: max operations in one write transaction
+        :param loop_of: returns the event loop of the driver of the platform, retries are sent on it,
+                        None or no loop to send on the retry thread
+        """
+        self.path = path
+        self.sender = sender
+        self.is_ready = is_ready
+        self.loop_of = loop_of
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.entries: Dict[int, JournalEntry] = dict()
+        self.lock = Lock()
+        self.operations: SimpleQueue = SimpleQueue()
+
+        # statistics
+        self.retried = 0
+        self.dead = 0
+        self.discarded = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        last_id = max(connection.execute('SELECT MAX(id) FROM outbound').fetchone()[0] or 0,
+                      connection.execute('SELECT MAX(id) FROM dead_letter').fetchone()[0] or 0)
+        pending = connection.execute('SELECT id, attempts, next_attempt, created, last_error, payload FROM outbound')\
+            .fetchall()
+        connection.close()
+        self.ids = itertools.count(last_id + 1)
+
+        self.writer = Thread(target=self.write, name='JournalWriter', daemon=True)
+        self.writer.start()
+
+        self.loop = asyncio.new_event_loop()
+        self.retry_thread = Thread(target=self.run_loop, name='JournalRetry', daemon=True)
+        self.retry_thread.start()
+
+        atexit.register(self.close)
+
+        for entry_id, attempts, next_attempt, created, last_error, payload in pending:
+            try:
+                platform, chat_id, chat_type, message = load_payload(payload)
+            except Exception:
+                logger.exception(f'Unable to load journal entry {entry_id}, skipping')
+                continue
+            entry = JournalEntry(entry_id=entry_id, platform=platform, chat_id=chat_id, chat_type=chat_type,
+                                 message=message, attempts=attempts, created=created, last_error=last_error)
+            self.entries[entry_id] = entry
+            self.loop.call_soon_threadsafe(self._schedule_retry, entry, max(next_attempt - time.time(), 0))
+        if pending:
+            logger.info(f'Replaying {len(pending)} pending outbound messages')
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # region called from dispatcher
+
+    def record(self, message: UnifiedMessage, platform: str, chat_id: Union[int, str], chat_type: ChatType) -> int:
+        """
+        record pending message before it is queued or sent
+        :return: journal id
+        """
+        entry = JournalEntry(entry_id=next(self.ids), platform=platform, chat_id=chat_id, chat_type=chat_type,
+                             message=message, created=time.time())
+        with self.lock:
+            self.entries[entry.entry_id] = entry
+        self.operations.put(('insert', entry, 0.0))
+        return entry.entry_id
+
+    def complete(self, journal_id: int):
+        """
+        message is accepted by driver
+        """
+        with self.lock:
+            entry = self.entries.pop(journal_id, None)
+        if entry:
+            self.operations.put(('delete', entry, 0.0))
+
+    def discard(self, journal_id: int):
+        """
+        message is dropped on purpose, e.g. by queue overflow policy, it is not retried or replayed
+        """
+        with self.lock:
+            entry = self.entries.pop(journal_id, None)
+        if entry:
+            self.operations.put(('delete', entry, 0.0))
+            self.discarded += 1
+
+    def fail(self, journal_id: int, error: BaseException):
+        """
+        message failed to send, retry later or move to dead letter
+        """
+        with self.lock:
+            entry = self.entries.get(journal_id)
+            if not entry:
+                return
+            entry.attempts += 1
+            entry.last_error = f'{type(error).__name__}: {error}'
+            if entry.attempts >= self.max_attempts:
+                del self.entries[journal_id]
+
+        if entry.attempts >= self.max_attempts:
+            self.operations.put(('dead', entry, 0.0))
+            self.dead += 1
+            logger.error(f'Message to ({entry.platform}, {entry.chat_id}) failed {entry.attempts} times, '
+                         f'moved to dead letter: {entry.last_error}')
+            return
+
+        delay = min(self.retry_delay * 2 ** (entry.attempts - 1), self.max_retry_delay)
+        logger.warning(f'Message to ({entry.platform}, {entry.chat_id}) failed, retry in {delay:.1f}s: '
+                       f'{entry.last_error}')
+        self.operations.put(('update', entry, time.time() + delay))
+        self.loop.call_soon_threadsafe(self._schedule_retry, entry, delay)
+
+    def postpone(self, journal_id: int, delay: float):
+        """
+        message was not attempted, e.g. driver is unavailable, retry later without counting an attempt
+        """
+        with self.lock:
+            entry = self.entries.get(journal_id)
+        if not entry:
+            return
+        delay = max(delay, self.retry_delay)
+        self.operations.put(('update', entry, time.time() + delay))
+        self.loop.call_soon_threadsafe(self._schedule_retry, entry, delay)
+
+    # endregion
+
+    # region retry
+
+    def _schedule_retry(self, entry: JournalEntry, delay: float):
+        self.loop.call_later(delay, lambda: self.loop.create_task(self._retry(entry)))
+
+    async def _retry(self, entry: JournalEntry):
+        if entry.entry_id not in self.entries:
+            return
+        if not self.is_ready(entry.platform):  # wait for driver without counting attempts
+            self._schedule_retry(entry, self.retry_delay)
+            return
+        self.retried += 1
+        loop = self.loop_of(entry.platform) if self.loop_of else None
+        try:
+            sending = self.sender(entry.message, entry.platform, entry.chat_id, entry.chat_type,
+                                  journal_id=entry.entry_id)
+            if loop and loop is not self.loop and loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(sending, loop))
+            else:
+                await sending
+        except Exception as e:  # sender reports to journal by itself, this only happens if reporting failed
+            logger.exception(f'Retry of journal entry {entry.entry_id} failed')
+            self.fail(entry.entry_id, e)
+
+    # endregion
+
+    # region writer
+
+    def write(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        stopped = False
+        while not stopped:
+            operations = list()
+            try:
+                operations.append(self.operations.get())
+                deadline = time.monotonic() + self.flush_interval
+                while len(operations) < self.batch_size and operations[-1][0] != 'stop':
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    operations.append(self.operations.get(timeout=timeout))
+            except Empty:
+                pass
+            if operations[-1][0] == 'stop':
+                operations.pop()
+                stopped = True
+            try:
+                self._flush(connection, operations)
+            except Exception:
+                logger.exception(f'Failed to write {len(operations)} journal operations')
+        connection.close()
+
+    def _flush(self, connection: sqlite3.Connection, operations: List[Tuple[str, JournalEntry, float]]):
+        inserts: Dict[int, Tuple[JournalEntry, float]] = dict()
+        updates: Dict[int, Tuple[JournalEntry, float]] = dict()
+        deletes: List[int] = list()
+        dead: List[JournalEntry] = list()
+
+        for operation, entry, next_attempt in operations:
+            if operation == 'insert':
+                inserts[entry.entry_id] = (entry, next_attempt)
+            elif operation == 'update':
+                if entry.entry_id in inserts:
+                    inserts[entry.entry_id] = (entry, next_attempt)
+                else:
+                    updates[entry.entry_id] = (entry, next_attempt)
+            elif operation in ('delete', 'dead'):
+                # sent before it was ever written
+                if inserts.pop(entry.entry_id, None) is None:
+                    deletes.append(entry.entry_id)
+                updates.pop(entry.entry_id, None)
+                if operation == 'dead':
+                    dead.append(entry)
+
+        with connection:
+            if inserts:
+                connection.executemany('INSERT OR REPLACE INTO outbound VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                       [entry.row(next_attempt) for entry, next_attempt in inserts.values()])
+            if updates:
+                connection.executemany('UPDATE outbound SET attempts = ?, next_attempt = ?, last_error = ? '
+                                       'WHERE id = ?',
+                                       [(entry.attempts, next_attempt, entry.last_error, entry.entry_id)
+                                        for entry, next_attempt in updates.values()])
+            if deletes:
+                connection.executemany('DELETE FROM outbound WHERE id = ?', [(i,) for i in deletes])
+            if dead:
+                connection.executemany('INSERT OR REPLACE INTO dead_letter VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                       [entry.row(time.time()) for entry in dead])
+
+    def close(self):
+        """
+        stop the writer after it wrote remaining operations, called at exit
+        """
+        if not self.writer.is_alive():
+            return
+        self.operations.put(('stop', None, 0.0))
+        self.writer.join()
+
+    # endregion
+
+    # region inspection
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: in memory pending count, retry count, dead letter count and discarded count since start
+        """
+        return {'pending': len(self.entries), 'retried': self.retried, 'dead': self.dead,
+                'discarded': self.discarded}
+
+    def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        :param limit: max number of entries, newest first
+        :return: dead letter entries with decoded message
+        """
+        connection = sqlite3.connect(self.path)
+        try:
+            rows = connection.execute('SELECT id, attempts, created, next_attempt, last_error, payload '
+                                      'FROM dead_letter ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        finally:
+            connection.close()
+        result = list()
+        for entry_id, attempts, created, failed, last_error, payload in rows:
+            platform, chat_id, chat_type, message = load_payload(payload)
+            result.append({'id': entry_id, 'platform': platform, 'chat_id': chat_id, 'chat_type': chat_type,
+                           'message': message, 'attempts': attempts, 'created': created, 'failed': failed,
+                           'last_error': last_error})
+        return result
+
+    # endregion
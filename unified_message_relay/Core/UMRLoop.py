@@ -0,0 +1,197 @@
+from typing import Dict, List, Set, Tuple, Union
+from .UMRType import UnifiedMessage, GroupID, ChatType, ForwardTypeEnum
+from .UMRMessageRelation import get_message_id
+from .UMRMetrics import metrics
+from . import UMRLogging
+
+"""
+Relay loop detection
+
+Startup: find cycles in the forward graph built from Topology and Default rules, a message can travel around such
+a cycle if a driver receives the bot's own messages or another relay bridges the same chats.
+
+Runtime: drop echoes of messages the bot forwarded, messages that already passed through the chat they are received in,
+messages relayed more than MaxHops times, and optionally messages sent by the bot account itself.
+The dispatcher never forwards a message to a chat it already passed through.
+"""
+
+logger = UMRLogging.get_logger('Loop')
+
+Node = Tuple[str, Union[int, str], ChatType]  # (platform, chat id, chat type)
+ANY_CHAT = '*'  # stands for every chat of a platform that is not in Topology
+
+
+def format_node(node: Node) -> str:
+    platform, chat_id, chat_type = node
+    if chat_id == ANY_CHAT:
+        return f'{platform}:<unbridged chats>'
+    return f'{platform}:{chat_id}'
+
+
+def build_forward_graph(forward_list) -> Tuple[Dict[Node, Set[Node]], Set[Tuple[Node, Node]]]:
+    """
+    :param forward_list: ForwardList section of config
+    :return: (node -> nodes that receive every message from it, edges that come from one BiDirection entry)
+    """
+    graph: Dict[Node, Set[Node]] = dict()
+    bridges: Set[Tuple[Node, Node]] = set()
+
+    for i in forward_list.Topology:
+        src = (i.From, i.FromChat, i.FromChatType)
+        dst = (i.To, i.ToChat, i.ToChatType)
+        graph.setdefault(src, set()).add(dst)
+        graph.setdefault(dst, set())
+        if i.ForwardType == ForwardTypeEnum.BiDirection:
+            graph[dst].add(src)
+            bridges.add((src, dst))
+            bridges.add((dst, src))
+
+    # chats in Topology never use Default rules
+    bridged = set(graph)
+    defaults: Dict[str, Set[Node]] = dict()
+    for i in forward_list.Default:
+        defaults.setdefault(i.From, set()).add((i.To, i.ToChat, i.ToChatType))
+
+    for platform, targets in defaults.items():
+        graph.setdefault((platform, ANY_CHAT, ChatType.UNSPECIFIED), set()).update(targets)
+        for target in targets:
+            graph.setdefault(target, set())
+
+    for node in list(graph):
+        platform, chat_id, _ = node
+        if node not in bridged and chat_id != ANY_CHAT and platform in defaults:
+            graph[node].update(defaults[platform])
+
+    return graph, bridges
+
+
+def find_cycles(graph: Dict[Node, Set[Node]]) -> List[List[Node]]:
+    """
+    Strongly connected components with more than one node or with a self loop, Tarjan's algorithm without recursion
+    :param graph: forward graph
+    :return: list of components
+    """
+    index: Dict[Node, int] = dict()
+    low: Dict[Node, int] = dict()
+    stack: List[Node] = list()
+    on_stack: Set[Node] = set()
+    components: List[List[Node]] = list()
+    counter = 0
+
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(sorted(graph[root], key=str)))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            advanced = False
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(graph[child], key=str))))
+                    advanced = True
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            if advanced:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                component = list()
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1 or node in graph[node]:
+                    components.append(component[::-1])
+    return components
+
+
+def analyze_forward_list(forward_list) -> List[List[Node]]:
+    """
+    warn about forward cycles, a plain BiDirection bridge between two chats is not reported
+    :param forward_list: ForwardList section of config
+    :return: reported cycles
+    """
+    graph, bridges = build_forward_graph(forward_list)
+    reported = list()
+    for component in find_cycles(graph):
+        if len(component) == 2 and (component[0], component[1]) in bridges:
+            continue
+        reported.append(component)
+        if len(component) == 1:
+            logger.warning(f'Forward rules send messages from {format_node(component[0])} back to itself')
+        else:
+            logger.warning(f'Forward rules contain a cycle: {" -> ".join(format_node(i) for i in component)}, '
+                           f'messages may be relayed repeatedly if a driver receives the bot\'s own messages '
+                           f'or another relay bridges these chats')
+    return reported
+
+
+class LoopGuard:
+    def __init__(self, bot_accounts: Dict[str, Union[int, str]], max_hops: int, drop_own_messages: bool):
+        """
+        :param bot_accounts: bot account of every platform
+        :param max_hops: messages relayed more times than this are dropped, 0 for no limit
+        :param drop_own_messages: drop messages sent by the bot account of their platform
+        """
+        self.bot_accounts = {platform: str(account) for platform, account in bot_accounts.items()}
+        self.max_hops = max_hops
+        self.drop_own_messages = drop_own_messages
+
+    def check(self, message: UnifiedMessage) -> str:
+        """
+        :param message: received message
+        :return: reason to drop the message, empty string if it may be dispatched
+        """
+        chat_attrs = message.chat_attrs
+        if self.drop_own_messages:
+            bot_account = self.bot_accounts.get(chat_attrs.platform)
+            if bot_account and str(chat_attrs.user_id) == bot_account:
+                return 'own_message'
+
+        if chat_attrs.message_id:
+            relation = get_message_id(src_platform=chat_attrs.platform,
+                                      src_chat_id=chat_attrs.chat_id,
+                                      src_chat_type=chat_attrs.chat_type,
+                                      src_message_id=chat_attrs.message_id,
+                                      dst_platform=chat_attrs.platform,
+                                      dst_chat_id=chat_attrs.chat_id,
+                                      dst_chat_type=chat_attrs.chat_type)
+            if relation and relation.source:  # only messages sent by the bot have a source
+                return 'echo'
+
+        if message.path and GroupID(platform=chat_attrs.platform, chat_id=chat_attrs.chat_id,
+                                    chat_type=chat_attrs.chat_type) in message.path:
+            return 'path'  # came back to a chat it was relayed from, drivers set path of relayed messages
+
+        if self.max_hops and message.hops > self.max_hops:
+            return 'hop_limit'
+
+        return ''
+
+    def is_loop(self, message: UnifiedMessage) -> bool:
+        """
+        check message and count dropped ones as loop_<reason>_dropped
+        :param message: received message
+        :return: True if message should be dropped
+        """
+        reason = self.check(message)
+        if not reason:
+            return False
+        metrics.increase(f'loop_{reason}_dropped', message.chat_attrs.platform)
+        logger.debug(f'Dropped message {message.chat_attrs.message_id} '
+                     f'from ({message.chat_attrs.platform}, {message.chat_attrs.chat_id}): {reason}')
+        return True
@@ -1,17 +1,103 @@
-from typing import List, Callable, Union
+from typing import List, Callable, Union, Dict, Tuple, Set, Optional, FrozenSet
 from .UMRType import MessageHook, ChatType, UnifiedMessage
+from .UMRWorkerPool import WorkerPool
+from .UMRMetrics import metrics
+from .UMRBudget import call_with_budget
+from . import UMRConfig
 from . import UMRLogging
 
 logger = UMRLogging.get_logger('MessageHook')
 
 message_hook_full: List[MessageHook] = list()  # src_driver, src_group, dst_driver, dst_group, hook
 message_hook_src: List[MessageHook] = list()
+message_observer: List[MessageHook] = list()
+
+CACHE_SIZE = 4096  # matched hooks cached per index, cleared when full
+
+ChatKey = Tuple[Optional[str], Optional[Union[int, str]], Optional[ChatType]]  # None matches anything
+
+
+def expand(drivers: FrozenSet[str], chats: FrozenSet[Union[int, str]], chat_types: FrozenSet[ChatType]) \
+        -> List[ChatKey]:
+    """
+    :return: every (driver, chat, chat type) bucket a hook is registered in, empty attributes become wildcards
+    """
+    if ChatType.UNSPECIFIED in chat_types:
+        chat_types = (None,)
+    return [(driver, chat, chat_type)
+            for driver in drivers or (None,)
+            for chat in chats or (None,)
+            for chat_type in chat_types]
+
+
+def candidates(buckets: Dict[ChatKey, List[int]], driver: str, chat: Union[int, str], chat_type: ChatType) -> Set[int]:
+    """
+    :return: positions of hooks whose buckets match the chat, including wildcard buckets
+    """
+    result = set()
+    for driver_key in (driver, None):
+        for chat_key in (chat, None):
+            for chat_type_key in (chat_type, None):
+                positions = buckets.get((driver_key, chat_key, chat_type_key))
+                if positions:
+                    result.update(positions)
+    return result
+
+
+class HookIndex:
+    def __init__(self, hooks: List[MessageHook], match_destination: bool):
+        """
+        Buckets of hooks by source and destination chat, matched hooks keep registration order
+
+        :param hooks: registered hooks
+        :param match_destination: also match destination attributes
+        """
+        self.hooks: Tuple[MessageHook, ...] = tuple(hooks)
+        self.match_destination = match_destination
+        self.src_buckets: Dict[ChatKey, List[int]] = dict()
+        self.dst_buckets: Dict[ChatKey, List[int]] = dict()
+        self.cache: Dict[tuple, Tuple[MessageHook, ...]] = dict()
+
+        for position, hook in enumerate(self.hooks):
+            for key in expand(hook.src_driver, hook.src_chat, hook.src_chat_type):
+                self.src_buckets.setdefault(key, list()).append(position)
+            if match_destination:
+                for key in expand(hook.dst_driver, hook.dst_chat, hook.dst_chat_type):
+                    self.dst_buckets.setdefault(key, list()).append(position)
+
+    def match(self, src_driver: str, src_chat: Union[int, str], src_chat_type: ChatType, dst_driver: str = '',
+              dst_chat: Union[int, str] = 0, dst_chat_type: ChatType = ChatType.UNSPECIFIED) \
+            -> Tuple[MessageHook, ...]:
+        """
+        :return: matching hooks in registration order
+        """
+        key = (src_driver, src_chat, src_chat_type, dst_driver, dst_chat, dst_chat_type)
+        hooks = self.cache.get(key)
+        if hooks is not None:
+            return hooks
+
+        positions = candidates(self.src_buckets, src_driver, src_chat, src_chat_type)
+        if self.match_destination and positions:
+            positions &= candidates(self.dst_buckets, dst_driver, dst_chat, dst_chat_type)
+        hooks = tuple(self.hooks[i] for i in sorted(positions))
+
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache = dict()
+        self.cache[key] = hooks
+        return hooks
+
+
+hook_index_src = HookIndex(message_hook_src, False)
+hook_index_full = HookIndex(message_hook_full, True)
+observer_index = HookIndex(message_observer, False)
+observer_pool: Optional[WorkerPool] = None  # started by the first register_observer
 
 
 def register_hook(src_driver: Union[str, List[str]] = '', src_chat: Union[int, str, List[Union[int, str]]] = 0,
                   src_chat_type: Union[ChatType, List[ChatType]] = ChatType.UNSPECIFIED,
                   dst_driver: Union[str, List[str]] = '', dst_chat: Union[int, str, List[Union[int, str]]] = 0,
-                  dst_chat_type: Union[ChatType, List[ChatType]] = ChatType.UNSPECIFIED) -> Callable:
+                  dst_chat_type: Union[ChatType, List[ChatType]] = ChatType.UNSPECIFIED,
+                  timeout: Optional[float] = None) -> Callable:
     """
     message hook registration
 
@@ -21,42 +107,95 @@ def register_hook(src_driver: Union[str, List[str]] = '', src_chat: Union[int, s
     :param dst_driver: driver name
     :param dst_chat: chat id
     :param dst_chat_type: chat type
+    :param timeout: seconds before the hook is cancelled, None for Dispatch.HookTimeout, 0 for no limit
     :return: decorator
     """
 
     def deco(original_func):
+        global hook_index_src, hook_index_full
         if not dst_chat and not dst_driver:
-            message_hook_src.append(MessageHook(src_driver, src_chat, src_chat_type, dst_driver, dst_chat, dst_chat_type, original_func))
+            message_hook_src.append(MessageHook(src_driver, src_chat, src_chat_type, dst_driver, dst_chat, dst_chat_type, original_func,
+                                                timeout))
+            hook_index_src = HookIndex(message_hook_src, False)
         else:
-            message_hook_full.append(MessageHook(src_driver, src_chat, src_chat_type, dst_driver, dst_chat, dst_chat_type, original_func))
+            message_hook_full.append(MessageHook(src_driver, src_chat, src_chat_type, dst_driver, dst_chat, dst_chat_type, original_func,
+                                                 timeout))
+            hook_index_full = HookIndex(message_hook_full, True)
+        return original_func
+
+    return deco
+
+
+def register_observer(src_driver: Union[str, List[str]] = '', src_chat: Union[int, str, List[Union[int, str]]] = 0,
+                      src_chat_type: Union[ChatType, List[ChatType]] = ChatType.UNSPECIFIED) -> Callable:
+    """
+    observer registration, observers get a copy of every matching received message in background,
+    they can not block forwarding and forwarding does not wait for them
+
+    :param src_driver: driver name, not the name of platform that is specified in config.yaml
+    :param src_chat: chat id
+    :param src_chat_type: chat type
+    :return: decorator
+    """
+
+    def deco(original_func):
+        global observer_index, observer_pool
+        if not observer_pool:
+            observer_config = UMRConfig.config.Dispatch.Observers
+            observer_pool = WorkerPool('Observer', observer_config.Workers, observer_config.MaxPending)
+        message_observer.append(MessageHook(src_driver, src_chat, src_chat_type, '', 0, ChatType.UNSPECIFIED,
+                                            original_func))
+        observer_index = HookIndex(message_observer, False)
         return original_func
 
     return deco
 
 
+def notify_observers(message: UnifiedMessage):
+    """
+    queue matching observers, returns immediately
+    :param message: received message
+    """
+    observers = observer_index.match(message.chat_attrs.platform,
+                                     message.chat_attrs.chat_id,
+                                     message.chat_attrs.chat_type)
+    if not observers:
+        return
+    snapshot = message.snapshot()
+    for observer in observers:
+        if not observer_pool.submit(observer.hook_function, snapshot):
+            metrics.increase('observer_dropped', message.chat_attrs.platform)
+
+
+def hook_budget(hook: MessageHook) -> float:
+    if hook.timeout is None:
+        return UMRConfig.config.Dispatch.HookTimeout
+    return hook.timeout
+
+
 async def dispatch_hook(message: UnifiedMessage,
                         dst_driver: Union[str, List[str]] = '', dst_chat: Union[int, str, List[Union[int, str]]] = 0,
                         dst_chat_type: Union[ChatType, List[ChatType]] = ChatType.UNSPECIFIED):
+    # hooks over their budget are cancelled and treated as not consuming the message
 
     if not dst_driver and not dst_chat and dst_chat_type == ChatType.UNSPECIFIED:
+        notify_observers(message)
+
         # hook for matching source only
-        for hook in message_hook_src:
-            if (not hook.src_driver or message.chat_attrs.platform in hook.src_driver) and \
-                    (ChatType.UNSPECIFIED in hook.src_chat_type or message.chat_attrs.chat_type in hook.src_chat_type) and \
-                    (not hook.src_chat or message.chat_attrs.chat_id in hook.src_chat):
-                if await hook.hook_function(message):
-                    return True
+        for hook in hook_index_src.match(message.chat_attrs.platform,
+                                         message.chat_attrs.chat_id,
+                                         message.chat_attrs.chat_type):
+            if await call_with_budget('hook', hook.hook_function, hook_budget(hook), message):
+                return True
     else:
-        # hook for matching all four attributes
-        for hook in message_hook_full:
-            if (not hook.src_driver or message.chat_attrs.platform in hook.src_driver) and \
-                    (not hook.src_chat or message.chat_attrs.chat_id in hook.src_chat) and \
-                    (ChatType.UNSPECIFIED in hook.src_chat_type or message.chat_attrs.chat_type in hook.src_chat_type) and \
-                    (not hook.dst_driver or dst_driver in hook.dst_driver) and \
-                    (ChatType.UNSPECIFIED in hook.dst_chat_type or dst_chat_type in hook.src_chat_type) and \
-                    (not hook.dst_chat or dst_chat in hook.dst_chat):
-                if await hook.hook_function(dst_driver, dst_chat, dst_chat_type, message):
-                    return True
+        # hook for matching all six attributes
+        for hook in hook_index_full.match(message.chat_attrs.platform,
+                                          message.chat_attrs.chat_id,
+                                          message.chat_attrs.chat_type,
+                                          dst_driver, dst_chat, dst_chat_type):
+            if await call_with_budget('hook', hook.hook_function, hook_budget(hook),
+                                      dst_driver, dst_chat, dst_chat_type, message):
+                return True
 
     return False
 
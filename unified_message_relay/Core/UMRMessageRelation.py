@@ -1,24 +1,183 @@
-from collections import OrderedDict
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Tuple, Optional
+from threading import Lock
+import os
+import sys
 from . import UMRLogging
-from .UMRType import GroupID, MessageID, DestinationMessageID, ChatType
+from . import UMRConfig
+from .UMRType import GroupID, DestinationMessageID, ChatType
 
 logger = UMRLogging.get_logger('MessageRelation')
 
+"""
+Message relation store
 
-class FIFODict(OrderedDict):
-    def __init__(self, capacity):
-        super().__init__()
-        self._capacity = capacity  # cache size
+Every relayed message is one RelationGroup: the received message and all copies sent by the bot.
+Each member is looked up by its own key, all keys of a message point to the same group.
 
-    def __setitem__(self, key, value):
-        contains_key = key in self
-        if len(self) - int(contains_key) >= self._capacity:
-            self.popitem(last=False)  # pop the first element if full
-        OrderedDict.__setitem__(self, key, value)
+Keys are plain tuples (platform, chat_type, chat_id, message_id) with interned platform names,
+members are stored flat in one tuple, DestinationMessageID objects are only built when read.
+Keys are sharded by message key, so a busy chat spreads over every shard and can use the whole capacity.
+Oldest keys of each shard are evicted first, tracked by a fixed size ring of keys.
+"""
 
+Key = Tuple[str, ChatType, Union[int, str], Union[int, str]]  # (platform, chat_type, chat_id, message_id)
 
-message_mapping = FIFODict(4096)  # at least twice as large as message_tuple
+STRIDE = 5  # platform, chat_type, chat_id, message_id, user_id
+
+
+class RelationGroup:
+    """
+    Received message and its copies, the first member is the received message
+    """
+    __slots__ = ('members',)
+
+    def __init__(self, platform: str, chat_type: ChatType, chat_id: Union[int, str], message_id: Union[int, str],
+                 user_id: Union[int, str]):
+        self.members: Tuple = (platform, chat_type, chat_id, message_id, user_id)
+
+    def add(self, platform: str, chat_type: ChatType, chat_id: Union[int, str], message_id: Union[int, str],
+            user_id: Union[int, str]):
+        self.members += (platform, chat_type, chat_id, message_id, user_id)
+
+    def find(self, platform: str, chat_type: ChatType, chat_id: Union[int, str]) -> int:
+        """
+        :return: offset of the latest member in the chat, -1 if not found
+        """
+        members = self.members
+        for offset in range(len(members) - STRIDE, -1, -STRIDE):
+            if members[offset + 2] == chat_id and members[offset] == platform and members[offset + 1] == chat_type:
+                return offset
+        return -1
+
+    def build(self, offset: int) -> DestinationMessageID:
+        """
+        :param offset: offset of member
+        :return: DestinationMessageID of the member, copies have the received message as source
+        """
+        members = self.members
+        source = None
+        if offset:
+            source = DestinationMessageID(platform=members[0], chat_type=members[1], chat_id=members[2],
+                                          message_id=members[3], user_id=members[4])
+        return DestinationMessageID(platform=members[offset], chat_type=members[offset + 1],
+                                    chat_id=members[offset + 2], message_id=members[offset + 3],
+                                    user_id=members[offset + 4], source=source)
+
+
+class RelationShard:
+    def __init__(self, capacity: int):
+        """
+        Part of the keys, with their own eviction ring and lock
+
+        :param capacity: max number of keys in this shard
+        """
+        self.capacity = max(capacity, 1)
+        self.groups: Dict[Key, RelationGroup] = dict()
+        self.ring: List[Optional[Key]] = [None] * self.capacity
+        self.position = 0
+        self.lock = Lock()
+
+    def insert(self, key: Key, group: RelationGroup):
+        # caller holds the lock
+        if key not in self.groups:
+            evicted = self.ring[self.position]
+            if evicted is not None:
+                self.groups.pop(evicted, None)
+            self.ring[self.position] = key
+            self.position = (self.position + 1) % self.capacity
+        self.groups[key] = group
+
+
+class RelationStore:
+    def __init__(self, capacity: int, shards: int = 16):
+        """
+        Thread safe, keys are sharded by message key so drivers in different threads rarely wait for the same lock
+        and every shard gets an even part of the capacity.
+        A group is modified under the lock of the shard of its received message, a key is inserted under the lock
+        of its own shard, locks are never nested.
+
+        :param capacity: max number of keys (received messages and sent copies), oldest are evicted first
+        :param shards: number of shards
+        """
+        shards = max(shards, 1)
+        self.shards: List[RelationShard] = [RelationShard(capacity // shards) for _ in range(shards)]
+
+    def shard_of(self, key: Key) -> RelationShard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def _new_group(self, platform: str, chat_type: ChatType, chat_id: Union[int, str], message_id: Union[int, str],
+                   user_id: Union[int, str]) -> RelationGroup:
+        return RelationGroup(platform, chat_type, chat_id, message_id, user_id)
+
+    def set_ingress(self, platform: str, chat_type: ChatType, chat_id: Union[int, str], message_id: Union[int, str],
+                    user_id: Union[int, str]) -> Optional[RelationGroup]:
+        """
+        :return: new group, None if the message is already known
+        """
+        platform = sys.intern(platform)
+        key = (platform, chat_type, chat_id, message_id)
+        shard = self.shard_of(key)
+        with shard.lock:
+            if key in shard.groups:  # redelivered, or echo of a message sent by the bot, keep the relation
+                return None
+            group = self._new_group(platform, chat_type, chat_id, message_id, user_id)
+            shard.insert(key, group)
+        return group
+
+    def set_egress(self, src_key: Key, platform: str, chat_type: ChatType, chat_id: Union[int, str],
+                   message_id: Union[int, str], user_id: Union[int, str]) -> Optional[RelationGroup]:
+        """
+        :return: group of the source message, None if not found
+        """
+        group = self.get(src_key)
+        if not group:  # message relation not found
+            return None
+        self._add(group, platform, chat_type, chat_id, message_id, user_id)
+        return group
+
+    def _add(self, group: RelationGroup, platform: str, chat_type: ChatType, chat_id: Union[int, str],
+             message_id: Union[int, str], user_id: Union[int, str]):
+        platform = sys.intern(platform)
+        members = group.members
+        with self.shard_of((members[0], members[1], members[2], members[3])).lock:
+            group.add(platform, chat_type, chat_id, message_id, user_id)
+        key = (platform, chat_type, chat_id, message_id)
+        shard = self.shard_of(key)
+        with shard.lock:
+            shard.insert(key, group)
+
+    def get(self, key: Key) -> Optional[RelationGroup]:
+        """
+        only looks at messages kept in memory, never blocks
+        :param key: key of any member
+        """
+        return self.shard_of(key).groups.get(key)
+
+    async def fetch(self, key: Key) -> Optional[RelationGroup]:
+        """
+        same as get, but also looks up messages no longer kept in memory (persistent store) without blocking the
+        event loop
+        :param key: key of any member
+        """
+        return self.get(key)
+
+    def __len__(self):
+        return sum(len(shard.groups) for shard in self.shards)
+
+
+def create_store() -> RelationStore:
+    relation_config = UMRConfig.config.MessageRelation
+    if not relation_config.Persistent:
+        return RelationStore(relation_config.Capacity, relation_config.Shards)
+    from .UMRRelationDB import PersistentRelationStore
+    return PersistentRelationStore(relation_config.Capacity, relation_config.Shards,
+                                   relation_config.Path or os.path.join(UMRConfig.config.DataRoot, 'relation.db'),
+                                   ttl=relation_config.TTL,
+                                   flush_interval=relation_config.FlushInterval,
+                                   batch_size=relation_config.BatchSize)
+
+
+message_relation = create_store()
 
 
 def set_ingress_message_id(src_platform: str, src_chat_id: Union[int, str], src_chat_type: ChatType, src_message_id: int, user_id):
@@ -31,13 +190,7 @@ def set_ingress_message_id(src_platform: str, src_chat_id: Union[int, str], src_
     :param user_id:
     :return:
     """
-    saved_msg_id = {GroupID(platform=src_platform, chat_id=src_chat_id, chat_type=src_chat_type): DestinationMessageID(
-        platform=src_platform,
-        chat_id=src_chat_id,
-        chat_type=src_chat_type,
-        message_id=src_message_id,
-        user_id=user_id)}
-    message_mapping[MessageID(platform=src_platform, chat_id=src_chat_id, chat_type=src_chat_type, message_id=src_message_id)] = saved_msg_id
+    message_relation.set_ingress(src_platform, src_chat_type, src_chat_id, src_message_id, user_id)
 
 
 def set_egress_message_id(src_platform: str, src_chat_id: Union[int, str], src_message_id: Union[int, str], src_chat_type: ChatType,
@@ -55,24 +208,14 @@ def set_egress_message_id(src_platform: str, src_chat_id: Union[int, str], src_m
     :param user_id:
     :return:
     """
-    saved_msg_id = message_mapping.get(MessageID(platform=src_platform,
-                                       chat_id=src_chat_id, chat_type=src_chat_type, message_id=src_message_id), dict())
-
-    if not saved_msg_id:  # message relation not found
-        return
-
-    source = saved_msg_id.get(GroupID(platform=src_platform, chat_id=src_chat_id, chat_type=src_chat_type))
-
-    dst_msg_id = DestinationMessageID(platform=dst_platform, chat_id=dst_chat_id, chat_type=dst_chat_type,
-                                      message_id=dst_message_id, user_id=user_id, source=source)
-    saved_msg_id[GroupID(platform=dst_platform, chat_id=dst_chat_id, chat_type=dst_chat_type)] = dst_msg_id
-    message_mapping[MessageID(platform=dst_platform, chat_id=dst_chat_id, chat_type=dst_chat_type, message_id=dst_message_id)] = saved_msg_id
+    message_relation.set_egress((src_platform, src_chat_type, src_chat_id, src_message_id),
+                                dst_platform, dst_chat_type, dst_chat_id, dst_message_id, user_id)
 
 
 def get_message_id(src_platform: str, src_chat_id: Union[int, str], src_chat_type: ChatType, src_message_id: int, dst_platform: str, dst_chat_id: Union[int, str], dst_chat_type: ChatType) \
         -> DestinationMessageID:
     """
-
+    only looks at messages kept in memory, use fetch_message_id to include persistent store
     :param dst_chat_type:
     :param src_chat_type:
     :param src_platform:
@@ -82,10 +225,53 @@ def get_message_id(src_platform: str, src_chat_id: Union[int, str], src_chat_typ
     :param dst_chat_id:
     :return: tuple of user_id, message_id
     """
-    return message_mapping.get(MessageID(platform=src_platform, chat_id=src_chat_id, chat_type=src_chat_type, message_id=src_message_id),
-                               dict()).get(GroupID(platform=dst_platform, chat_id=dst_chat_id, chat_type=dst_chat_type))
+    group = message_relation.get((src_platform, src_chat_type, src_chat_id, src_message_id))
+    return build_message_id(group, dst_platform, dst_chat_id, dst_chat_type)
+
+
+async def fetch_message_id(src_platform: str, src_chat_id: Union[int, str], src_chat_type: ChatType,
+                           src_message_id: int, dst_platform: str, dst_chat_id: Union[int, str],
+                           dst_chat_type: ChatType) -> DestinationMessageID:
+    """
+    same as get_message_id, messages not kept in memory are loaded from persistent store without blocking the event
+    loop
+    """
+    group = await message_relation.fetch((src_platform, src_chat_type, src_chat_id, src_message_id))
+    return build_message_id(group, dst_platform, dst_chat_id, dst_chat_type)
+
+
+def build_message_id(group: Optional[RelationGroup], dst_platform: str, dst_chat_id: Union[int, str],
+                     dst_chat_type: ChatType) -> Optional[DestinationMessageID]:
+    if not group:
+        return None
+    offset = group.find(dst_platform, dst_chat_type, dst_chat_id)
+    if offset < 0:
+        return None
+    return group.build(offset)
+
+
+def get_relation_dict(src_platform: str, src_chat_id: Union[int, str], src_chat_type: ChatType, message_id: int) -> Dict[GroupID, DestinationMessageID]:
+    """
+    only looks at messages kept in memory, use fetch_relation_dict to include persistent store
+    """
+    return build_relation_dict(message_relation.get((src_platform, src_chat_type, src_chat_id, message_id)))
+
+
+async def fetch_relation_dict(src_platform: str, src_chat_id: Union[int, str], src_chat_type: ChatType,
+                              message_id: int) -> Dict[GroupID, DestinationMessageID]:
+    """
+    same as get_relation_dict, messages not kept in memory are loaded from persistent store without blocking the
+    event loop
+    """
+    return build_relation_dict(await message_relation.fetch((src_platform, src_chat_type, src_chat_id, message_id)))
 
 
-def get_relation_dict(src_platform: str, src_chat_id: Union[int, str], src_chat_type: ChatType, message_id: int) -> Dict[MessageID, DestinationMessageID]:
-    return message_mapping.get(MessageID(platform=src_platform, chat_id=src_chat_id, chat_type=src_chat_type, message_id=message_id),
-                               dict())
+def build_relation_dict(group: Optional[RelationGroup]) -> Dict[GroupID, DestinationMessageID]:
+    if not group:
+        return dict()
+    relation = dict()
+    members = group.members
+    for offset in range(0, len(members), STRIDE):
+        relation[GroupID(platform=members[offset], chat_id=members[offset + 2], chat_type=members[offset + 1])] = \
+            group.build(offset)
+    return relation
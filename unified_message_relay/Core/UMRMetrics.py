@@ -0,0 +1,197 @@
+from typing import Dict, Tuple, List, Union
+from bisect import bisect_left
+from threading import Lock
+import time
+
+"""
+In-process latency histograms and counters
+
+Everything is aggregated in memory with fixed buckets, nothing is logged per message.
+Use snapshot() to query from code and export_prometheus() to expose in Prometheus text format.
+"""
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                              30.0, float('inf'))
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum', 'max', 'lock')
+
+    def __init__(self):
+        self.counts: List[int] = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: 0 to 1
+        :return: upper bound of the bucket that contains the quantile, max value for the last bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        accumulated = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            accumulated += count
+            if accumulated >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class FunctionStats:
+    __slots__ = ('calls', 'total', 'max', 'timeouts', 'lock')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.timeouts = 0
+        self.lock = Lock()
+
+    def record(self, seconds: float, timed_out: bool = False):
+        with self.lock:
+            self.calls += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            if timed_out:
+                self.timeouts += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str], Histogram] = dict()  # (stage, driver) -> histogram
+        self.counters: Dict[Tuple[str, str], int] = dict()          # (name, driver) -> count
+        self.gauges: Dict[Tuple[str, str], float] = dict()          # (name, driver) -> current value
+        self.functions: Dict[Tuple[str, str], FunctionStats] = dict()  # (kind, qualified name) -> stats
+        self.lock = Lock()
+
+    def histogram(self, stage: str, driver: str) -> Histogram:
+        histogram = self.histograms.get((stage, driver))
+        if not histogram:
+            with self.lock:
+                histogram = self.histograms.setdefault((stage, driver), Histogram())
+        return histogram
+
+    def timer(self, stage: str, driver: str) -> Timer:
+        """
+        measure the time of a with block
+        :param stage: name of the stage, e.g. send
+        :param driver: driver name
+        """
+        return Timer(self.histogram(stage, driver))
+
+    def observe(self, stage: str, driver: str, seconds: float):
+        self.histogram(stage, driver).observe(seconds)
+
+    def increase(self, name: str, driver: str, value: int = 1):
+        with self.lock:
+            self.counters[(name, driver)] = self.counters.get((name, driver), 0) + value
+
+    def function(self, kind: str, name: str) -> FunctionStats:
+        """
+        :param kind: e.g. hook, command
+        :param name: qualified function name
+        """
+        stats = self.functions.get((kind, name))
+        if not stats:
+            with self.lock:
+                stats = self.functions.setdefault((kind, name), FunctionStats())
+        return stats
+
+    def set_gauge(self, name: str, driver: str, value: float):
+        self.gauges[(name, driver)] = value
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, Union[int, float]]]]:
+        """
+        :return: {'latency': {'stage/driver': {count, sum, max, p50, p99}}, 'counter': {'name/driver': {value}},
+                  'gauge': {'name/driver': {value}}, 'function': {'kind/name': {calls, total, max, timeouts}}}
+        """
+        latency = dict()
+        for (stage, driver), histogram in list(self.histograms.items()):
+            latency[f'{stage}/{driver}'] = {
+                'count': histogram.count,
+                'sum':   histogram.sum,
+                'max':   histogram.max,
+                'p50':   histogram.quantile(0.5),
+                'p99':   histogram.quantile(0.99),
+            }
+        counter = {f'{name}/{driver}': {'value': value} for (name, driver), value in list(self.counters.items())}
+        gauge = {f'{name}/{driver}': {'value': value} for (name, driver), value in list(self.gauges.items())}
+        function = {f'{kind}/{name}': {'calls': stats.calls, 'total': stats.total, 'max': stats.max,
+                                       'timeouts': stats.timeouts}
+                    for (kind, name), stats in list(self.functions.items())}
+        return {'latency': latency, 'counter': counter, 'gauge': gauge, 'function': function}
+
+    def export_prometheus(self, prefix: str = 'umr') -> str:
+        """
+        :param prefix: metric name prefix
+        :return: all metrics in Prometheus text exposition format
+        """
+        lines = [f'# TYPE {prefix}_stage_latency_seconds histogram']
+        for (stage, driver), histogram in sorted(list(self.histograms.items())):
+            labels = f'stage="{stage}",driver="{driver}"'
+            accumulated = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                accumulated += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{prefix}_stage_latency_seconds_bucket{{{labels},le="{le}"}} {accumulated}')
+            lines.append(f'{prefix}_stage_latency_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{prefix}_stage_latency_seconds_count{{{labels}}} {histogram.count}')
+
+        counters = sorted(list(self.counters.items()))
+        names = sorted(set(name for (name, _), _ in counters))
+        for name in names:
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            for (_name, driver), value in counters:
+                if _name == name:
+                    lines.append(f'{prefix}_{name}_total{{driver="{driver}"}} {value}')
+
+        gauges = sorted(list(self.gauges.items()))
+        names = sorted(set(name for (name, _), _ in gauges))
+        for name in names:
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            for (_name, driver), value in gauges:
+                if _name == name:
+                    lines.append(f'{prefix}_{name}{{driver="{driver}"}} {value}')
+
+        functions = sorted(list(self.functions.items()))
+        for name, metric_type, attribute in (('function_calls_total', 'counter', 'calls'),
+                                             ('function_seconds_total', 'counter', 'total'),
+                                             ('function_max_seconds', 'gauge', 'max'),
+                                             ('function_timeouts_total', 'counter', 'timeouts')):
+            if functions:
+                lines.append(f'# TYPE {prefix}_{name} {metric_type}')
+            for (kind, function), stats in functions:
+                lines.append(f'{prefix}_{name}{{kind="{kind}",function="{function}"}} {getattr(stats, attribute)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,148 @@
+from typing import Dict, Union
+from threading import Lock
+import asyncio
+import time
+from .UMRType import ChatType, GroupID
+from . import UMRConfig
+from . import UMRLogging
+
+logger = UMRLogging.get_logger('RateLimit')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        """
+        Thread safe token bucket, tokens are reserved in advance so waiters are served in order
+        The bucket is kept as the time it will be full again (GCRA), which is in the future while tokens are used
+
+        :param rate: tokens per second, 0 for unlimited
+        :param capacity: max tokens that can be saved for burst
+        """
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.interval = 1 / rate if rate else 0.0
+        self.full_at = time.monotonic()
+        self.lock = Lock()
+
+        # statistics
+        self.throttled = 0         # number of delayed requests
+        self.throttle_time = 0.0   # total delay in seconds
+
+    def _available_at(self, now: float) -> float:
+        # earliest time when at least one token is in the bucket
+        return max(now, self.full_at - (self.capacity - 1) * self.interval)
+
+    def reserve(self) -> float:
+        """
+        take one token, the bucket may go into debt
+        :return: seconds to wait before the token can be used
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            available_at = self._available_at(now)
+            self.full_at = max(self.full_at, available_at) + self.interval
+            delay = available_at - now
+            if delay > 0:
+                self.throttled += 1
+                self.throttle_time += delay
+            return delay
+
+    def defer(self, delay: float):
+        """
+        the token taken by the last reserve is used later than reserved, e.g. while waiting for another bucket
+        :param delay: seconds from now until the token is used
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            self.full_at = max(self.full_at, time.monotonic() + delay + self.interval)
+
+    def peek(self) -> float:
+        """
+        :return: seconds until a token is available, 0 if there is one, nothing is taken
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            return self._available_at(now) - now
+
+    def try_acquire(self) -> float:
+        """
+        take one token only if there is one, the bucket never goes into debt
+        :return: 0 if the token is taken, otherwise seconds until a token is available
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            available_at = self._available_at(now)
+            if available_at > now:
+                self.throttled += 1
+                return available_at - now
+            self.full_at = max(self.full_at, now) + self.interval
+            return 0.0
+
+
+class RateLimiter:
+    def __init__(self):
+        """
+        Token buckets per destination driver and per destination chat, configured by RateLimit of each driver
+        """
+        self.driver_buckets: Dict[str, TokenBucket] = dict()
+        self.chat_buckets: Dict[GroupID, TokenBucket] = dict()
+        self.lock = Lock()
+
+    @staticmethod
+    def _driver_config(platform: str) -> UMRConfig.RateLimitConfig:
+        driver_config = UMRConfig.config.Driver.get(platform)
+        if not driver_config:
+            return UMRConfig.RateLimitConfig()
+        return driver_config.RateLimit
+
+    def _get_buckets(self, platform: str, chat_id: Union[int, str], chat_type: ChatType):
+        destination = GroupID(platform=platform, chat_id=chat_id, chat_type=chat_type)
+        driver_bucket = self.driver_buckets.get(platform)
+        chat_bucket = self.chat_buckets.get(destination)
+        if not driver_bucket or not chat_bucket:
+            rate_limit = self._driver_config(platform)
+            with self.lock:
+                driver_bucket = self.driver_buckets.get(platform)
+                if not driver_bucket:
+                    driver_bucket = TokenBucket(rate_limit.Rate, rate_limit.Burst)
+                    self.driver_buckets[platform] = driver_bucket
+                chat_bucket = self.chat_buckets.get(destination)
+                if not chat_bucket:
+                    chat_bucket = TokenBucket(rate_limit.ChatRate, rate_limit.ChatBurst)
+                    self.chat_buckets[destination] = chat_bucket
+        return driver_bucket, chat_bucket
+
+    async def acquire(self, platform: str, chat_id: Union[int, str], chat_type: ChatType):
+        """
+        wait until the message can be sent, messages over the limit are delayed, never dropped
+        the driver token is only taken once the chat allows sending, so a throttled chat does not hold up other
+        chats of the same driver, the chat token is moved to the time the driver allows sending
+        :param platform: dst platform
+        :param chat_id: dst chat id
+        :param chat_type: dst chat type
+        """
+        driver_bucket, chat_bucket = self._get_buckets(platform, chat_id, chat_type)
+        delay = chat_bucket.reserve()
+        if delay > 0:
+            logger.debug(f'Message to ({platform}, {chat_id}, {chat_type}) is delayed for {delay:.3f}s by chat limit')
+            await asyncio.sleep(delay)
+        delay = driver_bucket.reserve()
+        if delay > 0:
+            chat_bucket.defer(delay)
+            logger.debug(f'Message to ({platform}, {chat_id}, {chat_type}) is delayed for {delay:.3f}s by driver limit')
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[Union[str, GroupID], Dict[str, Union[int, float]]]:
+        """
+        :return: number of delayed messages and total delay of every driver (str) and destination chat (GroupID)
+        """
+        buckets = list(self.driver_buckets.items()) + list(self.chat_buckets.items())
+        return {key: {'throttled': bucket.throttled, 'throttle_time': bucket.throttle_time}
+                for key, bucket in buckets}
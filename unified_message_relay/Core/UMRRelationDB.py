@@ -0,0 +1,251 @@
+from typing import Dict, List, Tuple, Union, Optional, Any
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from queue import SimpleQueue, Empty
+import asyncio
+import atexit
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+from .UMRType import ChatType
+from .UMRMessageRelation import RelationStore, RelationGroup, Key, STRIDE
+from . import UMRLogging
+
+"""
+Persistent message relation store
+
+Relations are written to SQLite so replies keep working after restart. The compact in memory store stays in front
+as cache, get only looks at the cache, fetch loads messages not found there on a reader thread and caches them again.
+
+Writes are batched by a writer thread, the send path never waits on disk: a sent copy whose source message is not
+in memory is added by the writer thread. Relations older than TTL are pruned.
+"""
+
+logger = UMRLogging.get_logger('RelationDB')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS message_group (
+    id INTEGER PRIMARY KEY,
+    members TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_group_updated ON message_group (updated);
+CREATE TABLE IF NOT EXISTS message_key (
+    platform TEXT NOT NULL,
+    chat_type TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    group_id INTEGER NOT NULL,
+    PRIMARY KEY (platform, chat_type, chat_id, message_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS message_key_group ON message_key (group_id);
+'''
+
+
+class PersistentRelationGroup(RelationGroup):
+    __slots__ = ('group_id',)
+
+
+def encode_key(key: Key) -> Tuple[str, str, str, str]:
+    platform, chat_type, chat_id, message_id = key
+    return platform, chat_type.value, str(chat_id), str(message_id)
+
+
+def encode_members(members: Tuple) -> str:
+    return json.dumps([i.value if isinstance(i, ChatType) else i for i in members])
+
+
+def decode_members(text: str) -> Tuple:
+    members = json.loads(text)
+    for offset in range(0, len(members), STRIDE):
+        members[offset] = sys.intern(members[offset])
+        members[offset + 1] = ChatType(members[offset + 1])
+    return tuple(members)
+
+
+class PersistentRelationStore(RelationStore):
+    def __init__(self, capacity: int, shards: int, path: str, ttl: float, flush_interval: float, batch_size: int):
+        """
+        :param capacity: number of keys cached in memory
+        :param shards: number of shards in memory
+        :param path: sqlite database file
+        :param ttl: seconds before a relation is pruned, 0 for never
+        :param flush_interval: seconds between batched writes
+        :param batch_size: max relations in one write transaction
+        """
+        super().__init__(capacity, shards)
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.operations: SimpleQueue = SimpleQueue()  # (operation, key, group or (source key, user id))
+
+        # statistics, updated by reader and writer threads
+        self.loaded = 0       # cache misses found on disk
+        self.not_found = 0    # cache misses not found on disk
+        self.stats_lock = Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)  # for reads, guarded by read_lock
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        self.read_lock = Lock()
+        self.reader = ThreadPoolExecutor(1, thread_name_prefix='RelationReader')
+        last_id = self.connection.execute('SELECT MAX(id) FROM message_group').fetchone()[0] or 0
+        self.ids = itertools.count(last_id + 1)
+
+        self.writer = Thread(target=self.write, name='RelationWriter', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _new_group(self, platform: str, chat_type: ChatType, chat_id: Union[int, str], message_id: Union[int, str],
+                   user_id: Union[int, str]) -> PersistentRelationGroup:
+        group = PersistentRelationGroup(platform, chat_type, chat_id, message_id, user_id)
+        group.group_id = next(self.ids)
+        return group
+
+    def set_ingress(self, platform: str, chat_type: ChatType, chat_id: Union[int, str], message_id: Union[int, str],
+                    user_id: Union[int, str]) -> Optional[RelationGroup]:
+        group = super().set_ingress(platform, chat_type, chat_id, message_id, user_id)
+        if group:
+            self.operations.put(('write', (platform, chat_type, chat_id, message_id), group))
+        return group
+
+    def set_egress(self, src_key: Key, platform: str, chat_type: ChatType, chat_id: Union[int, str],
+                   message_id: Union[int, str], user_id: Union[int, str]) -> Optional[RelationGroup]:
+        """
+        :return: group of the source message, None if it is not in memory, then the writer thread looks it up on disk
+        """
+        key = (platform, chat_type, chat_id, message_id)
+        group = super().set_egress(src_key, platform, chat_type, chat_id, message_id, user_id)
+        if group:
+            self.operations.put(('write', key, group))
+        else:
+            self.operations.put(('egress', key, (src_key, user_id)))
+        return group
+
+    async def fetch(self, key: Key) -> Optional[RelationGroup]:
+        group = self.get(key)
+        if group:
+            return group
+        return await asyncio.get_event_loop().run_in_executor(self.reader, self._load, key)
+
+    def _load(self, key: Key, connection: Optional[sqlite3.Connection] = None) -> Optional[RelationGroup]:
+        """
+        :param connection: connection owned by the calling thread, shared read connection if None
+        """
+        query = 'SELECT g.id, g.members FROM message_key k JOIN message_group g ON g.id = k.group_id ' \
+                'WHERE k.platform = ? AND k.chat_type = ? AND k.chat_id = ? AND k.message_id = ?'
+        if connection:
+            row = connection.execute(query, encode_key(key)).fetchone()
+        else:
+            with self.read_lock:
+                row = self.connection.execute(query, encode_key(key)).fetchone()
+        with self.stats_lock:
+            if not row:
+                self.not_found += 1
+                return None
+            self.loaded += 1
+
+        group = PersistentRelationGroup.__new__(PersistentRelationGroup)
+        group.group_id, group.members = row[0], decode_members(row[1])
+        members = group.members
+        source_key = (members[0], members[1], members[2], members[3])
+        shard = self.shard_of(source_key)
+        with shard.lock:
+            cached = shard.groups.get(source_key)
+            if cached:  # loaded by another thread meanwhile
+                return cached
+            shard.insert(source_key, group)
+        for offset in range(STRIDE, len(members), STRIDE):
+            member_key = (members[offset], members[offset + 1], members[offset + 2], members[offset + 3])
+            shard = self.shard_of(member_key)
+            with shard.lock:
+                shard.insert(member_key, group)
+        return group
+
+    # region writer
+
+    def write(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        prune_interval = min(self.ttl / 10, 3600)
+        next_prune = time.monotonic()
+        stopped = False
+        while not stopped:
+            operations = list()
+            try:
+                operations.append(self.operations.get(timeout=prune_interval or None))
+                deadline = time.monotonic() + self.flush_interval
+                while len(operations) < self.batch_size and operations[-1][0] != 'stop':
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    operations.append(self.operations.get(timeout=timeout))
+            except Empty:
+                pass
+            if operations and operations[-1][0] == 'stop':
+                operations.pop()
+                stopped = True
+            try:
+                self._flush(connection, operations)
+                if self.ttl and time.monotonic() >= next_prune:
+                    self._prune(connection)
+                    next_prune = time.monotonic() + prune_interval
+            except Exception:
+                logger.exception(f'Failed to write {len(operations)} message relations')
+        connection.close()
+
+    def _flush(self, connection: sqlite3.Connection, operations: List[Tuple[str, Key, Any]]):
+        if not operations:
+            return
+        now = time.time()
+        groups: Dict[int, PersistentRelationGroup] = dict()
+        batch: Dict[Key, PersistentRelationGroup] = dict()  # written in this batch, may be evicted from memory
+        keys = list()
+        for operation, key, group in operations:
+            if operation == 'egress':  # source message was not in memory when the copy was sent
+                src_key, user_id = group
+                group = batch.get(src_key) or self.get(src_key) or self._load(src_key, connection)
+                if not group:  # message relation not found
+                    continue
+                self._add(group, key[0], key[1], key[2], key[3], user_id)
+            batch[key] = group
+            groups[group.group_id] = group
+            keys.append(encode_key(key) + (group.group_id,))
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO message_group VALUES (?, ?, ?)',
+                                   [(group_id, encode_members(group.members), now)
+                                    for group_id, group in groups.items()])
+            connection.executemany('INSERT OR REPLACE INTO message_key VALUES (?, ?, ?, ?, ?)', keys)
+
+    def _prune(self, connection: sqlite3.Connection):
+        expired = time.time() - self.ttl
+        with connection:
+            connection.execute('DELETE FROM message_key WHERE group_id IN '
+                               '(SELECT id FROM message_group WHERE updated < ?)', (expired,))
+            removed = connection.execute('DELETE FROM message_group WHERE updated < ?', (expired,)).rowcount
+        if removed:
+            logger.debug(f'Pruned {removed} expired message relations')
+
+    def close(self):
+        """
+        stop the writer after it wrote remaining relations, called at exit
+        """
+        self.reader.shutdown()
+        if not self.writer.is_alive():
+            return
+        self.operations.put(('stop', None, None))
+        self.writer.join()
+
+    # endregion
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: cached keys, cache misses loaded from disk and cache misses not found
+        """
+        with self.stats_lock:
+            return {'cached': len(self), 'loaded': self.loaded, 'not_found': self.not_found}
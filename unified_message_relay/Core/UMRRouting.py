@@ -0,0 +1,175 @@
+from typing import Dict, List, Tuple, Union, Optional, Mapping
+from types import MappingProxyType
+from .UMRType import ForwardAction, ForwardActionType, DefaultForwardAction, DefaultForwardActionType, ChatType, \
+    ForwardTypeEnum, DefaultForwardTypeEnum
+from . import UMRLogging
+
+logger = UMRLogging.get_logger('Routing')
+
+_EMPTY_MAPPING: Mapping = MappingProxyType(dict())
+
+
+class Route:
+    """
+    Compiled forward actions of one source chat, immutable after compiling
+    """
+    __slots__ = ('forward_all', 'reply_only', 'block', 'reply_targets')
+
+    def __init__(self, forward_all: Tuple[ForwardAction, ...] = (), reply_only: Tuple[ForwardAction, ...] = (),
+                 block: Tuple[ForwardAction, ...] = (),
+                 reply_targets: Mapping[str, Mapping[Union[int, str], ForwardActionType]] = _EMPTY_MAPPING):
+        """
+        :param forward_all: destinations that receive every message
+        :param reply_only: destinations that only receive replies to forwarded messages
+        :param block: destinations that receive nothing
+        :param reply_targets: platform -> chat id -> action type of the first action to that chat
+        """
+        self.forward_all = forward_all
+        self.reply_only = reply_only
+        self.block = block
+        self.reply_targets = reply_targets
+
+    def __bool__(self):
+        return bool(self.forward_all or self.reply_only or self.block)
+
+    def reply_action(self, platform: str, chat_id: Union[int, str]) -> Optional[ForwardActionType]:
+        """
+        :param platform: platform of the replied message
+        :param chat_id: chat of the replied message
+        :return: action type towards that chat, None if not bridged
+        """
+        return self.reply_targets.get(platform, _EMPTY_MAPPING).get(chat_id)
+
+
+EMPTY_ROUTE = Route()
+
+
+class RoutingTable:
+    def __init__(self, forward_list):
+        """
+        Compile ForwardList config into a read only routing table
+        All lookups are nested dict hits, no object is allocated and unknown chats are not inserted
+
+        :param forward_list: ForwardList section of config
+        """
+        routes: Dict[str, Dict[Union[int, str], Dict[ChatType, List[ForwardAction]]]] = dict()
+        default_actions: Dict[str, Dict[Tuple[str, Union[int, str], ChatType], DefaultForwardAction]] = dict()
+
+        def add_action(src_platform, src_chat, src_chat_type, action: ForwardAction):
+            routes.setdefault(src_platform, dict()).setdefault(src_chat, dict()).setdefault(
+                src_chat_type, list()).append(action)
+
+        for i in forward_list.Topology:
+
+            # Add action
+            # BiDirection = two ALL
+            # OneWay      = one All
+            # OneWay+     = one All + one Reply
+
+            # ForwardType.All: From one platform to another, forward all message
+            # ForwardType.Reply: From one platform to another, forward only replied message
+
+            if i.ForwardType == ForwardTypeEnum.BiDirection:
+                forward_action_type = ForwardActionType.ForwardAll
+                backward_action_type = ForwardActionType.ForwardAll
+            elif i.ForwardType == ForwardTypeEnum.OneWayPlus:
+                forward_action_type = ForwardActionType.ForwardAll
+                backward_action_type = ForwardActionType.ReplyOnly
+            elif i.ForwardType == ForwardTypeEnum.OneWay:
+                forward_action_type = ForwardActionType.ForwardAll
+                backward_action_type = ForwardActionType.Block
+            else:
+                logger.warning(f'Unrecognized ForwardType in config: "{i.ForwardType}", ignoring')
+                continue
+            add_action(i.From, i.FromChat, i.FromChatType,
+                       ForwardAction(to_platform=i.To,
+                                     to_chat=i.ToChat,
+                                     chat_type=i.ToChatType,
+                                     action_type=forward_action_type))
+            add_action(i.To, i.ToChat, i.ToChatType,
+                       ForwardAction(to_platform=i.From,
+                                     to_chat=i.FromChat,
+                                     chat_type=i.FromChatType,
+                                     action_type=backward_action_type))
+
+        for i in forward_list.Default:
+
+            # Add action
+            # OneWay      = one All
+            # OneWay+     = one All + one Reply
+
+            # ForwardType.All: From one platform to another, forward all message, accept reply backward
+            # ForwardType.Reply: From one platform to another, forward all message, reject reply backward
+
+            if i.ForwardType == DefaultForwardTypeEnum.OneWayPlus:
+                action_type = DefaultForwardActionType.OneWayWithReply
+            elif i.ForwardType == DefaultForwardTypeEnum.OneWay:
+                action_type = DefaultForwardActionType.OneWay
+            else:
+                logger.warning(f'Unrecognized ForwardType in config: "{i.ForwardType}", ignoring')
+                continue
+            default_actions.setdefault(i.From, dict())[(i.To, i.ToChat, i.ToChatType)] = \
+                DefaultForwardAction(to_platform=i.To,
+                                     to_chat=i.ToChat,
+                                     chat_type=i.ToChatType,
+                                     action_type=action_type)
+
+        # freeze
+        self._routes: Mapping[str, Mapping[Union[int, str], Mapping[ChatType, Route]]] = MappingProxyType({
+            platform: MappingProxyType({
+                chat_id: MappingProxyType({
+                    chat_type: self._compile_route(actions)
+                    for chat_type, actions in chat_types.items()})
+                for chat_id, chat_types in chats.items()})
+            for platform, chats in routes.items()})
+
+        self._default_actions: Mapping[str, Tuple[DefaultForwardAction, ...]] = MappingProxyType({
+            platform: tuple(actions.values()) for platform, actions in default_actions.items()})
+
+        # src platform -> dst platform -> dst chat id -> dst chat type -> action
+        default_index: Dict[str, Dict[str, Dict[Union[int, str], Dict[ChatType, DefaultForwardAction]]]] = dict()
+        for platform, actions in default_actions.items():
+            for action in actions.values():
+                default_index.setdefault(platform, dict()).setdefault(action.to_platform, dict()).setdefault(
+                    action.to_chat, dict())[action.chat_type] = action
+        self._default_index = MappingProxyType({
+            platform: MappingProxyType({
+                dst_platform: MappingProxyType({
+                    chat_id: MappingProxyType(chat_types)
+                    for chat_id, chat_types in chats.items()})
+                for dst_platform, chats in dst_platforms.items()})
+            for platform, dst_platforms in default_index.items()})
+
+    @staticmethod
+    def _compile_route(actions) -> Route:
+        reply_targets: Dict[str, Dict[Union[int, str], ForwardActionType]] = dict()
+        for action in actions:
+            # the first action to the same chat wins, same as scanning the action list
+            reply_targets.setdefault(action.to_platform, dict()).setdefault(action.to_chat, action.action_type)
+        return Route(
+            forward_all=tuple(i for i in actions if i.action_type == ForwardActionType.ForwardAll),
+            reply_only=tuple(i for i in actions if i.action_type == ForwardActionType.ReplyOnly),
+            block=tuple(i for i in actions if i.action_type == ForwardActionType.Block),
+            reply_targets=MappingProxyType({platform: MappingProxyType(chats)
+                                            for platform, chats in reply_targets.items()}))
+
+    def route(self, platform: str, chat_id: Union[int, str], chat_type: ChatType) -> Route:
+        """
+        :return: compiled route of the source chat, EMPTY_ROUTE if the chat is not bridged
+        """
+        return self._routes.get(platform, _EMPTY_MAPPING).get(chat_id, _EMPTY_MAPPING).get(chat_type, EMPTY_ROUTE)
+
+    def default_actions(self, platform: str) -> Tuple[DefaultForwardAction, ...]:
+        """
+        :param platform: source platform
+        :return: default actions of the source platform
+        """
+        return self._default_actions.get(platform, ())
+
+    def default_action(self, src_platform: str, dst_platform: str, dst_chat_id: Union[int, str],
+                       dst_chat_type: ChatType) -> Optional[DefaultForwardAction]:
+        """
+        :return: default action from src_platform to the destination chat, None if not defined
+        """
+        return self._default_index.get(src_platform, _EMPTY_MAPPING).get(dst_platform, _EMPTY_MAPPING).get(
+            dst_chat_id, _EMPTY_MAPPING).get(dst_chat_type)
@@ -0,0 +1,169 @@
+from typing import Dict, Callable, Awaitable, Tuple, Union, Optional
+from dataclasses import dataclass
+from threading import Lock
+import asyncio
+import time
+from .UMRType import UnifiedMessage, ChatType, GroupID, QueueOverflowPolicy
+from .UMRMetrics import metrics
+from . import UMRLogging
+
+"""
+Outbound stage between dispatcher and driver
+
+Every destination chat has its own bounded queue and worker, messages to the same chat are sent in order,
+a slow or rate limited chat only holds up its own queue.
+Depth of every queue is exported as gauge send_queue_depth and wait time as histogram send_queue_wait,
+labeled with platform:chat_type:chat_id of the destination.
+"""
+
+logger = UMRLogging.get_logger('SendQueue')
+
+Sender = Callable[..., Awaitable]  # (message, platform, chat_id, chat_type, journal_id=)
+Discard = Callable[[int], None]  # (journal_id), called for journaled messages dropped by overflow policy
+
+
+@dataclass
+class SendQueueStats:
+    """
+    Counters of one destination queue, wait time is measured from enqueue to the start of sending
+    """
+    depth: int = 0
+    enqueued: int = 0
+    sent: int = 0
+    failed: int = 0
+    dropped: int = 0
+    last_wait: float = 0.0
+    max_wait: float = 0.0
+    total_wait: float = 0.0
+
+    @property
+    def average_wait(self) -> float:
+        if not self.sent + self.failed:
+            return 0.0
+        return self.total_wait / (self.sent + self.failed)
+
+
+class DestinationQueue:
+    def __init__(self, destination: GroupID, sender: Sender, max_size: int, overflow_policy: QueueOverflowPolicy,
+                 discard: Optional[Discard] = None):
+        """
+        Must be created inside the event loop that will run the worker
+
+        :param destination: destination chat
+        :param sender: coroutine function that actually sends the message
+        :param max_size: queue bound, 0 for unbounded
+        :param overflow_policy: what to do when the queue is full
+        :param discard: called with journal id of dropped messages
+        """
+        self.destination = destination
+        self.sender = sender
+        self.discard = discard
+        self.overflow_policy = overflow_policy
+        self.stats = SendQueueStats()
+        self.label = f'{destination.platform}:{destination.chat_type.value}:{destination.chat_id}'
+        self.loop = asyncio.get_event_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self.worker = self.loop.create_task(self.work())
+
+    async def put(self, message: UnifiedMessage, journal_id: int = 0):
+        """
+        enqueue message, can be called from any event loop
+        :param message: message to send
+        :param journal_id: id in outbound journal, 0 if not journaled
+        """
+        if asyncio.get_event_loop() is self.loop:
+            await self._put(message, journal_id)
+        else:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._put(message, journal_id), self.loop))
+
+    async def _put(self, message: UnifiedMessage, journal_id: int):
+        item = (message, journal_id, time.monotonic())
+        if self.queue.full():
+            if self.overflow_policy == QueueOverflowPolicy.DROP_NEWEST:
+                self._drop(journal_id)
+                logger.debug(f'Queue to {self.destination} is full, dropping incoming message')
+                return
+            elif self.overflow_policy == QueueOverflowPolicy.DROP_OLDEST:
+                _, dropped_journal_id, _ = self.queue.get_nowait()
+                self.queue.task_done()
+                self._drop(dropped_journal_id)
+                logger.debug(f'Queue to {self.destination} is full, dropping oldest message')
+
+        await self.queue.put(item)
+        self.stats.enqueued += 1
+        self._set_depth()
+
+    def _set_depth(self):
+        self.stats.depth = self.queue.qsize()
+        metrics.set_gauge('send_queue_depth', self.label, self.stats.depth)
+
+    def _drop(self, journal_id: int):
+        self.stats.dropped += 1
+        if journal_id and self.discard:  # dropped on purpose, must not be replayed
+            self.discard(journal_id)
+
+    async def work(self):
+        while True:
+            message, journal_id, enqueued_at = await self.queue.get()
+            self._set_depth()
+            wait = time.monotonic() - enqueued_at
+            metrics.observe('send_queue_wait', self.label, wait)
+            self.stats.last_wait = wait
+            self.stats.total_wait += wait
+            if wait > self.stats.max_wait:
+                self.stats.max_wait = wait
+            try:
+                await self.sender(message, self.destination.platform, self.destination.chat_id,
+                                  self.destination.chat_type, journal_id=journal_id)
+                self.stats.sent += 1
+            except Exception:
+                self.stats.failed += 1
+                logger.exception(f'Failed to send message to {self.destination}')
+            finally:
+                self.queue.task_done()
+
+
+class SendQueues:
+    def __init__(self, sender: Sender, max_size: int, overflow_policy: QueueOverflowPolicy,
+                 discard: Optional[Discard] = None):
+        """
+        Lazily created queues for every destination
+
+        :param sender: coroutine function that actually sends the message
+        :param max_size: bound of each queue, 0 for unbounded
+        :param overflow_policy: what to do when a queue is full
+        :param discard: called with journal id of dropped messages
+        """
+        self.sender = sender
+        self.discard = discard
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.queues: Dict[GroupID, DestinationQueue] = dict()
+        self.lock = Lock()  # drivers may dispatch from different threads
+
+    async def put(self, message: UnifiedMessage, platform: str, chat_id: Union[int, str], chat_type: ChatType,
+                  journal_id: int = 0):
+        """
+        enqueue message to the queue of its destination
+        :param message: message to send
+        :param platform: dst platform
+        :param chat_id: dst chat id
+        :param chat_type: dst chat type
+        :param journal_id: id in outbound journal, 0 if not journaled
+        """
+        destination = GroupID(platform=platform, chat_id=chat_id, chat_type=chat_type)
+        queue = self.queues.get(destination)
+        if not queue:
+            with self.lock:
+                queue = self.queues.get(destination)
+                if not queue:
+                    queue = DestinationQueue(destination, self.sender, self.max_size, self.overflow_policy,
+                                             self.discard)
+                    self.queues[destination] = queue
+        await queue.put(message, journal_id)
+
+    def stats(self) -> Dict[GroupID, SendQueueStats]:
+        """
+        :return: counters of every destination queue
+        """
+        return {destination: queue.stats for destination, queue in list(self.queues.items())}
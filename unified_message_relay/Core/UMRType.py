@@ -1,6 +1,7 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import List, Callable, FrozenSet, Union
+from copy import copy, deepcopy
+from typing import List, Callable, FrozenSet, Union, Tuple, Optional
 from enum import Enum, auto, Flag
 
 
@@ -11,6 +12,24 @@ class LogLevel(str, Enum):
     DEBUG = 'DEBUG'
 
 
+class QueueOverflowPolicy(str, Enum):
+    """
+    What to do when a bounded queue is full
+    """
+    BLOCK = 'block'              # wait until there is space
+    DROP_OLDEST = 'drop-oldest'  # discard the oldest queued item
+    DROP_NEWEST = 'drop-newest'  # discard the incoming item
+
+
+class CircuitState(str, Enum):
+    """
+    State of the circuit breaker of a destination driver
+    """
+    CLOSED = 'closed'        # sending normally
+    OPEN = 'open'            # driver is failing, sends fail fast until cooldown ends
+    HALF_OPEN = 'half-open'  # cooldown ended, one probe send is allowed
+
+
 class ChatType(str, Enum):
     """
     Command filter option
@@ -129,6 +148,8 @@ class UnifiedMessage:
     image: str  # path of the image or download url
     file_id: str  # unique file identifier
     send_action: SendAction
+    path: Tuple[GroupID, ...]  # chats this message passed through, starting from its origin
+    hops: int  # times this message was relayed, drivers may carry it across platforms
 
     def __init__(self, text: str = '', message_entities=None, image='', file_id='', platform='', chat_id=0, chat_type=ChatType.UNSPECIFIED,
                  name='', user_id=0, message_id: int = 0):
@@ -146,6 +167,76 @@ class UnifiedMessage:
                                         name=name,
                                         user_id=user_id,
                                         message_id=message_id)
+        self.path = ()
+        self.hops = 0
+
+    @property
+    def origin(self) -> Optional[GroupID]:
+        """
+        chat where this message was first received, None before dispatch
+        """
+        return self.path[0] if self.path else None
+
+    def snapshot(self) -> UnifiedMessage:
+        """
+        :return: detached copy, changes to either message do not affect the other
+        """
+        message = UnifiedMessage()
+        message.chat_attrs = deepcopy(self.chat_attrs)
+        message.text = self.text
+        message.text_entities = [copy(i) for i in self.text_entities]
+        message.image = self.image
+        message.file_id = self.file_id
+        message.send_action = copy(self.send_action)
+        message.path = self.path
+        message.hops = self.hops
+        return message
+
+
+def _copy_chat_attrs(chat_attrs: ChatAttribute) -> ChatAttribute:
+    chat_attrs = copy(chat_attrs)
+    if chat_attrs.forward_from:
+        chat_attrs.forward_from = _copy_chat_attrs(chat_attrs.forward_from)
+    if chat_attrs.reply_to:
+        chat_attrs.reply_to = _copy_chat_attrs(chat_attrs.reply_to)
+    return chat_attrs
+
+
+class UnifiedMessageView(UnifiedMessage):
+    """
+    Per destination overlay of UnifiedMessage
+    Unset attributes are read from the original message, assigned attributes only change this view.
+    Mutable attributes (chat_attrs, text_entities, send_action) are copied into the view on first access,
+    so hooks of one destination can modify them in place without affecting other destinations.
+    """
+
+    # attribute name -> copy function, applied once when read through the view
+    copied_attributes = {
+        'chat_attrs':    _copy_chat_attrs,
+        'text_entities': lambda text_entities: [copy(i) for i in text_entities],
+        'send_action':   copy,
+    }
+
+    def __init__(self, message: UnifiedMessage, **overrides):
+        """
+        UnifiedMessage.__init__ is not called, attributes not in overrides are read from message
+
+        :param message: original message
+        :param overrides: per destination attributes, e.g. send_action, chat_attrs, image
+        """
+        self.__dict__['_base'] = message
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        # only called for attributes not overridden by this view
+        if name == '_base':
+            raise AttributeError(name)
+        value = getattr(self._base, name)
+        copy_function = self.copied_attributes.get(name)
+        if copy_function:
+            value = copy_function(value)
+            self.__dict__[name] = value
+        return value
 
 
 @dataclass
@@ -227,9 +318,11 @@ class MessageHook:
     dst_chat: FrozenSet[int]
     dst_chat_type: FrozenSet[ChatType]
     hook_function: Callable
+    timeout: Optional[float]  # None for Dispatch.HookTimeout, 0 for no limit
 
     def __init__(self, src_driver: Union[str, List[str]], src_chat: Union[int, List[int]], src_chat_type: Union[ChatType, List[ChatType]],
-                 dst_driver: Union[str, List[str]], dst_chat: Union[int, List[int]], dst_chat_type: Union[ChatType, List[ChatType]], hook_function: Callable):
+                 dst_driver: Union[str, List[str]], dst_chat: Union[int, List[int]], dst_chat_type: Union[ChatType, List[ChatType]], hook_function: Callable,
+                 timeout: Optional[float] = None):
         if isinstance(src_driver, str):
             if src_driver:
                 self.src_driver = frozenset([src_driver])
@@ -237,7 +330,7 @@ class MessageHook:
                 self.src_driver = frozenset()
         else:
             self.src_driver = frozenset(src_driver)
-        if isinstance(src_chat, int):
+        if isinstance(src_chat, (int, str)):
             if src_chat:
                 self.src_chat = frozenset([src_chat])
             else:
@@ -255,7 +348,7 @@ class MessageHook:
                 self.dst_driver = frozenset()
         else:
             self.dst_driver = frozenset(dst_driver)
-        if isinstance(dst_chat, int):
+        if isinstance(dst_chat, (int, str)):
             if dst_chat:
                 self.dst_chat = frozenset([dst_chat])
             else:
@@ -267,6 +360,7 @@ class MessageHook:
         else:
             self.dst_chat_type = frozenset(dst_chat_type)
         self.hook_function = hook_function
+        self.timeout = timeout
 
 
 @dataclass
@@ -279,9 +373,12 @@ class Command:
     privilege: Privilege
     chat_type: ChatType
     command_function: Callable
+    timeout: Optional[float]  # None for Dispatch.CommandTimeout, 0 for no limit
+    background: bool  # run on command pool instead of dispatch loop
 
     def __init__(self, platform: Union[str, List[str]] = '', description='', chat_type=ChatType.UNSPECIFIED,
-                 privilege=Privilege.UNSPECIFIED, command_function=None):
+                 privilege=Privilege.UNSPECIFIED, command_function=None, timeout: Optional[float] = None,
+                 background: bool = False):
         if isinstance(platform, str):
             if platform:
                 self.platform = frozenset([platform])
@@ -293,6 +390,8 @@ class Command:
         self.chat_type = chat_type
         self.privilege = privilege
         self.command_function = command_function
+        self.timeout = timeout
+        self.background = background
 
 
 @dataclass(frozen=True)
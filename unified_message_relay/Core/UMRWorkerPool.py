@@ -0,0 +1,84 @@
+from typing import Callable, Awaitable, Dict
+from threading import Thread, Lock
+import asyncio
+from . import UMRLogging
+
+"""
+Bounded background worker pool
+
+A daemon thread with its own event loop runs a fixed number of worker tasks. Jobs are submitted from any thread
+or loop without waiting, jobs over the queue limit are dropped and counted.
+"""
+
+logger = UMRLogging.get_logger('WorkerPool')
+
+
+class WorkerPool:
+    def __init__(self, name: str, workers: int, max_pending: int):
+        """
+        Start the pool thread
+
+        :param name: pool name, used in thread name and logs
+        :param workers: number of jobs running at the same time
+        :param max_pending: max queued and running jobs, 0 for unbounded
+        """
+        self.name = name
+        self.workers = max(workers, 1)
+        self.max_pending = max_pending
+        self.lock = Lock()
+
+        # statistics
+        self.pending = 0     # queued and running jobs
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.queue: asyncio.Queue = None
+        started = Lock()
+        started.acquire()
+        self.thread = Thread(target=self.run, args=(started,), name=f'WorkerPool-{name}', daemon=True)
+        self.thread.start()
+        started.acquire()  # queue must exist before the first submit
+
+    def run(self, started: Lock):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        for _ in range(self.workers):
+            self.loop.create_task(self.work())
+        started.release()
+        self.loop.run_forever()
+
+    async def work(self):
+        while True:
+            function, args = await self.queue.get()
+            try:
+                await function(*args)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f'Job {function.__qualname__} in pool {self.name} failed')
+            finally:
+                with self.lock:
+                    self.pending -= 1
+
+    def submit(self, function: Callable[..., Awaitable], *args) -> bool:
+        """
+        queue a job without waiting, can be called from any thread
+        :param function: coroutine function
+        :param args: positional args to pass
+        :return: False if the job is dropped because the pool is full
+        """
+        with self.lock:
+            if self.max_pending and self.pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            self.pending += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (function, args))
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: pending, processed, failed and dropped jobs
+        """
+        return {'pending': self.pending, 'processed': self.processed, 'failed': self.failed, 'dropped': self.dropped}
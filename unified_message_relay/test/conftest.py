@@ -0,0 +1,31 @@
+"""
+Tests run against a generated config in a temporary home directory, the real ~/.umr/config.yaml is not touched.
+UMRConfig loads the config on import, so the home directory is set up before any test module imports Core.
+"""
+import os
+import tempfile
+from typing import Callable
+import pytest
+import yaml
+
+root = tempfile.mkdtemp(prefix='umr-test-')
+os.makedirs(os.path.join(root, '.umr'))
+with open(os.path.join(root, '.umr', 'config.yaml'), 'w') as f:
+    yaml.safe_dump({'DataRoot': root, 'LogRoot': root, 'ForwardList': {}}, f)
+os.environ['HOME'] = root
+
+
+@pytest.fixture
+def message() -> Callable[..., 'UnifiedMessage']:
+    """
+    factory of received messages, a text message from user 1 in QQ group -100 unless told otherwise
+    other keyword arguments are passed to UnifiedMessage, e.g. message_entities, name
+    """
+    from unified_message_relay.Core.UMRType import UnifiedMessage, ChatType
+
+    def factory(text: str = 'hello', platform: str = 'QQ', chat_id=-100, chat_type: ChatType = ChatType.GROUP,
+                user_id=1, message_id: int = 0, **kwargs) -> UnifiedMessage:
+        return UnifiedMessage(text=text, platform=platform, chat_id=chat_id, chat_type=chat_type, user_id=user_id,
+                              message_id=message_id, **kwargs)
+
+    return factory
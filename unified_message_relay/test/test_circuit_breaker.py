@@ -0,0 +1,159 @@
+import asyncio
+import concurrent.futures
+import threading
+import pytest
+from unified_message_relay.Core import UMRCircuitBreaker
+from unified_message_relay.Core.UMRCircuitBreaker import CircuitBreaker, CircuitBreakers, CircuitOpenError
+from unified_message_relay.Core.UMRType import CircuitState
+
+
+def breakers(failure_threshold: int = 2, cooldown: float = 0.05, timeout: float = 0) -> CircuitBreakers:
+    result = CircuitBreakers()
+    result.breakers['QQ'] = CircuitBreaker('QQ', failure_threshold, cooldown, timeout)
+    return result
+
+
+async def fail():
+    raise ValueError('send failed')
+
+
+async def succeed():
+    return 'sent'
+
+
+def test_opens_after_threshold_and_recovers_after_probe():
+    async def main():
+        circuit_breakers = breakers()
+        breaker = circuit_breakers.get('QQ')
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                await circuit_breakers.call('QQ', fail)
+        assert breaker.state == CircuitState.OPEN
+        with pytest.raises(CircuitOpenError):
+            await circuit_breakers.call('QQ', succeed)
+        assert not circuit_breakers.ready('QQ')
+
+        await asyncio.sleep(0.06)
+        assert breaker.allow()  # probe
+        assert breaker.state == CircuitState.HALF_OPEN
+        assert not breaker.allow()  # one probe at a time
+        breaker.record_success()
+        assert breaker.state == CircuitState.CLOSED
+        assert await circuit_breakers.call('QQ', succeed) == 'sent'
+
+    asyncio.run(main())
+
+
+def test_failed_probe_opens_again():
+    breaker = CircuitBreaker('QQ', failure_threshold=1, cooldown=0, timeout=0)
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.opened == 2
+
+
+def test_cancelled_probe_is_released():
+    async def main():
+        circuit_breakers = breakers(failure_threshold=1, cooldown=0)
+        breaker = circuit_breakers.get('QQ')
+        breaker.record_failure()
+        task = asyncio.ensure_future(circuit_breakers.call('QQ', asyncio.sleep, 1))
+        await asyncio.sleep(0)
+        assert breaker.probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not breaker.probing
+
+    asyncio.run(main())
+
+
+def test_timeout_counts_as_failure():
+    async def main():
+        circuit_breakers = breakers(failure_threshold=1, timeout=0.01)
+        with pytest.raises(asyncio.TimeoutError):
+            await circuit_breakers.call('QQ', asyncio.sleep, 1)
+        assert circuit_breakers.get('QQ').state == CircuitState.OPEN
+        assert circuit_breakers.get('QQ').timeouts == 1
+
+    asyncio.run(main())
+
+
+def test_future_returned_by_sync_driver_is_awaited():
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def send_returning_future(error: bool):
+        def send():
+            if error:
+                raise ValueError('send failed')
+            return 'sent'
+        return executor.submit(send)
+
+    async def send_hanging():
+        return concurrent.futures.Future()  # never finishes
+
+    async def main():
+        circuit_breakers = breakers(failure_threshold=2, timeout=0.05)
+        assert await circuit_breakers.call('QQ', send_returning_future, False) == 'sent'
+        with pytest.raises(ValueError):
+            await circuit_breakers.call('QQ', send_returning_future, True)
+        with pytest.raises(asyncio.TimeoutError):
+            await circuit_breakers.call('QQ', send_hanging)
+        assert circuit_breakers.get('QQ').state == CircuitState.OPEN
+
+    asyncio.run(main())
+
+
+def test_future_of_other_event_loop_is_awaited():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def send_on_driver_loop():
+        async def send():
+            await asyncio.sleep(0.01)
+            return 'sent'
+        return asyncio.run_coroutine_threadsafe(send(), loop)
+
+    async def send_returning_driver_task():
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(create_task(), loop))
+
+    async def create_task():
+        async def send():
+            await asyncio.sleep(0.01)
+            return 'sent'
+        return asyncio.ensure_future(send())
+
+    async def main():
+        circuit_breakers = breakers()
+        assert await circuit_breakers.call('QQ', send_on_driver_loop) == 'sent'
+        assert await circuit_breakers.call('QQ', send_returning_driver_task) == 'sent'
+
+    asyncio.run(main())
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_breaker_is_created_once(monkeypatch):
+    created = list()
+
+    class CountingBreaker(CircuitBreaker):
+        def __init__(self, *args):
+            created.append(args[0])
+            super().__init__(*args)
+
+    monkeypatch.setattr(UMRCircuitBreaker, 'CircuitBreaker', CountingBreaker)
+    circuit_breakers = CircuitBreakers()
+    barrier = threading.Barrier(8)
+
+    def get():
+        barrier.wait()
+        circuit_breakers.get('Telegram')
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert created == ['Telegram']
@@ -0,0 +1,81 @@
+import asyncio
+from unified_message_relay.Core.UMRCoalesce import Coalescers, MessageCoalescer, merge_messages
+from unified_message_relay.Core.UMRConfig import CoalesceRule
+from unified_message_relay.Core.UMRType import MessageEntity, EntityType, ChatAttribute, ChatType, \
+    GroupID
+
+DESTINATION = GroupID(platform='Telegram', chat_id=-10, chat_type=ChatType.GROUP)
+
+
+def test_merge_shifts_entities(message):
+    first = message('hello', message_id=1)
+    first.text_entities = [MessageEntity(0, 5, EntityType.BOLD)]
+    second = message('world', message_id=2)
+    second.text_entities = [MessageEntity(0, 5, EntityType.LINK, 'https://example.com')]
+
+    merged = merge_messages([first, second])
+    assert merged.text == 'hello\nworld'
+    assert [(i.start, i.end, i.entity_type, i.link) for i in merged.text_entities] == \
+        [(0, 5, EntityType.BOLD, ''), (6, 11, EntityType.LINK, 'https://example.com')]
+    assert merged.chat_attrs.message_id == 1  # attributes of the first message
+    assert first.text == 'hello' and first.text_entities[0].start == 0  # originals are not modified
+    assert merge_messages([first]) is first
+
+
+def run_coalescer(messages, window: float = 0.02, max_messages: int = 10, wait: float = 0.06):
+    async def main():
+        sent = list()
+
+        async def sender(message, platform, chat_id, chat_type):
+            sent.append(message.text)
+
+        coalescer = MessageCoalescer(DESTINATION, sender, window, max_messages)
+        for i in messages:
+            await coalescer.submit(i)
+        await asyncio.sleep(wait)
+        return sent, coalescer
+
+    return asyncio.run(main())
+
+
+def test_burst_from_same_sender_is_merged(message):
+    sent, coalescer = run_coalescer([message('a'), message('b'), message('c')])
+    assert sent == ['a\nb\nc']
+    assert (coalescer.received, coalescer.sent) == (3, 1)
+
+
+def test_other_sender_flushes_buffer(message):
+    sent, _ = run_coalescer([message('a'), message('b'), message('c', user_id=2), message('d', user_id=2)])
+    assert sent == ['a\nb', 'c\nd']
+
+
+def test_reply_and_media_are_sent_as_is_in_order(message):
+    reply = message('reply')
+    reply.chat_attrs.reply_to = ChatAttribute(platform='QQ', chat_id=-1, chat_type=ChatType.GROUP, message_id=9)
+    image = message('caption')
+    image.image = '/tmp/image.png'
+    sent, _ = run_coalescer([message('a'), reply, message('b'), image, message('c')])
+    assert sent == ['a', 'reply', 'b', 'caption', 'c']
+
+
+def test_max_messages_flushes_immediately(message):
+    sent, _ = run_coalescer([message(str(i)) for i in range(5)], window=1, max_messages=2, wait=0.01)
+    assert sent == ['0\n1', '2\n3']  # the last one waits for the window
+
+
+def test_only_configured_destinations_coalesce():
+    async def sender(message, platform, chat_id, chat_type):
+        pass
+
+    async def main():
+        coalescers = Coalescers(sender, [CoalesceRule(To='Telegram', ToChat=-10), CoalesceRule(To='Discord')])
+        assert coalescers
+        assert coalescers.get_coalescer('Telegram', -10, ChatType.GROUP)
+        assert coalescers.get_coalescer('Telegram', -10, ChatType.GROUP) is \
+            coalescers.get_coalescer('Telegram', -10, ChatType.GROUP)
+        assert coalescers.get_coalescer('Telegram', -20, ChatType.GROUP) is None
+        assert coalescers.get_coalescer('Discord', 5, ChatType.GROUP)  # every chat of the driver
+        assert coalescers.get_coalescer('QQ', -1, ChatType.GROUP) is None
+        assert not Coalescers(sender, [])
+
+    asyncio.run(main())
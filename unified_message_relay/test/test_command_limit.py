@@ -0,0 +1,51 @@
+import asyncio
+from unified_message_relay.Core import UMRCommand
+from unified_message_relay.Core.UMRCommand import CommandLimiter
+from unified_message_relay.Core.UMRType import ChatAttribute, ChatType
+
+
+def chat(user_id: int = 1, chat_id: int = -100) -> ChatAttribute:
+    return ChatAttribute(platform='QQ', chat_id=chat_id, chat_type=ChatType.GROUP, user_id=user_id)
+
+
+def test_max_concurrency():
+    limiter = CommandLimiter(0, 1, 0, 1, max_concurrency=1)
+    assert limiter.acquire(chat()) == ('', 0)
+    reason, _ = limiter.acquire(chat(user_id=2))
+    assert reason
+    limiter.release()
+    assert limiter.acquire(chat(user_id=2)) == ('', 0)
+
+
+def test_user_rate():
+    limiter = CommandLimiter(user_rate=0.1, user_burst=1, chat_rate=0, chat_burst=1, max_concurrency=0)
+    assert limiter.acquire(chat())[0] == ''
+    reason, retry_after = limiter.acquire(chat())
+    assert reason and retry_after > 0
+    assert limiter.acquire(chat(user_id=2))[0] == ''  # other users have their own bucket
+
+
+def test_chat_rejection_does_not_charge_user():
+    limiter = CommandLimiter(user_rate=0.1, user_burst=2, chat_rate=0.1, chat_burst=1, max_concurrency=0)
+    assert limiter.acquire(chat(chat_id=-1))[0] == ''
+    assert limiter.acquire(chat(chat_id=-1))[0]  # chat bucket is empty
+    assert limiter.acquire(chat(chat_id=-2))[0] == ''  # user still has the second token
+    assert limiter.running == 2  # rejected runs are not counted
+
+
+def test_rejection_reply_is_throttled(monkeypatch):
+    replies = list()
+
+    async def quick_reply(chat_attrs, text, message_entities=None):
+        replies.append(text)
+
+    monkeypatch.setattr(UMRCommand, 'quick_reply', quick_reply)
+    monkeypatch.setattr(UMRCommand, 'rejection_replies', dict())
+
+    async def main():
+        for _ in range(5):
+            await UMRCommand.reject(chat(), 'busy')
+        await UMRCommand.reject(chat(user_id=2), 'busy')
+
+    asyncio.run(main())
+    assert replies == ['busy', 'busy']
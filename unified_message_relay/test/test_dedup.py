@@ -0,0 +1,42 @@
+from unified_message_relay.Core.UMRConfig import DedupConfig
+from unified_message_relay.Core.UMRDedup import MessageDeduplicator
+
+
+def test_redelivered_message_is_dropped(message):
+    deduplicator = MessageDeduplicator(capacity=100)
+    assert not deduplicator.is_duplicate(message(message_id=1))
+    assert deduplicator.is_duplicate(message(message_id=1))
+    assert not deduplicator.is_duplicate(message(message_id=2))
+    assert not deduplicator.is_duplicate(message(message_id=1, chat_id=-200))  # same id in another chat
+    assert deduplicator.stats() == {'QQ': 1}
+
+
+def test_parts_of_one_platform_message_are_kept(message):
+    deduplicator = MessageDeduplicator(capacity=100)
+    assert not deduplicator.is_duplicate(message('text part', message_id=1))
+    image = message('', message_id=1)
+    image.image = '/tmp/image.png'
+    assert not deduplicator.is_duplicate(image)
+    assert deduplicator.is_duplicate(image)
+
+
+def test_messages_without_id_or_when_disabled_are_never_duplicates(message):
+    deduplicator = MessageDeduplicator(capacity=100)
+    assert not deduplicator.is_duplicate(message(message_id=0))
+    assert not deduplicator.is_duplicate(message(message_id=0))
+    assert not DedupConfig().Enabled  # opt in
+    disabled = MessageDeduplicator(capacity=0)
+    assert not disabled.is_duplicate(message(message_id=1))
+    assert not disabled.is_duplicate(message(message_id=1))
+
+
+def test_keys_are_remembered_for_one_generation(message):
+    deduplicator = MessageDeduplicator(capacity=3)
+    for message_id in range(1, 4):  # fills and rotates the first generation
+        assert not deduplicator.is_duplicate(message(message_id=message_id))
+    assert deduplicator.is_duplicate(message(message_id=1))  # found in previous generation, kept alive
+    for message_id in range(4, 6):  # rotates again, 1 survives in the previous generation
+        assert not deduplicator.is_duplicate(message(message_id=message_id))
+    assert deduplicator.is_duplicate(message(message_id=1))
+    assert not deduplicator.is_duplicate(message(message_id=2))  # older than two generations
+    assert len(deduplicator.current) + len(deduplicator.previous) <= 2 * 3
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+from unified_message_relay.Core.UMRDriver import BaseDriverMixin, DriverAPI, blocking
+
+
+class Driver(BaseDriverMixin):
+    def __init__(self, name):
+        super().__init__(name)
+
+    async def send(self, to_chat, chat_type, message):
+        return threading.current_thread()
+
+    def sync_api(self, value, offset=0):
+        return threading.current_thread(), value + offset
+
+    @blocking
+    def blocking_api(self):
+        return threading.current_thread()
+
+    def listed_api(self):
+        return threading.current_thread()
+
+    def future_api(self):
+        async def result():
+            return 'done'
+
+        return asyncio.ensure_future(result())  # needs the caller's loop
+
+    def _private(self):
+        pass
+
+
+def test_sync_and_async_methods_run_on_caller_thread():
+    api = DriverAPI('Test', Driver('Test'), sync_workers=2, blocking_apis=['listed_api', 'send'])
+    assert {'send', 'sync_api', 'blocking_api', 'future_api'} <= set(api.functions)
+    assert '_private' not in api.functions
+
+    async def main():
+        caller = threading.current_thread()
+        assert await api.call('send', 1, None, None) is caller  # coroutines are never offloaded
+        assert await api.call('sync_api', 1, offset=2) == (caller, 3)
+        future = await api.call('future_api')
+        assert isinstance(future, asyncio.Future) and await future == 'done'
+        assert await api.call('blocking_api') is not caller
+        assert await api.call('listed_api') is not caller
+
+    asyncio.run(main())
+    assert api.executor is not None
+
+
+def test_missing_and_late_methods():
+    driver = Driver('Test')
+    api = DriverAPI('Test', driver, sync_workers=1)
+
+    async def main():
+        assert await api.call('missing') is None
+        driver.late_api = lambda: 'late'  # set on instance after registration
+        assert await api.call('late_api') == 'late'
+        assert 'late_api' in api.functions
+        assert await api.call('sync_api', 1) == (threading.current_thread(), 1)
+
+    asyncio.run(main())
+    assert api.executor is None  # no blocking call, no pool
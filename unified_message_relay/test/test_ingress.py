@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+from unified_message_relay.Core.UMRIngress import IngressQueue
+from unified_message_relay.Core.UMRType import QueueOverflowPolicy
+
+
+class Recorder:
+    """
+    dispatch function that records message texts, chats in held wait until released
+    """
+    def __init__(self):
+        self.dispatched = list()
+        self.held = dict()
+
+    def hold(self, chat_id) -> threading.Event:
+        return self.held.setdefault(chat_id, threading.Event())
+
+    async def __call__(self, message):
+        gate = self.held.get(message.chat_attrs.chat_id)
+        while gate and not gate.is_set():
+            await asyncio.sleep(0.001)
+        self.dispatched.append(message.text)
+
+    def wait_for(self, count: int):
+        deadline = time.monotonic() + 5
+        while len(self.dispatched) < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        assert len(self.dispatched) >= count
+
+
+def test_messages_of_a_chat_keep_order_across_drivers(message):
+    recorder = Recorder()
+    ingress = IngressQueue(recorder, max_size=0, batch_size=4, overflow_policy=QueueOverflowPolicy.BLOCK)
+
+    def driver(name):
+        async def receive():
+            for index in range(50):
+                await ingress.put(message(f'{name}{index}', chat_id=-1))
+
+        asyncio.run(receive())
+
+    threads = [threading.Thread(target=driver, args=(name,)) for name in 'ab']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    recorder.wait_for(100)
+    for name in 'ab':
+        assert [text for text in recorder.dispatched if text[0] == name] == [f'{name}{index}' for index in range(50)]
+    assert ingress.stats()['dispatched'] == 100
+
+
+def test_slow_chat_does_not_hold_other_chats(message):
+    recorder = Recorder()
+    slow = recorder.hold(-1)
+    ingress = IngressQueue(recorder, max_size=0, batch_size=64, overflow_policy=QueueOverflowPolicy.BLOCK)
+
+    async def receive():
+        await ingress.put(message('slow', chat_id=-1))
+        while ingress.stats()['running'] == 0:
+            await asyncio.sleep(0.001)
+        for index in range(3):
+            await ingress.put(message(f'fast{index}', chat_id=-2))
+
+    asyncio.run(receive())
+    recorder.wait_for(3)  # batches after the slow message
+    assert recorder.dispatched == ['fast0', 'fast1', 'fast2']
+    slow.set()
+    recorder.wait_for(4)
+
+
+def test_block_waits_for_room_in_order(message):
+    recorder = Recorder()
+    gate = recorder.hold(-1)
+    ingress = IngressQueue(recorder, max_size=2, batch_size=64, overflow_policy=QueueOverflowPolicy.BLOCK)
+
+    async def receive():
+        for text in ('a', 'b'):
+            await ingress.put(message(text, chat_id=-1))
+        puts = [asyncio.ensure_future(ingress.put(message(text, chat_id=-1))) for text in 'cde']
+        ticks = 0
+        while ticks < 20:  # caller's loop keeps running
+            await asyncio.sleep(0.001)
+            ticks += 1
+        assert not any(put.done() for put in puts)
+        assert ingress.stats()['blocked'] == 3
+        gate.set()
+        await asyncio.gather(*puts)
+
+    asyncio.run(receive())
+    recorder.wait_for(5)
+    assert recorder.dispatched == ['a', 'b', 'c', 'd', 'e']
+    assert ingress.stats()['dropped'] == 0
+
+
+def test_drop_policies(message):
+    for policy, expected in ((QueueOverflowPolicy.DROP_NEWEST, ['a', 'b']),
+                             (QueueOverflowPolicy.DROP_OLDEST, ['a', 'd'])):
+        recorder = Recorder()
+        gate = recorder.hold(-1)
+        ingress = IngressQueue(recorder, max_size=2, batch_size=64, overflow_policy=policy)
+
+        async def receive():
+            await ingress.put(message('a', chat_id=-1))
+            while ingress.stats()['running'] == 0:  # a is being dispatched, only waiting ones can be dropped
+                await asyncio.sleep(0.001)
+            for text in 'bcd':
+                await ingress.put(message(text, chat_id=-1))
+
+        asyncio.run(receive())
+        gate.set()
+        recorder.wait_for(2)
+        time.sleep(0.01)
+        assert recorder.dispatched == expected
+        stats = ingress.stats()
+        assert stats['dropped'] == 2 and stats['depth'] == 0 and stats['running'] == 0
+
+
+def test_shards_pin_chats_and_run_blocking_work_in_parallel(message):
+    threads = dict()
+    gate = threading.Event()
+
+    async def dispatch(received):
+        threads.setdefault(received.chat_attrs.chat_id, set()).add(threading.current_thread().name)
+        if received.chat_attrs.chat_id == -1:
+            gate.wait(5)  # blocks its whole shard
+
+    ingress = IngressQueue(dispatch, max_size=0, batch_size=64, overflow_policy=QueueOverflowPolicy.BLOCK, shards=4)
+    blocked_shard = ingress.shard_of(message(chat_id=-1))
+    others = [chat_id for chat_id in range(-2, -40, -1)
+              if ingress.shard_of(message(chat_id=chat_id)) is not blocked_shard]
+
+    async def receive():
+        await ingress.put(message(chat_id=-1))
+        for _ in range(3):
+            for chat_id in others:
+                await ingress.put(message(chat_id=chat_id))
+
+    asyncio.run(receive())
+    deadline = time.monotonic() + 5
+    while ingress.stats()['dispatched'] < 3 * len(others) and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert ingress.stats()['dispatched'] == 3 * len(others)  # only the blocked shard waits
+    gate.set()
+    assert len({name for chat_id in others for name in threads[chat_id]}) == 3
+    assert all(len(names) == 1 for names in threads.values())
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import threading
+import time
+import pytest
+from unified_message_relay.Core.UMRJournal import OutboundJournal, dump_payload, load_payload
+from unified_message_relay.Core.UMRSendQueue import SendQueues
+from unified_message_relay.Core.UMRType import ChatType, QueueOverflowPolicy, UnifiedMessageView, ChatAttribute, \
+    MessageEntity, EntityType, SendAction, GroupID
+
+
+def journal(path, sender=None, max_attempts: int = 3, loop_of=None) -> OutboundJournal:
+    async def ignore(*args, **kwargs):
+        pass
+
+    return OutboundJournal(str(path), sender or ignore, lambda platform: True, max_attempts=max_attempts,
+                           retry_delay=0.01, max_retry_delay=0.01, flush_interval=0.01, batch_size=100,
+                           loop_of=loop_of)
+
+
+def wait_for(condition, timeout: float = 2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_pending_entries_are_replayed_after_restart(tmp_path, message):
+    path = tmp_path / 'journal.db'
+    first = journal(path)
+    pending_id = first.record(message('pending'), 'Telegram', 1, ChatType.GROUP)
+    completed_id = first.record(message('completed'), 'Telegram', 2, ChatType.GROUP)
+    discarded_id = first.record(message('discarded'), 'Telegram', 3, ChatType.GROUP)
+    first.complete(completed_id)
+    first.discard(discarded_id)
+    first.close()
+    assert not first.writer.is_alive()
+    assert first.stats()['discarded'] == 1
+
+    replayed = list()
+
+    async def sender(message, platform, chat_id, chat_type, journal_id=0):
+        replayed.append((message.text, platform, chat_id, journal_id))
+        second.complete(journal_id)
+
+    second = journal(path, sender)
+    wait_for(lambda: replayed)
+    assert replayed == [('pending', 'Telegram', 1, pending_id)]
+    assert second.record(message('new'), 'Telegram', 1, ChatType.GROUP) > pending_id
+    second.close()
+
+
+def test_failed_entry_is_retried_then_dead_lettered(tmp_path, message):
+    attempts = list()
+
+    async def sender(message, platform, chat_id, chat_type, journal_id=0):
+        attempts.append(journal_id)
+        failing.fail(journal_id, ValueError('send failed'))
+
+    failing = journal(tmp_path / 'journal.db', sender, max_attempts=3)
+    journal_id = failing.record(message('hello'), 'Telegram', 1, ChatType.GROUP)
+    failing.fail(journal_id, ValueError('send failed'))
+    wait_for(lambda: failing.stats()['dead'] == 1)
+    assert attempts == [journal_id, journal_id]
+    assert failing.stats()['pending'] == 0
+    failing.close()
+    dead_letters = failing.dead_letters()
+    assert len(dead_letters) == 1
+    assert dead_letters[0]['attempts'] == 3
+    assert 'send failed' in dead_letters[0]['last_error']
+
+
+def test_dropped_queue_entries_are_discarded(message):
+    async def main(overflow_policy: QueueOverflowPolicy):
+        discarded = list()
+        blocked = asyncio.Event()
+
+        async def sender(message, platform, chat_id, chat_type, journal_id=0):
+            await blocked.wait()
+
+        send_queues = SendQueues(sender, max_size=1, overflow_policy=overflow_policy, discard=discarded.append)
+        await send_queues.put(message('sending'), 'Telegram', 1, ChatType.GROUP, journal_id=1)
+        await asyncio.sleep(0)  # worker takes the first message
+        await send_queues.put(message('queued'), 'Telegram', 1, ChatType.GROUP, journal_id=2)
+        await send_queues.put(message('overflow'), 'Telegram', 1, ChatType.GROUP, journal_id=3)
+        await send_queues.put(message('not journaled'), 'Telegram', 1, ChatType.GROUP)
+        blocked.set()
+        return discarded
+
+    assert asyncio.run(main(QueueOverflowPolicy.DROP_NEWEST)) == [3]
+    assert asyncio.run(main(QueueOverflowPolicy.DROP_OLDEST)) == [2, 3]
+
+
+def test_payload_keeps_every_message_field(message):
+    original = message('hello', user_id='u1', message_id=7, name='alice',
+                       message_entities=[MessageEntity(0, 5, EntityType.BOLD | EntityType.ITALIC, 'https://a.b')])
+    original.chat_attrs.reply_to = ChatAttribute(platform='QQ', chat_id=-100, chat_type=ChatType.GROUP, message_id=3)
+    original.image = '/tmp/image.png'
+    original.path = (GroupID(platform='QQ', chat_type=ChatType.GROUP, chat_id=-100),)
+    original.hops = 1
+    view = UnifiedMessageView(original, send_action=SendAction(message_id=3, user_id=2), text='hello!')
+
+    platform, chat_id, chat_type, loaded = load_payload(dump_payload('Telegram', '@channel', ChatType.GROUP, view))
+    assert (platform, chat_id, chat_type) == ('Telegram', '@channel', ChatType.GROUP)
+    assert (loaded.text, loaded.image, loaded.path, loaded.hops, loaded.send_action) == \
+        ('hello!', '/tmp/image.png', original.path, 1, SendAction(message_id=3, user_id=2))
+    assert [(i.start, i.end, i.entity_type, i.link) for i in loaded.text_entities] == \
+        [(0, 5, EntityType.BOLD | EntityType.ITALIC, 'https://a.b')]
+    assert vars(loaded.chat_attrs).keys() == vars(original.chat_attrs).keys()
+    assert (loaded.chat_attrs.user_id, loaded.chat_attrs.message_id, loaded.chat_attrs.name) == ('u1', 7, 'alice')
+    assert loaded.chat_attrs.reply_to.message_id == 3 and loaded.chat_attrs.forward_from is None
+
+    unknown = json.loads(dump_payload('Telegram', 1, ChatType.GROUP, original))
+    unknown['version'] = 0
+    with pytest.raises(ValueError):
+        load_payload(json.dumps(unknown).encode())
+
+
+def test_retry_runs_on_destination_loop(tmp_path, message):
+    driver_loop = asyncio.new_event_loop()
+    driver_thread = threading.Thread(target=driver_loop.run_forever, daemon=True)
+    driver_thread.start()
+    threads = list()
+
+    async def sender(message, platform, chat_id, chat_type, journal_id=0):
+        threads.append((threading.current_thread(), asyncio.get_event_loop()))
+        retrying.complete(journal_id)
+
+    retrying = journal(tmp_path / 'journal.db', sender,
+                       loop_of=lambda platform: driver_loop if platform == 'Telegram' else None)
+    retrying.fail(retrying.record(message('hello'), 'Telegram', 1, ChatType.GROUP), ValueError('send failed'))
+    retrying.fail(retrying.record(message('hello'), 'Discord', 1, ChatType.GROUP), ValueError('send failed'))
+    wait_for(lambda: len(threads) == 2)
+    assert (driver_thread, driver_loop) in threads
+    assert (retrying.retry_thread, retrying.loop) in threads  # platform without a loop
+    retrying.close()
+    driver_loop.call_soon_threadsafe(driver_loop.stop)
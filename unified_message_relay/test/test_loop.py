@@ -0,0 +1,66 @@
+from unified_message_relay.Core.UMRLoop import LoopGuard
+from unified_message_relay.Core.UMRMessageRelation import set_ingress_message_id, set_egress_message_id
+from unified_message_relay.Core.UMRMetrics import metrics
+from unified_message_relay.Core.UMRType import ChatType, GroupID
+
+
+def guard(bot_accounts=None, max_hops: int = 3, drop_own_messages: bool = False) -> LoopGuard:
+    return LoopGuard(bot_accounts or dict(), max_hops, drop_own_messages)
+
+
+def dropped(reason: str, platform: str) -> int:
+    return metrics.snapshot()['counter'].get(f'loop_{reason}_dropped/{platform}', {'value': 0})['value']
+
+
+def test_own_message_is_only_dropped_when_enabled(message):
+    accounts = {'QQ': 10000, 'Telegram': '42'}
+    assert guard(accounts).check(message(platform='QQ', chat_id=-1, user_id=10000, message_id=1)) == ''
+    dropping = guard(accounts, drop_own_messages=True)
+    assert dropping.check(message(platform='QQ', chat_id=-1, user_id=10000, message_id=1)) == 'own_message'
+    # account ids compared as str
+    assert dropping.check(message(platform='Telegram', chat_id=-1, user_id=42, message_id=1)) == 'own_message'
+    assert dropping.check(message(platform='QQ', chat_id=-1, user_id=10001, message_id=1)) == ''
+
+
+def test_echo_of_forwarded_message_is_dropped(message):
+    set_ingress_message_id('QQ', -1001, ChatType.GROUP, 1001, 7)
+    set_egress_message_id('QQ', -1001, 1001, ChatType.GROUP, 'Telegram', -1002, 2001, ChatType.GROUP, 7)
+
+    # copy sent by the bot comes back
+    assert guard().check(message(platform='Telegram', chat_id=-1002, user_id=7, message_id=2001)) == 'echo'
+    # received message itself has no source
+    assert guard().check(message(platform='QQ', chat_id=-1001, user_id=7, message_id=1001)) == ''
+    assert guard().check(message(platform='Telegram', chat_id=-1002, user_id=7, message_id=2002)) == ''
+    # driver does not report message ids
+    assert guard().check(message(platform='Telegram', chat_id=-1002, user_id=7, message_id=0)) == ''
+
+
+def test_message_back_in_its_path_is_dropped(message):
+    relayed = message(platform='Telegram', chat_id=-10, message_id=1)
+    relayed.path = (GroupID(platform='QQ', chat_id=-1, chat_type=ChatType.GROUP),
+                    GroupID(platform='Discord', chat_id=-5, chat_type=ChatType.GROUP))
+    assert guard().check(relayed) == ''
+    relayed.path += (GroupID(platform='Telegram', chat_id=-10, chat_type=ChatType.GROUP),
+                     GroupID(platform='Matrix', chat_id='!room', chat_type=ChatType.GROUP))
+    assert guard().check(relayed) == 'path'
+
+
+def test_hop_limit(message):
+    relayed = message(platform='QQ', chat_id=-1, message_id=1)
+    relayed.hops = 3
+    assert guard(max_hops=3).check(relayed) == ''
+    relayed.hops = 4
+    assert guard(max_hops=3).check(relayed) == 'hop_limit'
+    assert guard(max_hops=0).check(relayed) == ''
+
+
+def test_is_loop_counts_dropped_messages(message):
+    hop_limit, own_message = dropped('hop_limit', 'Discord'), dropped('own_message', 'Discord')
+    relayed = message(platform='Discord', chat_id=-1, message_id=1)
+    relayed.hops = 2
+    assert guard(max_hops=1).is_loop(relayed)
+    assert guard(max_hops=1).is_loop(relayed)
+    assert not guard(max_hops=2).is_loop(relayed)
+    assert guard({'Discord': 1}, drop_own_messages=True).is_loop(message(platform='Discord', user_id=1))
+    assert dropped('hop_limit', 'Discord') == hop_limit + 2
+    assert dropped('own_message', 'Discord') == own_message + 1
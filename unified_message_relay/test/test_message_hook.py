@@ -0,0 +1,115 @@
+import asyncio
+import random
+from unified_message_relay.Core import UMRMessageHook
+from unified_message_relay.Core.UMRMessageHook import HookIndex, register_hook, dispatch_hook
+from unified_message_relay.Core.UMRType import MessageHook, ChatType, UnifiedMessageView, MessageEntity, EntityType
+
+G = ChatType.GROUP
+P = ChatType.PRIVATE
+ANY = ChatType.UNSPECIFIED
+
+
+def hook(name: str, src_driver='', src_chat=0, src_chat_type=ANY, dst_driver='', dst_chat=0, dst_chat_type=ANY) \
+        -> MessageHook:
+    def hook_function(message):
+        pass
+
+    hook_function.__name__ = name
+    return MessageHook(src_driver, src_chat, src_chat_type, dst_driver, dst_chat, dst_chat_type, hook_function)
+
+
+def names(hooks) -> list:
+    return [i.hook_function.__name__ for i in hooks]
+
+
+def test_source_wildcards_keep_registration_order():
+    index = HookIndex([hook('qq_group', 'QQ', src_chat_type=G),
+                       hook('everything'),
+                       hook('chats', ['QQ', 'Telegram'], [-1, -2]),
+                       hook('private', src_chat_type=P),
+                       hook('telegram', 'Telegram')], False)
+    assert names(index.match('QQ', -1, G)) == ['qq_group', 'everything', 'chats']
+    assert names(index.match('QQ', -3, G)) == ['qq_group', 'everything']
+    assert names(index.match('Telegram', -2, G)) == ['everything', 'chats', 'telegram']
+    assert names(index.match('Telegram', 5, P)) == ['everything', 'private', 'telegram']
+    assert names(index.match('Discord', 5, G)) == ['everything']
+
+
+def test_destination_attributes_are_intersected():
+    index = HookIndex([hook('qq_to_telegram', 'QQ', dst_driver='Telegram'),
+                       hook('to_chat', dst_driver='Telegram', dst_chat=-10),
+                       hook('to_private', 'QQ', dst_chat_type=P)], True)
+    assert names(index.match('QQ', -1, G, 'Telegram', -10, G)) == ['qq_to_telegram', 'to_chat']
+    assert names(index.match('QQ', -1, G, 'Telegram', -20, P)) == ['qq_to_telegram', 'to_private']
+    assert names(index.match('Discord', -1, G, 'Telegram', -10, G)) == ['to_chat']
+    assert names(index.match('QQ', -1, G, 'Discord', -10, G)) == []
+
+
+def test_cached_result_is_reused():
+    index = HookIndex([hook('qq', 'QQ')], False)
+    first = index.match('QQ', -1, G)
+    assert index.match('QQ', -1, G) is first
+    assert index.match('Telegram', -1, G) == ()
+
+
+def brute_force(hooks, match_destination, src_driver, src_chat, src_chat_type, dst_driver, dst_chat, dst_chat_type):
+    def matches(drivers, chats, chat_types, driver, chat, chat_type):
+        return (not drivers or driver in drivers) and (not chats or chat in chats) and \
+            (ANY in chat_types or chat_type in chat_types)
+
+    return [i for i in hooks
+            if matches(i.src_driver, i.src_chat, i.src_chat_type, src_driver, src_chat, src_chat_type)
+            and (not match_destination
+                 or matches(i.dst_driver, i.dst_chat, i.dst_chat_type, dst_driver, dst_chat, dst_chat_type))]
+
+
+def test_same_result_as_scanning_every_hook():
+    rng = random.Random(0)
+    drivers = ['QQ', 'Telegram', 'Discord']
+    chats = [-1, -2, 3]
+    chat_types = [G, P]
+
+    def attributes():
+        return (rng.choice(['', rng.choice(drivers), rng.sample(drivers, 2)]),
+                rng.choice([0, rng.choice(chats), rng.sample(chats, 2)]),
+                rng.choice([ANY, rng.choice(chat_types), chat_types]))
+
+    hooks = [hook(str(i), *attributes(), *attributes()) for i in range(60)]
+    for match_destination in (False, True):
+        index = HookIndex(hooks, match_destination)
+        for _ in range(300):
+            chat = (rng.choice(drivers), rng.choice(chats), rng.choice(chat_types),
+                    rng.choice(drivers), rng.choice(chats), rng.choice(chat_types))
+            assert list(index.match(*chat)) == brute_force(hooks, match_destination, *chat)
+
+
+def test_destination_hooks_modify_their_own_view(monkeypatch, message):
+    monkeypatch.setattr(UMRMessageHook, 'message_hook_full', list())
+    monkeypatch.setattr(UMRMessageHook, 'hook_index_full', UMRMessageHook.hook_index_full)
+
+    @register_hook(src_driver='QQ', dst_driver='Telegram')
+    async def telegram_hook(dst_driver, dst_chat, dst_chat_type, message):
+        message.chat_attrs.name += ' (QQ)'
+        message.text_entities[0].entity_type = EntityType.BOLD
+        message.send_action.message_id = 5
+
+    @register_hook(src_driver='QQ', dst_driver='Discord')
+    async def discord_hook(dst_driver, dst_chat, dst_chat_type, message):
+        message.chat_attrs.name = message.chat_attrs.name.upper()
+        message.text_entities.append(MessageEntity(0, 2, EntityType.ITALIC))
+
+    original = message(message_entities=[MessageEntity(0, 5)], name='alice')
+    telegram = UnifiedMessageView(original)
+    discord = UnifiedMessageView(original)
+
+    async def main():
+        await dispatch_hook(telegram, 'Telegram', -10, G)
+        await dispatch_hook(discord, 'Discord', -20, G)
+
+    asyncio.run(main())
+    assert telegram.chat_attrs.name == 'alice (QQ)' and discord.chat_attrs.name == 'ALICE'
+    assert [i.entity_type for i in telegram.text_entities] == [EntityType.BOLD]
+    assert [i.entity_type for i in discord.text_entities] == [EntityType.PLAIN, EntityType.ITALIC]
+    assert discord.send_action.message_id == 0
+    assert original.chat_attrs.name == 'alice' and original.send_action.message_id == 0
+    assert [i.entity_type for i in original.text_entities] == [EntityType.PLAIN]
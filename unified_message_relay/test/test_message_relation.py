@@ -0,0 +1,46 @@
+from unified_message_relay.Core.UMRMessageRelation import RelationStore
+from unified_message_relay.Core.UMRType import ChatType
+
+
+def test_busy_chat_uses_whole_capacity():
+    store = RelationStore(capacity=64, shards=4)
+    for message_id in range(1000):
+        store.set_ingress('QQ', ChatType.GROUP, -1, message_id, 1)
+    assert len(store) == 64  # not capacity / shards
+    assert store.get(('QQ', ChatType.GROUP, -1, 999))
+    assert not store.get(('QQ', ChatType.GROUP, -1, 0))
+
+
+def test_oldest_keys_are_evicted_first():
+    store = RelationStore(capacity=8, shards=1)
+    for message_id in range(10):
+        store.set_ingress('QQ', ChatType.GROUP, -1, message_id, 1)
+    assert [message_id for message_id in range(10) if store.get(('QQ', ChatType.GROUP, -1, message_id))] == \
+        list(range(2, 10))
+
+
+def test_copies_point_to_received_message():
+    store = RelationStore(capacity=64, shards=4)
+    src_key = ('QQ', ChatType.GROUP, -1, 1)
+    group = store.set_ingress('QQ', ChatType.GROUP, -1, 1, 7)
+    assert store.set_ingress('QQ', ChatType.GROUP, -1, 1, 7) is None  # redelivered
+    assert store.set_egress(src_key, 'Telegram', ChatType.GROUP, -2, 2, 7) is group
+    assert store.set_egress(('QQ', ChatType.GROUP, -1, 404), 'Telegram', ChatType.GROUP, -2, 3, 7) is None
+
+    copy = store.get(('Telegram', ChatType.GROUP, -2, 2))
+    assert copy is group
+    member = copy.build(copy.find('Telegram', ChatType.GROUP, -2))
+    assert member.message_id == 2
+    assert member.source.platform == 'QQ' and member.source.message_id == 1
+    assert copy.build(copy.find('QQ', ChatType.GROUP, -1)).source is None
+
+
+def test_evicted_copy_keeps_other_keys():
+    store = RelationStore(capacity=2, shards=1)
+    src_key = ('QQ', ChatType.GROUP, -1, 1)
+    store.set_ingress('QQ', ChatType.GROUP, -1, 1, 7)
+    store.set_egress(src_key, 'Telegram', ChatType.GROUP, -2, 2, 7)
+    store.set_egress(src_key, 'Discord', ChatType.GROUP, -3, 3, 7)  # evicts the received message key
+    assert not store.get(src_key)
+    group = store.get(('Discord', ChatType.GROUP, -3, 3))
+    assert group.find('QQ', ChatType.GROUP, -1) == 0
@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from unified_message_relay.Core import UMRAdmin, UMRConfig
+from unified_message_relay.Core.UMRType import ChatType
+
+OWNER = 1
+ADMIN = 2
+MEMBER = 3
+
+
+@pytest.fixture
+def platform_api(monkeypatch):
+    calls = list()
+
+    async def api_call(platform, role, chat_id, chat_type, user_id):
+        calls.append((role, user_id))
+        if role == 'is_group_owner':
+            return user_id == OWNER
+        return user_id in (OWNER, ADMIN)
+
+    monkeypatch.setattr(UMRAdmin, 'api_call', api_call)
+    monkeypatch.setattr(UMRAdmin, 'privilege_cache', UMRAdmin.PrivilegeCache())
+    return calls
+
+
+def use_ttl(monkeypatch, ttl: float):
+    monkeypatch.setattr(UMRConfig.config, 'Driver', {'QQ': UMRConfig.BaseDriverConfig(Base='QQ',
+                                                                                       PrivilegeCacheTTL=ttl)})
+
+
+async def check_all():
+    result = list()
+    for user_id in (OWNER, ADMIN, MEMBER):
+        result.append((await UMRAdmin.is_group_owner('QQ', -100, ChatType.GROUP, user_id),
+                       await UMRAdmin.is_group_admin('QQ', -100, ChatType.GROUP, user_id)))
+    return result
+
+
+def test_cached_results_match_uncached(platform_api, monkeypatch):
+    use_ttl(monkeypatch, 0)
+    uncached = asyncio.run(check_all())
+    assert uncached == [(True, True), (False, True), (False, False)]
+    assert len(platform_api) == 6
+
+    use_ttl(monkeypatch, 60)
+    platform_api.clear()
+    assert asyncio.run(check_all()) == uncached  # fetched
+    assert asyncio.run(check_all()) == uncached  # cached
+    assert len(platform_api) == 6
+
+
+def test_private_chat_is_never_privileged(platform_api, monkeypatch):
+    use_ttl(monkeypatch, 60)
+    assert not asyncio.run(UMRAdmin.is_group_owner('QQ', 100, ChatType.PRIVATE, OWNER))
+    assert not asyncio.run(UMRAdmin.is_group_admin('QQ', 100, ChatType.PRIVATE, OWNER))
+    assert not platform_api
+
+
+def test_invalidate_drops_cached_role(platform_api, monkeypatch):
+    use_ttl(monkeypatch, 60)
+    assert asyncio.run(UMRAdmin.is_group_admin('QQ', -100, ChatType.GROUP, ADMIN))
+    UMRAdmin.invalidate_privilege('QQ', -100, ADMIN)
+    assert asyncio.run(UMRAdmin.is_group_admin('QQ', -100, ChatType.GROUP, ADMIN))
+    assert platform_api == [('is_group_admin', ADMIN), ('is_group_admin', ADMIN)]
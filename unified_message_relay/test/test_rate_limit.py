@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+from unified_message_relay.Core import UMRRateLimit
+from unified_message_relay.Core.UMRRateLimit import TokenBucket, RateLimiter
+from unified_message_relay.Core.UMRType import ChatType
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(UMRRateLimit, 'time', clock)
+    return clock
+
+
+def test_reserve_goes_into_debt(clock):
+    bucket = TokenBucket(rate=2, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)  # waiters are served in order
+    assert bucket.throttled == 2
+    assert bucket.throttle_time == pytest.approx(1.5)
+
+    clock.now += 1  # pays back the debt of two tokens
+    assert bucket.reserve() == pytest.approx(0.5)
+    clock.now += 10
+    assert bucket.reserve() == 0  # refill is capped by capacity
+    assert bucket.reserve() == 0
+    assert bucket.reserve() > 0
+
+
+def test_try_acquire_and_peek_never_go_into_debt(clock):
+    bucket = TokenBucket(rate=1, capacity=1)
+    assert bucket.peek() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.peek() == pytest.approx(1.0)
+    assert bucket.try_acquire() == pytest.approx(1.0)
+    assert bucket.try_acquire() == pytest.approx(1.0)  # rejected attempts take nothing
+    clock.now += 0.5
+    assert bucket.peek() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_acquire() == 0
+
+
+def test_unlimited_bucket():
+    bucket = TokenBucket(rate=0, capacity=1)
+    assert all(bucket.reserve() == 0 for _ in range(100))
+    assert bucket.try_acquire() == 0 and bucket.peek() == 0
+
+
+def limiter(monkeypatch, **rate_limit) -> RateLimiter:
+    monkeypatch.setattr(RateLimiter, '_driver_config',
+                        staticmethod(lambda platform: UMRRateLimit.UMRConfig.RateLimitConfig(**rate_limit)))
+    return RateLimiter()
+
+
+def test_throttled_chat_does_not_hold_driver_bucket(clock, monkeypatch):
+    delays = list()
+    wakeups = list()
+
+    async def sleep(delay):
+        delays.append(delay)
+        wakeup = asyncio.get_event_loop().create_future()
+        wakeups.append(wakeup)
+        await wakeup
+
+    monkeypatch.setattr(UMRRateLimit.asyncio, 'sleep', sleep)
+    rate_limiter = limiter(monkeypatch, Rate=10, Burst=1, ChatRate=1, ChatBurst=1)
+
+    def wake(now, sleeper):
+        clock.now = now
+        wakeups[sleeper].set_result(None)
+
+    async def main():
+        await rate_limiter.acquire('Telegram', -1, ChatType.GROUP)
+        second = asyncio.ensure_future(rate_limiter.acquire('Telegram', -1, ChatType.GROUP))
+        third = asyncio.ensure_future(rate_limiter.acquire('Telegram', -2, ChatType.GROUP))
+        await asyncio.wait([second, third], timeout=0.01)
+        assert delays == [pytest.approx(1.0), pytest.approx(0.1)]  # only the first message uses the driver token
+
+        wake(1000.1, 1)  # third is sent
+        await third
+        wake(1001.0, 0)  # second is sent, the driver bucket is full again
+        await second
+        assert len(delays) == 2
+
+    asyncio.run(main())
+    stats = rate_limiter.stats()
+    assert stats['Telegram']['throttled'] == 1
+
+
+def test_chat_token_moves_with_driver_delay(clock, monkeypatch):
+    delays = list()
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(UMRRateLimit.asyncio, 'sleep', sleep)
+    rate_limiter = limiter(monkeypatch, Rate=1, Burst=1, ChatRate=1, ChatBurst=1)
+
+    async def main():
+        await rate_limiter.acquire('Telegram', -1, ChatType.GROUP)
+        await rate_limiter.acquire('Telegram', -2, ChatType.GROUP)  # waits for the driver only
+
+    asyncio.run(main())
+    assert delays == [pytest.approx(1.0)]
+    _, chat_bucket = rate_limiter._get_buckets('Telegram', -2, ChatType.GROUP)
+    assert chat_bucket.peek() == pytest.approx(2.0)  # next message to the chat waits a second after this one
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+from unified_message_relay.Core.UMRRelationDB import PersistentRelationStore
+from unified_message_relay.Core.UMRType import ChatType
+
+SRC_KEY = ('QQ', ChatType.GROUP, -1, 1)
+COPY_KEY = ('Telegram', ChatType.GROUP, -2, 2)
+
+
+def store(path) -> PersistentRelationStore:
+    return PersistentRelationStore(capacity=16, shards=2, path=str(path), ttl=0, flush_interval=0.01, batch_size=100)
+
+
+def test_relations_survive_restart_and_load_off_the_event_loop(tmp_path):
+    path = tmp_path / 'relation.db'
+    first = store(path)
+    first.set_ingress('QQ', ChatType.GROUP, -1, 1, 7)
+    first.set_egress(SRC_KEY, 'Telegram', ChatType.GROUP, -2, 2, 7)
+    first.close()
+    assert not first.writer.is_alive()
+
+    second = store(path)
+    threads = list()
+    load = second._load
+
+    def recording_load(key, connection=None):
+        threads.append(threading.current_thread())
+        return load(key, connection)
+
+    second._load = recording_load
+    group = asyncio.run(second.fetch(COPY_KEY))
+    assert group.find('QQ', ChatType.GROUP, -1) == 0
+    assert threads and threads[0] is not threading.main_thread()
+    assert asyncio.run(second.fetch(SRC_KEY)) is group  # cached with all members
+    assert second.stats()['loaded'] == 1
+    assert asyncio.run(second.fetch(('QQ', ChatType.GROUP, -1, 404))) is None
+    second.close()
+
+
+def test_copy_of_message_not_in_memory_is_added_by_writer(tmp_path):
+    path = tmp_path / 'relation.db'
+    first = store(path)
+    first.set_ingress('QQ', ChatType.GROUP, -1, 1, 7)
+    first.close()
+
+    second = store(path)
+    second._load = None  # the send path must not read from disk
+    assert second.set_egress(SRC_KEY, 'Telegram', ChatType.GROUP, -2, 2, 7) is None
+    del second._load
+    second.set_egress(('QQ', ChatType.GROUP, -1, 404), 'Telegram', ChatType.GROUP, -2, 3, 7)
+    second.close()
+
+    third = store(path)
+    group = asyncio.run(third.fetch(COPY_KEY))
+    member = group.build(group.find('Telegram', ChatType.GROUP, -2))
+    assert member.message_id == 2 and member.source.message_id == 1
+    assert asyncio.run(third.fetch(('Telegram', ChatType.GROUP, -2, 3))) is None
+    third.close()
+
+
+def test_sync_lookups_never_read_from_disk(tmp_path):
+    path = tmp_path / 'relation.db'
+    first = store(path)
+    first.set_ingress('QQ', ChatType.GROUP, -1, 1, 7)
+    first.set_egress(SRC_KEY, 'Telegram', ChatType.GROUP, -2, 2, 7)
+    first.close()
+
+    second = store(path)
+    second._load = None  # get must not read from disk
+    assert second.get(COPY_KEY) is None and second.get(SRC_KEY) is None
+    del second._load
+    assert asyncio.run(second.fetch(COPY_KEY)) is second.get(SRC_KEY)  # cached by fetch
+    assert second.stats() == {'cached': 2, 'loaded': 1, 'not_found': 0}
+    second.close()
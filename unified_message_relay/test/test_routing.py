@@ -0,0 +1,65 @@
+from unified_message_relay.Core.UMRConfig import ForwardList
+from unified_message_relay.Core.UMRRouting import RoutingTable, EMPTY_ROUTE
+from unified_message_relay.Core.UMRType import ChatType, ForwardActionType, DefaultForwardActionType
+
+G = ChatType.GROUP
+
+
+def topology(src: str, src_chat, dst: str, dst_chat, forward_type: str) -> dict:
+    return {'From': src, 'FromChat': src_chat, 'FromChatType': 'group',
+            'To': dst, 'ToChat': dst_chat, 'ToChatType': 'group', 'ForwardType': forward_type}
+
+
+def routing_table(topologies=(), defaults=()) -> RoutingTable:
+    return RoutingTable(ForwardList(Topology=list(topologies), Default=list(defaults)))
+
+
+def destinations(actions) -> list:
+    return [(i.to_platform, i.to_chat) for i in actions]
+
+
+def test_forward_types():
+    table = routing_table([topology('QQ', -1, 'Telegram', -10, 'BiDirection'),
+                           topology('QQ', -2, 'Telegram', -20, 'OneWay+'),
+                           topology('QQ', -3, 'Telegram', -30, 'OneWay')])
+    assert destinations(table.route('QQ', -1, G).forward_all) == [('Telegram', -10)]
+    assert destinations(table.route('Telegram', -10, G).forward_all) == [('QQ', -1)]
+
+    assert destinations(table.route('QQ', -2, G).forward_all) == [('Telegram', -20)]
+    backward = table.route('Telegram', -20, G)
+    assert not backward.forward_all and destinations(backward.reply_only) == [('QQ', -2)]
+
+    backward = table.route('Telegram', -30, G)
+    assert not backward.forward_all and not backward.reply_only and destinations(backward.block) == [('QQ', -3)]
+    assert backward  # blocked chats are still bridged
+
+
+def test_unknown_chat_gets_empty_route():
+    table = routing_table([topology('QQ', -1, 'Telegram', -10, 'BiDirection')])
+    assert table.route('QQ', -404, G) is EMPTY_ROUTE
+    assert table.route('QQ', -1, ChatType.PRIVATE) is EMPTY_ROUTE
+    assert table.route('Discord', -1, G) is EMPTY_ROUTE
+    assert not EMPTY_ROUTE
+    assert table.route('QQ', -404, G) is EMPTY_ROUTE  # lookups do not insert
+
+
+def test_reply_action_uses_first_rule_to_chat():
+    table = routing_table([topology('QQ', -1, 'Telegram', -10, 'OneWay'),
+                           topology('Telegram', -10, 'QQ', -1, 'BiDirection')])
+    route = table.route('Telegram', -10, G)
+    assert route.reply_action('QQ', -1) == ForwardActionType.Block
+    assert route.reply_action('QQ', -404) is None
+    assert table.route('QQ', -1, G).reply_action('Telegram', -10) == ForwardActionType.ForwardAll
+
+
+def test_default_rules():
+    table = routing_table(defaults=[
+        {'From': 'QQ', 'To': 'Telegram', 'ToChat': -100, 'ToChatType': 'group', 'ForwardType': 'OneWay+'},
+        {'From': 'QQ', 'To': 'Telegram', 'ToChat': -200, 'ToChatType': 'group', 'ForwardType': 'OneWay'},
+    ])
+    assert destinations(table.default_actions('QQ')) == [('Telegram', -100), ('Telegram', -200)]
+    assert table.default_actions('Telegram') == ()
+    assert table.default_action('QQ', 'Telegram', -100, G).action_type == DefaultForwardActionType.OneWayWithReply
+    assert table.default_action('QQ', 'Telegram', -200, G).action_type == DefaultForwardActionType.OneWay
+    assert table.default_action('QQ', 'Telegram', -300, G) is None
+    assert table.default_action('Telegram', 'QQ', -100, G) is None
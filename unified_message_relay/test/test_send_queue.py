@@ -0,0 +1,36 @@
+import asyncio
+from unified_message_relay.Core.UMRMetrics import metrics
+from unified_message_relay.Core.UMRSendQueue import SendQueues
+from unified_message_relay.Core.UMRType import ChatType, QueueOverflowPolicy
+
+
+def test_depth_and_wait_are_exported_per_destination(message):
+    sent = list()
+
+    async def main():
+        gate = asyncio.Event()
+
+        async def sender(sent_message, platform, chat_id, chat_type, journal_id=0):
+            await gate.wait()
+            sent.append((chat_id, sent_message.text))
+
+        queues = SendQueues(sender, 0, QueueOverflowPolicy.BLOCK)
+        for text in ('a', 'b', 'c'):
+            await queues.put(message(text), 'Telegram', -10, ChatType.GROUP)
+        await queues.put(message('d'), 'Telegram', -20, ChatType.GROUP)
+        await asyncio.sleep(0)
+        gauge = metrics.snapshot()['gauge']
+        assert gauge['send_queue_depth/Telegram:group:-10']['value'] == 2  # first message is being sent
+        assert gauge['send_queue_depth/Telegram:group:-20']['value'] == 0
+
+        gate.set()
+        for queue in queues.queues.values():
+            await queue.queue.join()
+
+    asyncio.run(main())
+    assert [text for chat_id, text in sent if chat_id == -10] == ['a', 'b', 'c']
+    snapshot = metrics.snapshot()
+    assert snapshot['gauge']['send_queue_depth/Telegram:group:-10']['value'] == 0
+    assert snapshot['latency']['send_queue_wait/Telegram:group:-10']['count'] == 3
+    assert snapshot['latency']['send_queue_wait/Telegram:group:-20']['count'] == 1
+    assert 'umr_send_queue_depth{driver="Telegram:group:-10"} 0' in metrics.export_prometheus()